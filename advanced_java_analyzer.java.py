@@ -1,20 +1,119 @@
+import io
 import os
 import re
+import bisect
+import logging
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import tree_sitter_java as tsjava
+from tree_sitter import Language, Parser
+from java_syntax import (TYPE_DECLARATIONS, body_members, declared_names, node_text, referenced_types, type_list,
+                         type_name)
+
+JAVA_LANGUAGE = Language(tsjava.language())
+parser = Parser()
+parser.language = JAVA_LANGUAGE
+
+COMMON_CLASSES = {'String', 'Integer', 'Long', 'Double', 'Float', 'Boolean',
+                  'BigDecimal', 'BigInteger', 'List', 'ArrayList', 'LinkedList',
+                  'Set', 'HashSet', 'TreeSet', 'Map', 'HashMap', 'TreeMap',
+                  'Queue', 'Deque', 'Stack', 'Vector'}
+
+# 并行分析时每个工作进程一次领取的文件数
+FILES_PER_TASK = 32
+
+# 按包、邻域或 max_nodes 绘制的子图中类型超过这个数量时默认只画类型名，不展开字段和方法
+MAX_NODES_WITH_MEMBERS = 200
+
+RELATION_ARROWS = {
+    'extends': '--|>',
+    'implements': '..|>',
+    'associates': '-->',
+    'uses': '..>',
+}
+
+
+class RelationshipStore:
+    """去重的关系边集合，键为 (source, target, kind)，并记录每条边由哪些文件贡献。
+
+    迭代时按首次加入的顺序产出 (source, target, kind)，可以直接替代原来的列表。
+    """
+
+    def __init__(self):
+        self._edges = {}
+        self._by_file = defaultdict(set)
+        self._by_source = defaultdict(set)
+        self._by_target = defaultdict(set)
+
+    def __iter__(self):
+        return iter(self._edges)
+
+    def __len__(self):
+        return len(self._edges)
+
+    def __contains__(self, edge):
+        return edge in self._edges
+
+    def add(self, source, target, kind, file_path=None):
+        edge = (source, target, kind)
+        files = self._edges.get(edge)
+        if files is None:
+            files = self._edges[edge] = set()
+            self._by_source[source].add(edge)
+            self._by_target[target].add(edge)
+        files.add(file_path)
+        self._by_file[file_path].add(edge)
+
+    def files(self, edge):
+        return self._edges.get(edge, set())
+
+    def outgoing(self, name):
+        return self._by_source.get(name, set())
+
+    def incoming(self, name):
+        return self._by_target.get(name, set())
+
+    def remove_file(self, file_path, kinds=None):
+        """撤销某个文件贡献的边（可限定关系类型），没有其他文件贡献的边会被删除。"""
+        edges = self._by_file.get(file_path)
+        if not edges:
+            return
+        for edge in [edge for edge in edges if kinds is None or edge[2] in kinds]:
+            edges.discard(edge)
+            files = self._edges[edge]
+            files.discard(file_path)
+            if not files:
+                del self._edges[edge]
+                self._discard_index(self._by_source, edge[0], edge)
+                self._discard_index(self._by_target, edge[1], edge)
+        if not edges:
+            del self._by_file[file_path]
+
+    @staticmethod
+    def _discard_index(index, key, edge):
+        edges = index[key]
+        edges.discard(edge)
+        if not edges:
+            del index[key]
+
 
 # generate class diagram from Java code
 class ProjectJavaAnalyzer:
     def __init__(self):
         self.classes = {}
         self.interfaces = {}
-        self.relationships = []
+        self.relationships = RelationshipStore()
         self.imports = {}
         self.method_calls = defaultdict(list)
+        # 当前文件中记录的调用，按文件解析一次即可
+        self.current_method_calls = []
         self.package_structure = defaultdict(list)
-        self.common_classes = {'String', 'Integer', 'Long', 'Double', 'Float', 'Boolean',
-                               'BigDecimal', 'BigInteger', 'List', 'ArrayList', 'LinkedList',
-                               'Set', 'HashSet', 'TreeSet', 'Map', 'HashMap', 'TreeMap',
-                               'Queue', 'Deque', 'Stack', 'Vector'}
+        self.common_classes = COMMON_CLASSES
+        # 类型名 -> 包名，包名 -> 类型名，以及有序的包名列表，用于按包前缀快速选出子图
+        self.type_packages = {}
+        self.package_types = defaultdict(set)
+        self._packages = []
+        self.current_package = None
 
     def analyze_project(self, directory):
         for root, _, files in os.walk(directory):
@@ -27,9 +126,10 @@ class ProjectJavaAnalyzer:
 
     def analyze_file(self, code, file_path):
         self.current_file = file_path
+        self.current_method_calls = []
+        self.current_package = None
         self.parse_package(code)
         self.parse_imports(code)
-        self.remove_comments(code)
         self.parse_classes_and_interfaces(code)
         self.analyze_method_calls(code)
 
@@ -37,6 +137,7 @@ class ProjectJavaAnalyzer:
         package_match = re.search(r'package\s+([\w.]+);', code)
         if package_match:
             package = package_match.group(1)
+            self.current_package = package
             class_name = os.path.basename(self.current_file)[:-5]  # Remove .java
             self.package_structure[package].append(class_name)
 
@@ -48,9 +149,6 @@ class ProjectJavaAnalyzer:
             if class_name not in self.common_classes:
                 self.imports[class_name] = full_path
 
-    def remove_comments(self, code):
-        return re.sub(r'(/\*([^*]|[\r\n]|(\*+([^*/]|[\r\n])))*\*+/)|(//.*)', '', code)
-
     def parse_classes_and_interfaces(self, code):
         class_pattern = r'(public\s+)?(abstract\s+)?(class|interface)\s+(\w+)(\s+extends\s+(\w+))?(\s+implements\s+([\w,\s]+))?'
         for match in re.finditer(class_pattern, code):
@@ -63,14 +161,16 @@ class ProjectJavaAnalyzer:
                 if name not in self.common_classes:
                     self.classes[name] = {'methods': [], 'fields': []}
                     if parent and parent not in self.common_classes:
-                        self.relationships.append((name, parent, 'extends'))
+                        self.relationships.add(name, parent, 'extends', self.current_file)
                     if implements:
                         for interface in implements.split(','):
                             interface = interface.strip()
                             if interface not in self.common_classes:
-                                self.relationships.append((name, interface, 'implements'))
+                                self.relationships.add(name, interface, 'implements', self.current_file)
             else:
                 self.interfaces[name] = {'methods': []}
+            if name in self.classes or name in self.interfaces:
+                self.index_type(name, self.current_package)
 
             class_code = self.extract_class_code(name, code)
             self.analyze_members(name, class_code)
@@ -93,58 +193,445 @@ class ProjectJavaAnalyzer:
             field_name = match.group(3)
             self.classes[class_name]['fields'].append((field_type, field_name))
             if field_type in self.classes or field_type in self.imports:
-                self.relationships.append((class_name, field_type, 'associates'))
+                self.relationships.add(class_name, field_type, 'associates', self.current_file)
 
     def analyze_method_body(self, class_name, method_name, method_body):
         method_call_pattern = r'(\w+)\.(\w+)\('
         for match in re.finditer(method_call_pattern, method_body):
             object_name = match.group(1)
             called_method = match.group(2)
-            self.method_calls[f"{class_name}.{method_name}"].append(f"{object_name}.{called_method}")
+            caller = f"{class_name}.{method_name}"
+            callee = f"{object_name}.{called_method}"
+            self.method_calls[caller].append(callee)
+            self.current_method_calls.append((caller, callee))
 
     def analyze_method_calls(self, code):
-        for caller, callees in self.method_calls.items():
+        self.resolve_method_calls(self.current_method_calls, self.current_file)
+
+    def resolve_method_calls(self, calls, file_path):
+        """把 (调用方, 被调用方) 解析为 uses 关系，只处理传入的这一批调用。"""
+        for caller, callee in calls:
             caller_class = caller.split('.')[0]
-            for callee in callees:
-                callee_parts = callee.split('.')
-                if len(callee_parts) == 2:
-                    object_name, method_name = callee_parts
-                    if object_name in self.classes or object_name in self.imports:
-                        self.relationships.append((caller_class, object_name, 'uses'))
+            callee_parts = callee.split('.')
+            if len(callee_parts) == 2:
+                object_name, method_name = callee_parts
+                if object_name in self.classes or object_name in self.imports:
+                    self.relationships.add(caller_class, object_name, 'uses', file_path)
+
+    def index_type(self, name, package):
+        package = package or ''
+        self.type_packages[name] = package
+        if package not in self.package_types:
+            bisect.insort(self._packages, package)
+        self.package_types[package].add(name)
+
+    def unindex_type(self, name, package):
+        package = package or ''
+        if self.type_packages.get(name) == package:
+            del self.type_packages[name]
+        names = self.package_types.get(package)
+        if names is None:
+            return
+        names.discard(name)
+        if not names:
+            del self.package_types[package]
+            del self._packages[bisect.bisect_left(self._packages, package)]
+
+    def types_in_package(self, prefix):
+        """包名等于 prefix 或以 prefix. 开头的包中的类型，按包名和类型名排序。"""
+        names = []
+        for i in range(bisect.bisect_left(self._packages, prefix), len(self._packages)):
+            package = self._packages[i]
+            if not package.startswith(prefix):
+                break
+            if package == prefix or package[len(prefix)] == '.':
+                names.extend(sorted(self.package_types[package]))
+        return names
+
+    def neighbourhood(self, seeds, hops):
+        """从 seeds 出发沿关系边（不分方向）广度优先扩展 hops 步，按发现顺序返回。"""
+        seen = dict.fromkeys(seeds)
+        frontier = list(seen)
+        for _ in range(hops):
+            next_frontier = []
+            for name in frontier:
+                edges = sorted(self.relationships.outgoing(name)) + sorted(self.relationships.incoming(name))
+                for source, target, _ in edges:
+                    other = target if source == name else source
+                    if other not in seen:
+                        seen[other] = None
+                        next_frontier.append(other)
+            if not next_frontier:
+                break
+            frontier = next_frontier
+        return list(seen)
+
+    def select_types(self, package=None, focus=None, hops=1, max_nodes=None):
+        """选出要绘制的类型。focus 给定时取其 hops 步邻域，否则取 package 前缀下的类型。
+
+        返回 (类型列表, 被 max_nodes 截掉的数量)。两者都没给时返回 None，表示绘制整个项目。
+        """
+        if focus is not None:
+            names = self.neighbourhood([focus], hops)
+        elif package is not None:
+            names = self.types_in_package(package)
+        else:
+            return None, 0
+        if max_nodes is not None and len(names) > max_nodes:
+            return names[:max_nodes], len(names) - max_nodes
+        return names, 0
 
-    def generate_mermaid(self):
-        mermaid_code = ["```mermaid", "classDiagram"]
+    def write_mermaid(self, out, package=None, focus=None, hops=1, max_nodes=None, members=None):
+        """把类图逐行写入文件对象 out。
+
+        package 按包名前缀筛选，focus 取某个类型 hops 步以内的邻域，max_nodes 限制类型数量；
+        members 为 False 时只画类型名；为 None 时，整个项目的类图总是展开成员（与不限定范围时的输出一致），
+        限定了范围的子图在类型数量超过 MAX_NODES_WITH_MEMBERS 时只画类型名。
+        子图的开销只与选出的类型及其关系数量有关。
+        """
+        names, omitted = self.select_types(package, focus, hops, max_nodes)
+        if names is None and max_nodes is not None:
+            names = list(self.classes) + [name for name in self.interfaces if name not in self.classes]
+            names, omitted = names[:max_nodes], max(len(names) - max_nodes, 0)
+
+        out.write("```mermaid\nclassDiagram\n")
+        if omitted:
+            out.write(f"    %% {omitted} more types omitted\n")
+
+        if names is None:
+            types = {**self.classes, **self.interfaces}.items()
+            relationships = iter(self.relationships)
+        else:
+            selected = set(names)
+            types = [(name, self.classes.get(name) or self.interfaces.get(name)) for name in names]
+            relationships = (edge for name in names for edge in sorted(self.relationships.outgoing(name))
+                             if edge[1] in selected)
+        if members is None:
+            members = names is None or len(names) <= MAX_NODES_WITH_MEMBERS
 
         # Add classes and interfaces
-        for name, info in {**self.classes, **self.interfaces}.items():
-            mermaid_code.append(f"    class {name} {{")
+        for name, info in types:
+            if info is None:
+                # 只出现在关系中的外部类型，由关系边隐式创建节点
+                continue
+            if not members:
+                out.write(f"    class {name}\n")
+                continue
+            out.write(f"    class {name} {{\n")
             for field_type, field_name in info.get('fields', []):
-                mermaid_code.append(f"        {field_type} {field_name}")
+                out.write(f"        {field_type} {field_name}\n")
             for method in info.get('methods', []):
-                mermaid_code.append(f"        {method}()")
-            mermaid_code.append("    }")
+                out.write(f"        {method}()\n")
+            out.write("    }\n")
 
         # Add relationships
-        for source, target, relation in self.relationships:
-            if relation == 'extends':
-                mermaid_code.append(f"    {source} --|> {target}")
-            elif relation == 'implements':
-                mermaid_code.append(f"    {source} ..|> {target}")
-            elif relation == 'associates':
-                mermaid_code.append(f"    {source} --> {target}")
-            elif relation == 'uses':
-                mermaid_code.append(f"    {source} ..> {target} : uses")
-
-        mermaid_code.append("```")
-        return "\n".join(mermaid_code)
-
-def analyze_java_project(directory):
-    analyzer = ProjectJavaAnalyzer()
+        for source, target, relation in relationships:
+            arrow = RELATION_ARROWS.get(relation)
+            if arrow is None:
+                continue
+            label = " : uses" if relation == 'uses' else ""
+            out.write(f"    {source} {arrow} {target}{label}\n")
+
+        out.write("```\n")
+
+    def generate_mermaid(self, **scope):
+        output = io.StringIO()
+        self.write_mermaid(output, **scope)
+        return output.getvalue().rstrip('\n')
+
+
+class _FileAnalysis:
+    """单个 Java 文件的分析结果，由工作进程生成后交给主进程合并。"""
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.package = None
+        self.imports = {}
+        self.classes = {}
+        self.interfaces = {}
+        # 继承和实现关系在单个文件内就能确定；关联和调用关系要等所有文件合并后再解析
+        self.relationships = []
+        self.field_types = []
+        self.method_calls = defaultdict(list)
+
+    def method_call_pairs(self):
+        return [(caller, callee) for caller, callees in self.method_calls.items() for callee in callees]
+
+    def referenced_names(self):
+        """关联和调用关系的解析结果依赖于这些名字是否为已知类型。"""
+        names = {name for _, referenced in self.field_types for name in referenced}
+        names.update(callee.split('.')[0] for _, callee in self.method_call_pairs())
+        return names
+
+    def visit_root(self, root):
+        for node in root.children:
+            if node.type == 'package_declaration':
+                self.package = next(node_text(child) for child in node.named_children
+                                    if child.type in ('scoped_identifier', 'identifier'))
+            elif node.type == 'import_declaration':
+                path_node = next((child for child in node.named_children
+                                  if child.type in ('scoped_identifier', 'identifier')), None)
+                # 跳过通配符导入
+                if path_node is not None and not any(child.type == 'asterisk' for child in node.children):
+                    full_path = node_text(path_node)
+                    class_name = full_path.split('.')[-1]
+                    if class_name not in COMMON_CLASSES:
+                        self.imports[class_name] = full_path
+            elif node.type in TYPE_DECLARATIONS:
+                self.visit_type(node)
+
+    def visit_type(self, node):
+        name = node_text(node.child_by_field_name('name'))
+        body = node.child_by_field_name('body')
+
+        if node.type == 'interface_declaration':
+            info = self.interfaces[name] = {'methods': []}
+            extends = next((child for child in node.children if child.type == 'extends_interfaces'), None)
+            for parent in type_list(extends):
+                if parent not in COMMON_CLASSES:
+                    self.relationships.append((name, parent, 'extends'))
+        else:
+            if name in COMMON_CLASSES:
+                return
+            info = self.classes[name] = {'methods': [], 'fields': []}
+            superclass = node.child_by_field_name('superclass')
+            if superclass is not None:
+                parent = type_name(superclass.named_children[0])
+                if parent and parent not in COMMON_CLASSES:
+                    self.relationships.append((name, parent, 'extends'))
+            for interface in type_list(node.child_by_field_name('interfaces')):
+                if interface not in COMMON_CLASSES:
+                    self.relationships.append((name, interface, 'implements'))
+
+        if body is None:
+            return
+
+        field_types = {}
+        methods = []
+        for member in body_members(body):
+            if member.type in TYPE_DECLARATIONS:
+                self.visit_type(member)
+            elif member.type == 'method_declaration':
+                info['methods'].append(node_text(member.child_by_field_name('name')))
+                methods.append(member)
+            elif member.type == 'field_declaration' and 'fields' in info:
+                type_node = member.child_by_field_name('type')
+                # Mermaid 用 ~ 表示泛型
+                field_type = ' '.join(node_text(type_node).split()).replace('<', '~').replace('>', '~')
+                referenced = referenced_types(type_node)
+                for field_name in declared_names(member):
+                    info['fields'].append((field_type, field_name))
+                    field_types[field_name] = type_name(type_node)
+                self.field_types.append((name, referenced))
+
+        for method in methods:
+            self.visit_method_calls(name, method, field_types)
+
+    def visit_method_calls(self, class_name, method, field_types):
+        """记录方法体内 obj.method() 形式的调用，obj 能解析为已声明变量时记为其类型名。"""
+        body = method.child_by_field_name('body')
+        if body is None:
+            return
+        variable_types = dict(field_types)
+        parameters = method.child_by_field_name('parameters')
+        for parameter in parameters.named_children:
+            name_node = parameter.child_by_field_name('name')
+            type_node = parameter.child_by_field_name('type')
+            if name_node is not None and type_node is not None:
+                variable_types[node_text(name_node)] = type_name(type_node)
+
+        caller = f"{class_name}.{node_text(method.child_by_field_name('name'))}"
+        stack = [body]
+        while stack:
+            node = stack.pop()
+            if node.type == 'local_variable_declaration':
+                local_type = type_name(node.child_by_field_name('type'))
+                for variable in declared_names(node):
+                    variable_types[variable] = local_type
+            elif node.type == 'method_invocation':
+                target = node.child_by_field_name('object')
+                if target is not None and target.type == 'identifier':
+                    object_name = node_text(target)
+                    target_type = variable_types.get(object_name) or object_name
+                    self.method_calls[caller].append(f"{target_type}.{node_text(node.child_by_field_name('name'))}")
+            stack.extend(reversed(node.children))
+
+
+def analyze_file_tree_sitter(file_path):
+    with open(file_path, 'rb') as f:
+        source = f.read()
+    analysis = _FileAnalysis(file_path)
+    analysis.visit_root(parser.parse(source).root_node)
+    return analysis
+
+
+class TreeSitterProjectJavaAnalyzer(ProjectJavaAnalyzer):
+    """用 tree-sitter 生成与 ProjectJavaAnalyzer 相同结构的数据。
+
+    每个文件只解析一次，文件之间在多个进程中并行分析，结果按文件路径顺序合并；依赖全局信息的
+    关联和调用关系在合并完成后逐个文件解析一次。保留每个文件的分析结果，修改过的文件可以通过
+    update_files() 单独替换，只有引用了新增或消失的类型名的文件需要重新解析关系。
+    """
+
+    # 依赖已知类型集合的关系，已知类型变化时需要重新解析
+    RESOLVED_KINDS = ('associates', 'uses')
+
+    def __init__(self):
+        super().__init__()
+        self.file_analyses = {}
+        # 类型名 / 导入名 -> 定义它的文件，同名时以最后合并的为准，与 dict.update 的行为一致
+        self._type_files = defaultdict(list)
+        self._import_files = defaultdict(list)
+        # 类型名 -> 关联或调用中引用了它的文件
+        self._references = defaultdict(set)
+
+    def analyze_project(self, directory, max_workers=None):
+        java_files = sorted(os.path.join(root, file)
+                            for root, _, files in os.walk(directory)
+                            for file in files if file.endswith('.java'))
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for analysis in executor.map(analyze_file_tree_sitter, java_files, chunksize=FILES_PER_TASK):
+                self.merge(analysis)
+        self.resolve_relationships()
+        logging.info(f"Analyzed {len(java_files)} files: {len(self.classes)} classes, "
+                     f"{len(self.interfaces)} interfaces, {len(self.relationships)} relationships")
+
+    def known_names(self):
+        return self.classes.keys() | self.imports.keys()
+
+    def merge(self, analysis):
+        path = analysis.file_path
+        self.file_analyses[path] = analysis
+        if analysis.package:
+            class_name = os.path.basename(path)[:-5]  # Remove .java
+            self.package_structure[analysis.package].append(class_name)
+        for name, full_path in analysis.imports.items():
+            self._import_files[name].append(path)
+            self.imports[name] = full_path
+        for name, info in analysis.classes.items():
+            self._type_files[name].append(path)
+            self.classes[name] = info
+            self.index_type(name, analysis.package)
+        for name, info in analysis.interfaces.items():
+            self._type_files[name].append(path)
+            self.interfaces[name] = info
+            self.index_type(name, analysis.package)
+        for source, target, kind in analysis.relationships:
+            self.relationships.add(source, target, kind, path)
+        for caller, callees in analysis.method_calls.items():
+            self.method_calls[caller].extend(callees)
+        for name in analysis.referenced_names():
+            self._references[name].add(path)
+
+    def unmerge(self, path):
+        """撤销一个文件的全部贡献，同名定义回退到仍然存在的其他文件。"""
+        analysis = self.file_analyses.pop(path, None)
+        if analysis is None:
+            return
+        if analysis.package:
+            classes = self.package_structure[analysis.package]
+            classes.remove(os.path.basename(path)[:-5])
+            if not classes:
+                del self.package_structure[analysis.package]
+        for name in analysis.imports:
+            self._unregister(self._import_files, self.imports, name, path,
+                             lambda other: self.file_analyses[other].imports[name])
+        for name in analysis.classes.keys() | analysis.interfaces.keys():
+            self.classes.pop(name, None)
+            self.interfaces.pop(name, None)
+            self.unindex_type(name, analysis.package)
+            files = self._type_files[name]
+            files.remove(path)
+            if not files:
+                del self._type_files[name]
+                continue
+            other = self.file_analyses[files[-1]]
+            self.index_type(name, other.package)
+            if name in other.classes:
+                self.classes[name] = other.classes[name]
+            else:
+                self.interfaces[name] = other.interfaces[name]
+        for caller, callees in analysis.method_calls.items():
+            remaining = self.method_calls[caller]
+            for callee in callees:
+                remaining.remove(callee)
+            if not remaining:
+                del self.method_calls[caller]
+        for name in analysis.referenced_names():
+            self._references[name].discard(path)
+            if not self._references[name]:
+                del self._references[name]
+        self.relationships.remove_file(path)
+
+    @staticmethod
+    def _unregister(owners, values, name, path, value_of):
+        files = owners[name]
+        files.remove(path)
+        if files:
+            values[name] = value_of(files[-1])
+        else:
+            del owners[name]
+            del values[name]
+
+    def resolve_file(self, analysis, known=None):
+        """解析单个文件的关联和调用关系，只处理该文件自己的字段和调用。"""
+        known = self.known_names() if known is None else known
+        for class_name, referenced in analysis.field_types:
+            for field_type in referenced:
+                if field_type in known and field_type not in self.common_classes:
+                    self.relationships.add(class_name, field_type, 'associates', analysis.file_path)
+        self.resolve_method_calls(analysis.method_call_pairs(), analysis.file_path)
+
+    def resolve_relationships(self):
+        known = self.known_names()
+        for analysis in self.file_analyses.values():
+            self.resolve_file(analysis, known)
+
+    def update_files(self, paths):
+        """用新的分析结果替换修改过的文件，已删除的文件只撤销其贡献。
+
+        已知类型集合发生变化时，只重新解析引用了这些类型名的文件。
+        """
+        known_before = self.known_names()
+        paths = sorted(set(paths))
+        for path in paths:
+            self.unmerge(path)
+        for path in paths:
+            if os.path.exists(path):
+                self.merge(analyze_file_tree_sitter(path))
+
+        affected = {path for path in paths if path in self.file_analyses}
+        for name in known_before ^ self.known_names():
+            affected.update(self._references.get(name, ()))
+
+        known = self.known_names()
+        for path in sorted(affected):
+            self.relationships.remove_file(path, kinds=self.RESOLVED_KINDS)
+            self.resolve_file(self.file_analyses[path], known)
+        logging.info(f"Updated {len(paths)} files, re-resolved relationships of {len(affected)} files")
+
+
+def analyze_java_project(directory, backend='tree_sitter', output=None, **scope):
+    """分析项目并生成类图。给定 output 时直接写入该文件对象，否则返回字符串。
+
+    scope 参数见 ProjectJavaAnalyzer.write_mermaid。
+    """
+    if backend == 'tree_sitter':
+        analyzer = TreeSitterProjectJavaAnalyzer()
+    else:
+        analyzer = ProjectJavaAnalyzer()
     analyzer.analyze_project(directory)
-    return analyzer.generate_mermaid()
+    if output is not None:
+        analyzer.write_mermaid(output, **scope)
+        return None
+    return analyzer.generate_mermaid(**scope)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
 
-# 示例使用
-project_directory = ''
-print(project_directory)
-mermaid_diagram = analyze_java_project(project_directory)
-print(mermaid_diagram)
\ No newline at end of file
+    # 示例使用
+    project_directory = ''
+    print(project_directory)
+    mermaid_diagram = analyze_java_project(project_directory)
+    print(mermaid_diagram)
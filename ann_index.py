@@ -0,0 +1,341 @@
+import argparse
+import logging
+import time
+import numpy as np
+import faiss
+
+logging.basicConfig(level=logging.INFO)
+
+INDEX_TYPES = ('flat', 'hnsw', 'ivf_flat', 'ivf_pq', 'sq_fp16', 'sq8', 'pq')
+
+# 有损压缩向量的索引类型：float16、int8 标量量化、乘积量化（带 IVF 或不带）。
+# 它们返回的距离是近似值，检索时可以用磁盘上的原始向量对候选重新排序（见 RerankingIndex）
+QUANTIZED_TYPES = ('sq_fp16', 'sq8', 'pq', 'ivf_pq')
+
+# FAISS 建议每个聚类中心 39~256 个训练样本
+MIN_POINTS_PER_CENTROID = 39
+MAX_POINTS_PER_CENTROID = 256
+
+HNSW_M = 32
+PQ_NBITS = 8
+
+# 往索引里添加向量时每批的行数，避免把 mmap 的向量一次性读入内存
+ADD_BATCH_ROWS = 65536
+
+# int8 标量量化只需要统计每一维的取值范围，训练样本上限
+SQ_TRAINING_ROWS = 65536
+
+# 重排序时候选数是 k 的倍数
+RERANK_CANDIDATES = 4
+
+
+def default_nlist(num_vectors):
+    """经验值 4*sqrt(N)，同时保证每个聚类中心有足够的训练样本。"""
+    return max(1, min(int(4 * np.sqrt(num_vectors)), num_vectors // MIN_POINTS_PER_CENTROID))
+
+
+def default_pq_m(dimension):
+    """选择能整除维度、且每个子空间至少 4 维的最大子量化器个数。"""
+    for m in (64, 48, 32, 24, 16, 12, 8, 4, 2, 1):
+        if dimension % m == 0 and dimension // m >= 4:
+            return m
+    return 1
+
+
+def factory_string(index_type, dimension, nlist=None, hnsw_m=HNSW_M, pq_m=None, pq_nbits=PQ_NBITS):
+    if index_type == 'flat':
+        return "IDMap,Flat"
+    if index_type == 'hnsw':
+        return f"IDMap,HNSW{hnsw_m}"
+    if index_type == 'ivf_flat':
+        return f"IVF{nlist},Flat"
+    if index_type == 'ivf_pq':
+        return f"IVF{nlist},PQ{pq_m or default_pq_m(dimension)}x{pq_nbits}"
+    if index_type == 'sq_fp16':
+        return "IDMap,SQfp16"
+    if index_type == 'sq8':
+        return "IDMap,SQ8"
+    if index_type == 'pq':
+        return f"IDMap,PQ{pq_m or default_pq_m(dimension)}x{pq_nbits}"
+    raise ValueError(f"Unknown index type: {index_type}, expected one of {INDEX_TYPES}")
+
+
+def training_size(index_type, nlist, pq_nbits=PQ_NBITS):
+    """返回 (最少训练样本数, 最多训练样本数)。"""
+    if index_type in ('sq_fp16', 'sq8'):
+        return 1, SQ_TRAINING_ROWS
+    minimum = (nlist or 0) * MIN_POINTS_PER_CENTROID
+    maximum = (nlist or 0) * MAX_POINTS_PER_CENTROID
+    if index_type in ('ivf_pq', 'pq'):
+        # PQ 的每个子量化器有 2^nbits 个中心
+        minimum = max(minimum, (1 << pq_nbits) * MIN_POINTS_PER_CENTROID)
+        maximum = max(maximum, (1 << pq_nbits) * MAX_POINTS_PER_CENTROID)
+    return minimum, maximum
+
+
+def select_training_sample(vectors, size, seed=0, rows=None):
+    """无放回地均匀抽取训练样本，下标排序后读取，对 mmap 的向量更友好。rows 不为空时只从这些行中抽取。"""
+    num_vectors = len(vectors) if rows is None else len(rows)
+    if num_vectors <= size:
+        return np.ascontiguousarray(vectors if rows is None else vectors[rows], dtype='float32')
+    rng = np.random.default_rng(seed)
+    sample = np.sort(rng.choice(num_vectors, size, replace=False))
+    return np.ascontiguousarray(vectors[sample if rows is None else rows[sample]], dtype='float32')
+
+
+def build_index(vectors, ids=None, index_type='flat', nlist=None, hnsw_m=HNSW_M, pq_m=None,
+                pq_nbits=PQ_NBITS, seed=0, rows=None):
+    """按 index_type 构建带 ID 的 FAISS 索引并加入全部向量。
+
+    rows 不为空时只使用 vectors 中的这些行（如 mmap 的 embeddings.npy 中仍然有效的行），训练样本和
+    每批加入的向量按行读取，不会把整个矩阵读入内存。ids 为空时 ID 为行号。
+
+    IVF 类索引会自动选择聚类中心数和训练样本；向量太少不足以训练时 ivf_flat 退回 flat 索引，
+    ivf_pq 和 pq 退回 int8 标量量化，仍然保持压缩存储。实际构建的类型可以用 index_type_of 查询。
+    """
+    dimension = vectors.shape[1]
+    if rows is not None:
+        rows = np.asarray(rows, dtype='int64')
+    num_vectors = len(vectors) if rows is None else len(rows)
+    if ids is None:
+        ids = np.arange(num_vectors, dtype='int64') if rows is None else rows
+
+    maximum = num_vectors
+    if index_type in ('ivf_flat', 'ivf_pq', 'pq'):
+        if index_type != 'pq':
+            nlist = nlist or default_nlist(num_vectors)
+        minimum, maximum = training_size(index_type, nlist, pq_nbits)
+        if num_vectors < minimum:
+            fallback = 'flat' if index_type == 'ivf_flat' else 'sq8'
+            logging.warning(f"{num_vectors} vectors are not enough to train {index_type} "
+                            f"(need {minimum}), falling back to {fallback} index")
+            index_type = fallback
+    if index_type in ('sq_fp16', 'sq8'):
+        maximum = training_size(index_type, nlist)[1]
+
+    description = factory_string(index_type, dimension, nlist, hnsw_m, pq_m, pq_nbits)
+    index = faiss.index_factory(dimension, description)
+    if not index.is_trained:
+        start_time = time.time()
+        index.train(select_training_sample(vectors, maximum, seed, rows))
+        logging.info(f"Training {description} took {time.time() - start_time:.2f} seconds")
+
+    for start in range(0, num_vectors, ADD_BATCH_ROWS):
+        stop = min(start + ADD_BATCH_ROWS, num_vectors)
+        batch = vectors[start:stop] if rows is None else vectors[rows[start:stop]]
+        index.add_with_ids(np.ascontiguousarray(batch, dtype='float32'),
+                           np.asarray(ids[start:stop], dtype='int64'))
+    return index
+
+
+def set_search_params(index, nprobe=None, ef_search=None):
+    """设置 IVF 的 nprobe 或 HNSW 的 efSearch，对不适用的索引类型忽略并给出警告。"""
+    parameter_space = faiss.ParameterSpace()
+    for name, value in (('nprobe', nprobe), ('efSearch', ef_search)):
+        if value is None:
+            continue
+        try:
+            parameter_space.set_index_parameter(index, name, value)
+        except RuntimeError:
+            logging.warning(f"Search parameter {name} does not apply to this index, ignored")
+
+
+def memory_bytes(index):
+    """索引中向量编码、ID 和 HNSW 邻接表占用的内存（不含 IVF 聚类中心等与向量数无关的结构）。"""
+    if isinstance(index, RerankingIndex):
+        index = index.index
+    if isinstance(index, faiss.IndexIDMap):
+        index = faiss.downcast_index(index.index)
+    if isinstance(index, faiss.IndexHNSW):
+        # HNSW 没有实现 sa_code_size：向量在 storage 中，每条邻接边是一个 int32
+        storage = faiss.downcast_index(index.storage)
+        return index.ntotal * (storage.sa_code_size() + 8) + index.hnsw.neighbors.size() * 4
+    try:
+        return index.ntotal * (index.sa_code_size() + 8)
+    except RuntimeError:
+        # 其他没有实现独立编码的索引类型，按序列化后的大小估计
+        return int(faiss.serialize_index(index).nbytes) + index.ntotal * 8
+
+
+def float32_bytes(num_vectors, dimension):
+    return num_vectors * (dimension * 4 + 8)
+
+
+def rerank(query, candidate_ids, vectors, k):
+    """用原始向量计算候选的精确 L2 距离，返回前 k 个 (距离, ID)。
+
+    vectors 通常是 mmap 的 embeddings.npy，只读取候选所在的行；按 ID 排序后读取，减少随机访问。
+    """
+    candidate_ids = np.unique(candidate_ids[candidate_ids >= 0])
+    if not len(candidate_ids):
+        return np.empty(0, dtype='float32'), candidate_ids
+    rows = np.asarray(vectors[candidate_ids], dtype='float32')
+    distances = ((rows - query.reshape(1, -1)) ** 2).sum(axis=1)
+    order = np.argsort(distances, kind='stable')[:k]
+    return distances[order], candidate_ids[order]
+
+
+class RerankingIndex:
+    """两阶段检索：量化索引取回 k * candidates 个候选，再用磁盘上的原始向量按精确距离重排。
+
+    只实现检索用到的接口（search、ntotal）；增删向量和写盘使用 .index。
+    """
+
+    def __init__(self, index, vectors, candidates=RERANK_CANDIDATES):
+        self.index = index
+        self.vectors = vectors
+        self.candidates = candidates
+
+    @property
+    def ntotal(self):
+        return self.index.ntotal
+
+    def search(self, queries, k):
+        queries = np.ascontiguousarray(queries, dtype='float32').reshape(-1, self.vectors.shape[1])
+        _, candidate_ids = self.index.search(queries, k * self.candidates)
+        distances = np.full((len(queries), k), np.inf, dtype='float32')
+        ids = np.full((len(queries), k), -1, dtype='int64')
+        for i, query in enumerate(queries):
+            row_distances, row_ids = rerank(query, candidate_ids[i], self.vectors, k)
+            distances[i, :len(row_ids)] = row_distances
+            ids[i, :len(row_ids)] = row_ids
+        return distances, ids
+
+
+def with_reranking(index, vectors, candidates=RERANK_CANDIDATES):
+    """索引是量化类型且 candidates > 0 时包装成 RerankingIndex，否则原样返回。"""
+    if not candidates or vectors is None or not is_quantized(index):
+        return index
+    return RerankingIndex(index, vectors, candidates)
+
+
+def index_type_of(index):
+    """根据 FAISS 索引的实际结构返回对应的 INDEX_TYPES 名称（build_index 可能退回了别的类型）。"""
+    if isinstance(index, RerankingIndex):
+        index = index.index
+    if isinstance(index, faiss.IndexIDMap):
+        index = faiss.downcast_index(index.index)
+    if isinstance(index, faiss.IndexHNSW):
+        return 'hnsw'
+    if isinstance(index, faiss.IndexIVFPQ):
+        return 'ivf_pq'
+    if isinstance(index, faiss.IndexIVFFlat):
+        return 'ivf_flat'
+    if isinstance(index, faiss.IndexPQ):
+        return 'pq'
+    if isinstance(index, faiss.IndexScalarQuantizer):
+        return 'sq_fp16' if index.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else 'sq8'
+    return 'flat'
+
+
+def is_quantized(index):
+    if isinstance(index, faiss.IndexIDMap):
+        index = faiss.downcast_index(index.index)
+    return isinstance(index, (faiss.IndexScalarQuantizer, faiss.IndexPQ, faiss.IndexIVFPQ))
+
+
+def supports_remove(index):
+    """HNSW 不支持按 ID 删除向量，只能重建。"""
+    if isinstance(index, faiss.IndexIDMap):
+        index = faiss.downcast_index(index.index)
+    return not isinstance(index, faiss.IndexHNSW)
+
+
+def percentile_ms(latencies, q):
+    return float(np.percentile(latencies, q) * 1000)
+
+
+def benchmark(vectors, k=10, num_queries=200, index_types=INDEX_TYPES, nprobes=(1, 8, 32),
+              ef_searches=(16, 64, 256), rerank_candidates=(0, RERANK_CANDIDATES), seed=0):
+    """以 flat 索引的精确结果为基准，测量各索引类型和搜索参数下的 recall@k、单条查询延迟和内存占用。
+
+    查询向量从语料中抽取并加上少量噪声，模拟与已有代码相近但不完全相同的查询。量化索引还会分别测量
+    不重排和按 rerank_candidates 倍候选重排的结果。memory_saved 是相对 float32 向量节省的比例。
+    index_type 是实际构建的类型，requested_type 是请求的类型，两者不同说明向量太少而退回了别的索引。
+    """
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(vectors), min(num_queries, len(vectors)), replace=False)
+    queries = np.ascontiguousarray(vectors[np.sort(rows)], dtype='float32')
+    queries += rng.normal(scale=queries.std() * 0.1, size=queries.shape).astype('float32')
+
+    _, ground_truth = build_index(vectors).search(queries, k)
+    baseline_bytes = float32_bytes(*vectors.shape)
+
+    results = []
+    for requested_type in index_types:
+        start_time = time.time()
+        index = build_index(vectors, index_type=requested_type, seed=seed)
+        build_seconds = time.time() - start_time
+        index_type = index_type_of(index)
+        index_bytes = memory_bytes(index)
+        searchers = [(0, index)]
+        if is_quantized(index):
+            searchers = [(candidates, with_reranking(index, vectors, candidates)) for candidates in rerank_candidates]
+
+        if index_type in ('ivf_flat', 'ivf_pq'):
+            settings = [{'nprobe': nprobe} for nprobe in nprobes]
+        elif index_type == 'hnsw':
+            settings = [{'ef_search': ef_search} for ef_search in ef_searches]
+        else:
+            settings = [{}]
+
+        for params in settings:
+            set_search_params(index, **params)
+            for candidates, searcher in searchers:
+                latencies = []
+                found = np.empty((len(queries), k), dtype='int64')
+                for i, query in enumerate(queries):
+                    start_time = time.perf_counter()
+                    _, indices = searcher.search(query[None, :], k)
+                    latencies.append(time.perf_counter() - start_time)
+                    found[i] = indices[0]
+
+                recall = np.mean([len(set(found[i]) & set(ground_truth[i])) / k for i in range(len(queries))])
+                results.append({
+                    'index_type': index_type,
+                    'requested_type': requested_type,
+                    'params': dict(params, rerank=candidates) if candidates else params,
+                    'build_seconds': build_seconds,
+                    'memory_mb': index_bytes / 2 ** 20,
+                    'memory_saved': 1 - index_bytes / baseline_bytes,
+                    f'recall@{k}': float(recall),
+                    'p50_ms': percentile_ms(latencies, 50),
+                    'p99_ms': percentile_ms(latencies, 99),
+                })
+    return results
+
+
+def parse_int_list(value):
+    return tuple(int(x) for x in value.split(','))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Compare FAISS index types on stored code embeddings")
+    arg_parser.add_argument('embeddings', help="path to an embeddings .npy file, e.g. code_index_cache/embeddings.npy")
+    arg_parser.add_argument('--k', type=int, default=10)
+    arg_parser.add_argument('--queries', type=int, default=200)
+    arg_parser.add_argument('--types', default=','.join(INDEX_TYPES))
+    arg_parser.add_argument('--nprobe', type=parse_int_list, default=(1, 8, 32))
+    arg_parser.add_argument('--ef-search', type=parse_int_list, default=(16, 64, 256))
+    arg_parser.add_argument('--rerank', type=parse_int_list, default=(0, RERANK_CANDIDATES),
+                            help="candidate multiples to re-rank quantized indexes with, 0 for none")
+    args = arg_parser.parse_args()
+
+    vectors = np.load(args.embeddings, mmap_mode='r')
+    logging.info(f"Benchmarking on {vectors.shape[0]} vectors of dimension {vectors.shape[1]}")
+    results = benchmark(vectors, k=args.k, num_queries=args.queries, index_types=args.types.split(','),
+                        nprobes=args.nprobe, ef_searches=args.ef_search, rerank_candidates=args.rerank)
+
+    print(f"{'index':<10} {'params':<20} {'build s':>8} {'MB':>8} {'saved':>6} {f'recall@{args.k}':>10} "
+          f"{'p50 ms':>8} {'p99 ms':>8}")
+    for result in results:
+        if result['index_type'] != result['requested_type']:
+            result['params'] = dict(requested=result['requested_type'], **result['params'])
+        params = ','.join(f"{name}={value}" for name, value in result['params'].items()) or '-'
+        print(f"{result['index_type']:<10} {params:<20} {result['build_seconds']:>8.2f} "
+              f"{result['memory_mb']:>8.1f} {result['memory_saved']:>6.0%} "
+              f"{result[f'recall@{args.k}']:>10.3f} {result['p50_ms']:>8.3f} {result['p99_ms']:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
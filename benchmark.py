@@ -0,0 +1,494 @@
+import argparse
+import importlib.util
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import metrics
+
+logging.basicConfig(level=logging.INFO)
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+TARGETS = ('rag', 'graph', 'diagram')
+
+# 合成仓库的默认规模
+DEFAULT_FILES = 200
+DEFAULT_CLASSES_PER_FILE = 2
+DEFAULT_METHODS_PER_CLASS = 6
+DEFAULT_CALL_DENSITY = 2.0
+DEFAULT_PACKAGES = 10
+
+# 等待子进程结果时检查它是否仍在运行的间隔（秒）
+RESULT_POLL_SECONDS = 1
+
+# 编码吞吐只在最多这么多个片段上测量，避免重复整次构建的开销
+ENCODE_SAMPLE = 2000
+
+WORDS = ('order', 'event', 'payment', 'customer', 'invoice', 'retry', 'handler', 'cache', 'account', 'report',
+         'session', 'token', 'queue', 'message', 'product', 'inventory', 'price', 'shipment', 'user', 'audit')
+SUFFIXES = ('Service', 'Handler', 'Repository', 'Manager', 'Processor', 'Validator', 'Client', 'Factory')
+
+
+def _camel(words, capitalize):
+    text = ''.join(word.capitalize() for word in words)
+    return text if capitalize else text[0].lower() + text[1:]
+
+
+def generate_repo(path, files=DEFAULT_FILES, classes_per_file=DEFAULT_CLASSES_PER_FILE,
+                  methods_per_class=DEFAULT_METHODS_PER_CLASS, call_density=DEFAULT_CALL_DENSITY,
+                  packages=DEFAULT_PACKAGES, seed=0):
+    """生成可复现的合成 Java 仓库，返回 {'classes': [(包名, 类名, [方法名])]}。
+
+    call_density 是每个方法平均调用其他类方法的次数，被调用的类通过字段注入，产生关联和调用关系。
+    """
+    rng = random.Random(seed)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+
+    classes = []
+    by_file = {}
+    for file_index in range(files):
+        package = f"com.bench.p{file_index % packages}"
+        for class_index in range(classes_per_file):
+            name = _camel(rng.sample(WORDS, 2), True) + rng.choice(SUFFIXES) + str(file_index * classes_per_file
+                                                                                  + class_index)
+            methods = [_camel(rng.sample(WORDS, 2), False) + str(i) for i in range(methods_per_class)]
+            classes.append((file_index, package, name, methods))
+            by_file.setdefault(file_index, []).append(classes[-1])
+
+    counts = np.random.default_rng(seed)
+    for file_index in range(files):
+        file_classes = by_file[file_index]
+        package = file_classes[0][1]
+        # 每个类依赖的其他类，通过字段注入
+        targets = {name: [c for c in rng.sample(classes, min(4, len(classes))) if c[2] != name][:3]
+                   for _, _, name, _ in file_classes}
+        imports = sorted({f"{target_package}.{target_name}" for class_targets in targets.values()
+                          for _, target_package, target_name, _ in class_targets if target_package != package})
+        lines = [f"package {package};", ""]
+        lines.extend(f"import {full_name};" for full_name in imports)
+        lines.append("")
+
+        for position, (_, _, name, methods) in enumerate(file_classes):
+            visibility = "public " if position == 0 else ""
+            lines.append(f"/**\n * {name} handles {' and '.join(rng.sample(WORDS, 3))}.\n */")
+            lines.append(f"{visibility}class {name} {{")
+            for _, _, target_name, _ in targets[name]:
+                lines.append(f"    private {target_name} {target_name[0].lower() + target_name[1:]};")
+            lines.append("    private int counter;")
+            for method in methods:
+                lines.append("")
+                lines.append(f"    public int {method}(int value) {{")
+                lines.append("        int result = value + counter;")
+                for _ in range(counts.poisson(call_density) if targets[name] else 0):
+                    _, _, target_name, target_methods = rng.choice(targets[name])
+                    field = target_name[0].lower() + target_name[1:]
+                    lines.append(f"        result += {field}.{rng.choice(target_methods)}(result);")
+                lines.append(f"        if (result > {rng.randrange(100, 1000)}) {{")
+                lines.append("            counter++;")
+                lines.append("        }")
+                lines.append("        return result;")
+                lines.append("    }")
+            lines.append("}")
+            lines.append("")
+
+        directory = os.path.join(path, *package.split('.'))
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"{file_classes[0][2]}.java"), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines))
+
+    return {'classes': [(package, name, methods) for _, package, name, methods in classes]}
+
+
+def make_queries(classes, count, seed=0):
+    """一半是自然语言问题，一半是类名或方法名这样的符号查询。"""
+    rng = random.Random(seed)
+    queries = []
+    for i in range(count):
+        _, name, methods = rng.choice(classes)
+        if i % 2:
+            queries.append(rng.choice([name, f"{name}.{rng.choice(methods)}"]))
+        else:
+            queries.append(f"How does {name} update the counter in {rng.choice(methods)}?")
+    return queries
+
+
+class _StubOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        server = self.server
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def send(message):
+            data = (json.dumps(message) + '\n').encode('utf8')
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        # 模拟按提示词长度增长的 prefill 时间
+        time.sleep(server.first_token_delay + server.prefill_per_char * len(request.get('prompt', '')))
+        for i in range(server.tokens):
+            send({'response': f"tok{i} ", 'done': False})
+            if server.token_delay:
+                time.sleep(server.token_delay)
+        context = list(request.get('context') or []) + list(range(server.tokens))
+        send({'response': '', 'done': True, 'eval_count': server.tokens, 'context': context})
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _StubOllamaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # 客户端读到 done 后会直接关闭连接，不算错误
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+
+class StubOllama:
+    """本地替身 Ollama 服务，只实现流式的 /api/generate，用于在没有模型的环境中测量端到端延迟。"""
+
+    def __init__(self, tokens=64, token_delay=0.0, first_token_delay=0.0, prefill_per_char=0.0):
+        self.server = _StubOllamaServer(('127.0.0.1', 0), _StubOllamaHandler)
+        self.server.tokens = tokens
+        self.server.token_delay = token_delay
+        self.server.first_token_delay = first_token_delay
+        self.server.prefill_per_char = prefill_per_char
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def latency_summary(latencies):
+    latencies = np.asarray(latencies, dtype='float64') * 1000
+    if not len(latencies):
+        return {}
+    return {
+        'count': int(len(latencies)),
+        'mean_ms': float(latencies.mean()),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'max_ms': float(latencies.max()),
+    }
+
+
+def timed(function, *args, **kwargs):
+    start_time = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start_time
+
+
+def peak_rss_mb():
+    # Linux 上 ru_maxrss 的单位是 KB；子进程（如进程池）单独统计
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return {'peak_rss_mb': own, 'peak_rss_children_mb': children}
+
+
+def load_script(name, file_name):
+    """加载文件名中带连字符或多个点、不能直接 import 的脚本。"""
+    spec = importlib.util.spec_from_file_location(name, os.path.join(REPO_DIR, file_name))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def java_files_of(repo_path):
+    return sorted(os.path.join(root, file) for root, _, files in os.walk(repo_path)
+                  for file in files if file.endswith('.java'))
+
+
+def bench_rag(repo_path, workdir, queries, options):
+    import optimized_rag_java_analyzer as rag
+    from ollama_client import OllamaClient
+
+    rag.CACHE_DIR = os.path.join(workdir, 'code_index_cache')
+    java_files = java_files_of(repo_path)
+    total_bytes = sum(os.path.getsize(path) for path in java_files)
+    results = {}
+
+    trees = []
+    start_time = time.perf_counter()
+    for path in java_files:
+        trees.append(rag.parse_java_file(path))
+    parse_seconds = time.perf_counter() - start_time
+    results['parse'] = {'files': len(java_files), 'seconds': parse_seconds,
+                        'files_per_second': len(java_files) / parse_seconds,
+                        'mb_per_second': total_bytes / parse_seconds / 1e6}
+
+    snippets = []
+    start_time = time.perf_counter()
+    for tree, source_code in trees:
+        if tree and source_code:
+            snippets.extend(rag.extract_code_snippets(tree, source_code))
+    extract_seconds = time.perf_counter() - start_time
+    results['extract'] = {'snippets': len(snippets), 'seconds': extract_seconds,
+                          'snippets_per_second': len(snippets) / extract_seconds}
+    del trees
+
+    sample = snippets[:options['encode_sample']]
+    _, encode_seconds = timed(rag.get_encoder().encode, sample)
+    results['encode'] = {'snippets': len(sample), 'seconds': encode_seconds,
+                         'snippets_per_second': len(sample) / encode_seconds}
+
+    _, build_seconds = timed(rag.load_or_create_index, repo_path, True)
+    # 再次从头构建时所有片段都命中向量缓存，只剩解析、分块和建索引
+    _, cached_build_seconds = timed(rag.load_or_create_index, repo_path, True)
+    (index, all_snippets, lexical), load_seconds = timed(rag.load_or_create_index, repo_path)
+    results['index'] = {'type': rag.INDEX_TYPE, 'vectors': int(index.ntotal), 'build_seconds': build_seconds,
+                        'cached_build_seconds': cached_build_seconds, 'load_seconds': load_seconds}
+
+    latencies = []
+    for query in queries:
+        _, seconds = timed(rag.query_code, index, all_snippets, query, 5, lexical)
+        latencies.append(seconds)
+    results['query'] = latency_summary(latencies)
+
+    # 用替身 Ollama 测量提示词构建和生成的端到端延迟
+    with StubOllama(tokens=options['stub_tokens'], token_delay=options['stub_token_delay'],
+                    prefill_per_char=options['stub_prefill_per_char']) as stub:
+        rag.ollama_client = OllamaClient(base_url=stub.url)
+        end_to_end, first_token, prompt_times = [], [], []
+        for query in queries[:options['llm_queries']]:
+            start_time = time.perf_counter()
+            relevant = rag.query_code(index, all_snippets, query, 5, lexical)
+            prompt, prompt_seconds = timed(rag.build_prompt, query, relevant)
+            generation = rag.ollama_client.stream(prompt)
+            generation.text()
+            end_to_end.append(time.perf_counter() - start_time)
+            first_token.append(generation.stats.time_to_first_token)
+            prompt_times.append(prompt_seconds)
+        rag.ollama_client.close()
+    results['prompt'] = latency_summary(prompt_times)
+    results['time_to_first_token'] = latency_summary(first_token)
+    results['end_to_end'] = latency_summary(end_to_end)
+    return results
+
+
+def bench_graph(repo_path, workdir, queries, options):
+    graph_module = load_script('graphrag_v4', 'graphrag-java-repo-parser-v4.py')
+    # 节点向量缓存等使用相对路径，切到工作目录下避免写进仓库
+    os.chdir(workdir)
+    results = {}
+    G, build_seconds = timed(graph_module.create_code_graph, repo_path, force_rebuild=True)
+    results['build'] = {'nodes': G.num_nodes, 'edges': G.num_edges, 'seconds': build_seconds,
+                        'edge_kinds': G.edge_counts()}
+    _, load_seconds = timed(graph_module.create_code_graph, repo_path)
+    results['load'] = {'seconds': load_seconds}
+
+    latencies = []
+    for query in queries:
+        _, seconds = timed(graph_module.query_graph, G, query)
+        latencies.append(seconds)
+    results['query'] = latency_summary(latencies)
+
+    rng = np.random.default_rng(0)
+    seeds = rng.integers(0, G.num_nodes, size=(len(queries), 5))
+    latencies = []
+    for row in seeds:
+        _, seconds = timed(G.expand, row, graph_module.CONTEXT_HOPS, None, graph_module.MAX_CONTEXT_NODES)
+        latencies.append(seconds)
+    results['expand'] = latency_summary(latencies)
+    return results
+
+
+def bench_diagram(repo_path, workdir, queries, options):
+    analyzer_module = load_script('advanced_java_analyzer', 'advanced_java_analyzer.java.py')
+    results = {}
+    analyzers = {}
+    for backend, cls in (('tree_sitter', analyzer_module.TreeSitterProjectJavaAnalyzer),
+                         ('regex', analyzer_module.ProjectJavaAnalyzer)):
+        analyzer = analyzers[backend] = cls()
+        _, analyze_seconds = timed(analyzer.analyze_project, repo_path)
+        diagram, render_seconds = timed(analyzer.generate_mermaid)
+        results[backend] = {'seconds': analyze_seconds, 'classes': len(analyzer.classes),
+                            'relationships': len(analyzer.relationships), 'render_seconds': render_seconds,
+                            'diagram_bytes': len(diagram.encode('utf8'))}
+
+    # 按邻域绘制子图只在默认的 tree-sitter 后端上测量
+    analyzer = analyzers['tree_sitter']
+    focus = next(iter(analyzer.classes), None)
+    if focus is not None:
+        diagram, seconds = timed(analyzer.generate_mermaid, focus=focus, hops=2)
+        results['scoped_render'] = {'backend': 'tree_sitter', 'focus': focus, 'hops': 2, 'seconds': seconds,
+                                    'diagram_bytes': len(diagram.encode('utf8'))}
+    return results
+
+
+BENCHMARKS = {'rag': bench_rag, 'graph': bench_graph, 'diagram': bench_diagram}
+
+
+def _run_in_child(target, repo_path, workdir, queries, options, results_queue):
+    try:
+        start_time = time.perf_counter()
+        results = BENCHMARKS[target](repo_path, workdir, queries, options)
+        results['total_seconds'] = time.perf_counter() - start_time
+        # 各入口内部按阶段记录的耗时分布
+        results['stages'] = metrics.summary()
+        results.update(peak_rss_mb())
+        results_queue.put((target, results, None))
+    except Exception as e:
+        logging.exception(f"Benchmark {target} failed")
+        results_queue.put((target, None, f"{type(e).__name__}: {e}"))
+
+
+def run_target(target, repo_path, workdir, queries, options):
+    """每个入口在单独的进程中运行，峰值 RSS 互不影响。
+
+    使用平台默认的启动方式：Linux 上 fork 出的子进程里，用 load_script 加载的脚本对进程池仍然可见。
+    子进程被杀死（如 OOM）或崩溃时不会放入结果，此时按退出码记为失败，不会一直等待。
+    """
+    results_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_in_child,
+                                      args=(target, repo_path, workdir, queries, options, results_queue))
+    process.start()
+    # 先取结果再 join：结果较大时子进程要等队列被读取后才能退出
+    while True:
+        try:
+            _, results, error = results_queue.get(timeout=RESULT_POLL_SECONDS)
+            break
+        except queue.Empty:
+            if process.is_alive():
+                continue
+            # 子进程可能在退出前刚放入结果
+            try:
+                _, results, error = results_queue.get(timeout=RESULT_POLL_SECONDS)
+                break
+            except queue.Empty:
+                process.join()
+                logging.error(f"Benchmark {target} exited with code {process.exitcode} without a result")
+                return {'error': f"process exited with code {process.exitcode}"}
+    process.join()
+    if error is not None:
+        return {'error': error}
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _flatten(results, prefix=''):
+    for key, value in results.items():
+        name = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            yield from _flatten(value, name)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield name, value
+
+
+def compare(baseline, current):
+    """逐项打印数值指标相对基线的变化。"""
+    old = dict(_flatten(baseline['results']))
+    print(f"{'metric':<55} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name, value in _flatten(current['results']):
+        if name not in old:
+            continue
+        change = f"{(value - old[name]) / old[name] * 100:+.1f}%" if old[name] else '-'
+        print(f"{name:<55} {old[name]:>12.4g} {value:>12.4g} {change:>8}")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="End-to-end benchmarks on a synthetic Java repository")
+    arg_parser.add_argument('--targets', default=','.join(TARGETS), help=f"comma separated, from {TARGETS}")
+    arg_parser.add_argument('--files', type=int, default=DEFAULT_FILES)
+    arg_parser.add_argument('--classes-per-file', type=int, default=DEFAULT_CLASSES_PER_FILE)
+    arg_parser.add_argument('--methods-per-class', type=int, default=DEFAULT_METHODS_PER_CLASS)
+    arg_parser.add_argument('--call-density', type=float, default=DEFAULT_CALL_DENSITY)
+    arg_parser.add_argument('--packages', type=int, default=DEFAULT_PACKAGES)
+    arg_parser.add_argument('--queries', type=int, default=100)
+    arg_parser.add_argument('--llm-queries', type=int, default=10)
+    arg_parser.add_argument('--encode-sample', type=int, default=ENCODE_SAMPLE)
+    arg_parser.add_argument('--stub-tokens', type=int, default=64)
+    arg_parser.add_argument('--stub-token-delay', type=float, default=0.0)
+    arg_parser.add_argument('--stub-prefill-per-char', type=float, default=0.0)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--workdir', help="keep the generated repository and caches here")
+    arg_parser.add_argument('--output', help="write the JSON results to this file instead of stdout")
+    arg_parser.add_argument('--compare', help="baseline JSON file to compare the results against")
+    args = arg_parser.parse_args()
+
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='rag_bench_'))
+    os.makedirs(workdir, exist_ok=True)
+    # 共享的向量缓存会让构建时间取决于之前跑过什么，每次测量使用工作目录中新的缓存
+    embedding_cache_path = os.path.join(workdir, 'embedding_cache.sqlite')
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(embedding_cache_path + suffix):
+            os.remove(embedding_cache_path + suffix)
+    os.environ['RAG_EMBEDDING_CACHE'] = embedding_cache_path
+    repo_path = os.path.join(workdir, 'repo')
+    repo_config = {'files': args.files, 'classes_per_file': args.classes_per_file,
+                   'methods_per_class': args.methods_per_class, 'call_density': args.call_density,
+                   'packages': args.packages, 'seed': args.seed}
+    repo, generate_seconds = timed(generate_repo, repo_path, **repo_config)
+    logging.info(f"Generated {args.files} files with {len(repo['classes'])} classes in {generate_seconds:.2f} seconds")
+    queries = make_queries(repo['classes'], args.queries, args.seed)
+
+    options = {'encode_sample': args.encode_sample, 'llm_queries': args.llm_queries,
+               'stub_tokens': args.stub_tokens, 'stub_token_delay': args.stub_token_delay,
+               'stub_prefill_per_char': args.stub_prefill_per_char}
+    results = {}
+    for target in args.targets.split(','):
+        logging.info(f"Running {target} benchmark...")
+        results[target] = run_target(target, repo_path, workdir, queries, options)
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'repo': dict(repo_config, bytes=sum(os.path.getsize(path) for path in java_files_of(repo_path))),
+        'queries': args.queries,
+        'results': results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compare(json.load(f), report)
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,403 @@
+import os
+import json
+import hashlib
+import mmap
+import logging
+from collections import defaultdict
+import numpy as np
+from java_syntax import (TYPE_DECLARATIONS, body_members, declared_names, node_text, referenced_types, type_list,
+                         type_name)
+
+NODE_KINDS = ('file', 'type', 'method')
+FILE, TYPE, METHOD = range(len(NODE_KINDS))
+
+# contains: 文件/类型包含类型或方法；其余为跨文件解析出的依赖关系
+EDGE_KINDS = ('contains', 'calls', 'extends', 'implements', 'field_type', 'imports')
+CONTAINS, CALLS, EXTENDS, IMPLEMENTS, FIELD_TYPE, IMPORTS = range(len(EDGE_KINDS))
+
+# 持久化目录中的文件，manifest 最后写入，存在即表示其余文件完整
+MANIFEST_FILE = 'graph.json'
+ARRAY_NAMES = ('node_kinds', 'node_files', 'node_starts', 'node_ends', 'node_digests', 'indptr', 'indices', 'kinds')
+
+
+def file_stat(path):
+    stat = os.stat(path)
+    return {'mtime': stat.st_mtime_ns, 'size': stat.st_size}
+
+
+class SourceFiles:
+    """按文件 ID 懒加载源文件，首次访问时 mmap，节点内容只在需要时切片解码。"""
+
+    def __init__(self, paths):
+        self.paths = paths
+        self._maps = {}
+
+    def __getitem__(self, file_id):
+        source = self._maps.get(file_id)
+        if source is None:
+            with open(self.paths[file_id], 'rb') as f:
+                # 空文件无法 mmap
+                if os.fstat(f.fileno()).st_size == 0:
+                    source = b''
+                else:
+                    source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[file_id] = source
+        return source
+
+    def close(self):
+        for source in self._maps.values():
+            if isinstance(source, mmap.mmap):
+                source.close()
+        self._maps.clear()
+
+
+class CodeGraph:
+    """以整数节点 ID 和 CSR 邻接数组存储的代码图。
+
+    节点只保存类型、名称、在源文件中的字节范围 (file_id, start_byte, end_byte) 和构建时算出的
+    内容摘要 node_digests（每行是一个 16 字节的 MD5），判断内容是否变化时不用读取源码；边按源节点排序存放，
+    indices[indptr[i]:indptr[i + 1]] 是节点 i 的邻居，kinds 是对应边的类型。边是双向存储的。
+    节点内容从 mmap 的源文件中按字节范围懒切片，图本身不保存任何源码。
+    """
+
+    def __init__(self, files, labels, node_kinds, node_files, node_starts, node_ends, node_digests, indptr, indices,
+                 kinds, file_stats=None):
+        self.files = files
+        self.file_stats = file_stats
+        self.labels = labels
+        self.node_kinds = node_kinds
+        self.node_files = node_files
+        self.node_starts = node_starts
+        self.node_ends = node_ends
+        self.node_digests = node_digests
+        self.indptr = indptr
+        self.indices = indices
+        self.kinds = kinds
+        self.sources = SourceFiles(files)
+        self.node_ids = {label: i for i, label in enumerate(labels)}
+
+    @property
+    def num_nodes(self):
+        return len(self.labels)
+
+    @property
+    def num_edges(self):
+        return len(self.indices) // 2
+
+    def content(self, node):
+        start, end = self.node_starts[node], self.node_ends[node]
+        return self.sources[self.node_files[node]][start:end].decode('utf8', errors='replace')
+
+    def neighbors(self, node, edge_kinds=None):
+        start, end = self.indptr[node], self.indptr[node + 1]
+        neighbors = self.indices[start:end]
+        if edge_kinds is not None:
+            neighbors = neighbors[np.isin(self.kinds[start:end], edge_kinds)]
+        return neighbors
+
+    def expand(self, seeds, hops=1, edge_kinds=None, max_nodes=None):
+        """从种子节点出发逐层做至多 hops 步的广度优先扩展，返回去重后的节点 ID。
+
+        种子节点按原顺序排在最前面，之后是第 1 步、第 2 步……发现的节点；max_nodes 限制返回的
+        节点总数（种子节点不受限制）。
+        """
+        result = list(dict.fromkeys(int(seed) for seed in seeds))
+        seen = set(result)
+        frontier = result
+        for _ in range(hops):
+            if not frontier or (max_nodes is not None and len(result) >= max_nodes):
+                break
+            next_frontier = []
+            for node in frontier:
+                for neighbor in self.neighbors(node, edge_kinds).tolist():
+                    if neighbor not in seen:
+                        seen.add(neighbor)
+                        next_frontier.append(neighbor)
+            if max_nodes is not None:
+                next_frontier = next_frontier[:max(max_nodes - len(result), 0)]
+            result = result + next_frontier
+            frontier = next_frontier
+        return result
+
+    def edge_counts(self):
+        counts = np.bincount(self.kinds, minlength=len(EDGE_KINDS)) // 2
+        return dict(zip(EDGE_KINDS, counts.tolist()))
+
+    def is_stale(self, files=None):
+        """源文件列表或任一文件的 mtime/大小与构建时不同，字节偏移就不再可靠。"""
+        if files is not None and sorted(files) != sorted(self.files):
+            return True
+        for path, stat in zip(self.files, self.file_stats):
+            if not os.path.exists(path) or file_stat(path) != stat:
+                return True
+        return False
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        manifest_path = os.path.join(directory, MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        for name in ARRAY_NAMES:
+            with open(os.path.join(directory, f"{name}.npy"), 'wb') as f:
+                np.save(f, getattr(self, name))
+
+        manifest = {'files': self.files, 'file_stats': self.file_stats, 'labels': self.labels}
+        with open(manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    @classmethod
+    def load(cls, directory):
+        """读取保存的图，数组以 mmap 方式打开，不需要重新解析源文件。目录不完整或是旧版本格式时返回 None。"""
+        manifest_path = os.path.join(directory, MANIFEST_FILE)
+        if not os.path.exists(manifest_path):
+            return None
+        if not all(os.path.exists(os.path.join(directory, f"{name}.npy")) for name in ARRAY_NAMES):
+            return None
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r') for name in ARRAY_NAMES}
+        return cls(manifest['files'], manifest['labels'], file_stats=manifest['file_stats'], **arrays)
+
+    def close(self):
+        self.sources.close()
+
+
+class _TypeInfo:
+    def __init__(self, node, file_id, scope):
+        self.node = node
+        self.file_id = file_id
+        self.scope = scope
+        self.superclass = None
+        self.interfaces = []
+        self.field_types = []
+        self.methods = defaultdict(list)
+
+
+class CodeGraphBuilder:
+    """逐个文件收集节点和符号，全部文件加入后通过符号表解析跨文件的边，最后生成 CodeGraph。
+
+    类型名的解析顺序：同文件的类型、显式导入、同包类型、通配符导入的包、全局唯一的同名类型。
+    方法调用的接收者类型由字段、参数和局部变量的声明类型推断，在该类型及其父类中按方法名查找。
+    """
+
+    def __init__(self):
+        self.files = []
+        self.file_stats = []
+        self.labels = []
+        self._label_set = set()
+        self.node_kinds = []
+        self.node_files = []
+        self.node_starts = []
+        self.node_ends = []
+        self.node_digests = []
+        self._source = b''
+        self.edges = set()
+        # 符号表
+        self.types = {}
+        self.qualified_types = {}
+        self.types_by_name = defaultdict(list)
+        self.file_contexts = []
+        self.pending_calls = []
+
+    def add_node(self, kind, label, file_id, start, end):
+        # 重载方法同名，用起始字节区分
+        if label in self._label_set:
+            label = f"{label}@{start}"
+        self._label_set.add(label)
+        self.labels.append(label)
+        self.node_kinds.append(kind)
+        self.node_files.append(file_id)
+        self.node_starts.append(start)
+        self.node_ends.append(end)
+        self.node_digests.append(hashlib.md5(self._source[start:end]).digest())
+        return len(self.labels) - 1
+
+    def add_edge(self, source, target, kind):
+        if source != target:
+            self.edges.add((source, target, kind))
+
+    def add_file(self, file_path, tree, source_bytes):
+        file_id = len(self.files)
+        self.files.append(file_path)
+        self.file_stats.append(file_stat(file_path))
+        self._source = source_bytes
+        file_node = self.add_node(FILE, file_path, file_id, 0, len(source_bytes))
+
+        context = {'node': file_node, 'package': '', 'imports': {}, 'wildcards': [], 'types': {}}
+        self.file_contexts.append(context)
+        for node in tree.root_node.children:
+            if node.type == 'package_declaration':
+                context['package'] = next(node_text(child) for child in node.named_children
+                                          if child.type in ('scoped_identifier', 'identifier'))
+            elif node.type == 'import_declaration':
+                path_node = next((child for child in node.named_children
+                                  if child.type in ('scoped_identifier', 'identifier')), None)
+                if path_node is None:
+                    continue
+                if any(child.type == 'asterisk' for child in node.children):
+                    context['wildcards'].append(node_text(path_node))
+                else:
+                    full_path = node_text(path_node)
+                    context['imports'][full_path.split('.')[-1]] = full_path
+
+        for node in tree.root_node.children:
+            if node.type in TYPE_DECLARATIONS:
+                self.add_type(node, file_id, file_node, context, [])
+
+    def add_type(self, node, file_id, parent_node, context, scope):
+        name = node_text(node.child_by_field_name('name'))
+        qualified_name = '.'.join(filter(None, [context['package']] + scope + [name]))
+        type_node = self.add_node(TYPE, f"{self.files[file_id]}::{'.'.join(scope + [name])}", file_id,
+                                  node.start_byte, node.end_byte)
+        self.add_edge(parent_node, type_node, CONTAINS)
+
+        info = _TypeInfo(type_node, file_id, scope + [name])
+        self.types[type_node] = info
+        self.qualified_types[qualified_name] = type_node
+        self.types_by_name[name].append(type_node)
+        context['types'].setdefault(name, type_node)
+
+        superclass = node.child_by_field_name('superclass')
+        if superclass is not None and superclass.named_children:
+            info.superclass = type_name(superclass.named_children[0])
+        info.interfaces = type_list(node.child_by_field_name('interfaces'))
+        if node.type == 'interface_declaration':
+            extends = next((child for child in node.children if child.type == 'extends_interfaces'), None)
+            info.interfaces = type_list(extends)
+
+        body = node.child_by_field_name('body')
+        if body is None:
+            return
+        field_types = {}
+        methods = []
+        for member in body_members(body):
+            if member.type in TYPE_DECLARATIONS:
+                self.add_type(member, file_id, type_node, context, scope + [name])
+            elif member.type == 'field_declaration':
+                type_child = member.child_by_field_name('type')
+                info.field_types.extend(referenced_types(type_child))
+                for field_name in declared_names(member):
+                    field_types[field_name] = type_name(type_child)
+            elif member.type in ('method_declaration', 'constructor_declaration'):
+                method_name = node_text(member.child_by_field_name('name'))
+                method_node = self.add_node(METHOD, f"{self.labels[type_node]}.{method_name}", file_id,
+                                            member.start_byte, member.end_byte)
+                self.add_edge(type_node, method_node, CONTAINS)
+                info.methods[method_name].append(method_node)
+                methods.append((method_node, member))
+
+        for method_node, member in methods:
+            self.collect_calls(method_node, type_node, member, field_types)
+
+    def collect_calls(self, method_node, type_node, method, field_types):
+        """记录 (调用方, 接收者类型名, 被调用方法名)，接收者为 None 表示调用本类方法。"""
+        body = method.child_by_field_name('body')
+        if body is None:
+            return
+        variable_types = dict(field_types)
+        parameters = method.child_by_field_name('parameters')
+        for parameter in parameters.named_children:
+            name_node = parameter.child_by_field_name('name')
+            parameter_type = parameter.child_by_field_name('type')
+            if name_node is not None and parameter_type is not None:
+                variable_types[node_text(name_node)] = type_name(parameter_type)
+
+        stack = [body]
+        while stack:
+            node = stack.pop()
+            if node.type == 'local_variable_declaration':
+                local_type = type_name(node.child_by_field_name('type'))
+                for variable in declared_names(node):
+                    variable_types[variable] = local_type
+            elif node.type == 'method_invocation':
+                target = node.child_by_field_name('object')
+                method_name = node_text(node.child_by_field_name('name'))
+                if target is None or target.type == 'this':
+                    self.pending_calls.append((method_node, type_node, None, method_name))
+                elif target.type == 'identifier':
+                    object_name = node_text(target)
+                    receiver = variable_types.get(object_name)
+                    # 没有声明过的大写标识符视为静态调用的类名
+                    if receiver is None and object_name[:1].isupper():
+                        receiver = object_name
+                    if receiver:
+                        self.pending_calls.append((method_node, type_node, receiver, method_name))
+            stack.extend(reversed(node.children))
+
+    def resolve_type(self, name, context):
+        if name is None:
+            return None
+        if name in context['types']:
+            return context['types'][name]
+        if name in context['imports']:
+            return self.qualified_types.get(context['imports'][name])
+        for package in [context['package']] + context['wildcards']:
+            node = self.qualified_types.get(f"{package}.{name}" if package else name)
+            if node is not None:
+                return node
+        candidates = self.types_by_name.get(name, [])
+        return candidates[0] if len(candidates) == 1 else None
+
+    def find_methods(self, type_node, method_name):
+        """在类型及其父类链上按名字查找方法。"""
+        seen = set()
+        while type_node is not None and type_node not in seen:
+            seen.add(type_node)
+            info = self.types[type_node]
+            if method_name in info.methods:
+                return info.methods[method_name]
+            type_node = self.resolve_type(info.superclass, self.file_contexts[info.file_id])
+        return []
+
+    def resolve(self):
+        for context in self.file_contexts:
+            for full_path in context['imports'].values():
+                target = self.qualified_types.get(full_path)
+                if target is not None:
+                    self.add_edge(context['node'], target, IMPORTS)
+
+        for type_node, info in self.types.items():
+            context = self.file_contexts[info.file_id]
+            parent = self.resolve_type(info.superclass, context)
+            if parent is not None:
+                self.add_edge(type_node, parent, EXTENDS)
+            for interface in info.interfaces:
+                target = self.resolve_type(interface, context)
+                if target is not None:
+                    self.add_edge(type_node, target, IMPLEMENTS)
+            for field_type in info.field_types:
+                target = self.resolve_type(field_type, context)
+                if target is not None:
+                    self.add_edge(type_node, target, FIELD_TYPE)
+
+        for method_node, type_node, receiver, method_name in self.pending_calls:
+            if receiver is not None:
+                type_node = self.resolve_type(receiver, self.file_contexts[self.types[type_node].file_id])
+            for target in self.find_methods(type_node, method_name):
+                self.add_edge(method_node, target, CALLS)
+        self.pending_calls = []
+
+    def build(self):
+        self.resolve()
+        num_nodes = len(self.labels)
+        edges = np.array(sorted(self.edges), dtype='int64').reshape(-1, 3)
+        # 每条边正反各存一次，按源节点排序后得到 CSR
+        sources = np.concatenate([edges[:, 0], edges[:, 1]])
+        targets = np.concatenate([edges[:, 1], edges[:, 0]])
+        kinds = np.concatenate([edges[:, 2], edges[:, 2]])
+        order = np.lexsort((targets, sources))
+        indptr = np.zeros(num_nodes + 1, dtype='int64')
+        np.cumsum(np.bincount(sources, minlength=num_nodes), out=indptr[1:])
+
+        graph = CodeGraph(self.files, self.labels,
+                          np.array(self.node_kinds, dtype='uint8'),
+                          np.array(self.node_files, dtype='int32'),
+                          np.array(self.node_starts, dtype='int64'),
+                          np.array(self.node_ends, dtype='int64'),
+                          np.frombuffer(b''.join(self.node_digests), dtype='uint8').reshape(-1, 16),
+                          indptr, targets[order].astype('int32'), kinds[order].astype('uint8'),
+                          self.file_stats)
+        logging.info(f"Built code graph with {graph.num_nodes} nodes and {graph.num_edges} edges: "
+                     f"{graph.edge_counts()}")
+        return graph
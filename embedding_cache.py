@@ -0,0 +1,218 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+import metrics
+
+# 跨仓库共享的向量缓存，按 (模型, 规范化后的片段哈希) 存放；RAG_EMBEDDING_CACHE 设为空字符串时不使用缓存
+EMBEDDING_CACHE_PATH = os.environ.get('RAG_EMBEDDING_CACHE',
+                                      os.path.join(os.path.expanduser('~'), '.cache', 'ragcode', 'embeddings.sqlite'))
+
+# 数据库大小（已使用的页，不含空闲页）的上限，超过后按最近使用时间淘汰到上限的 EVICT_TO 以下。
+# 每个向量在 B 树和溢出页中实际占用的空间比向量本身大，因此按页统计而不是按向量字节数
+MAX_CACHE_BYTES = int(os.environ.get('RAG_EMBEDDING_CACHE_MB', 2048)) * 2 ** 20
+EVICT_TO = 0.9
+
+# 每条 SQL 中的哈希个数，低于 SQLite 默认的参数个数上限
+LOOKUP_CHUNK = 500
+# 命中的条目距上次更新使用时间超过这么多秒才重新写入，避免每次读取都产生写事务
+TOUCH_INTERVAL = 3600
+# 其他进程持有写锁时最多等待的秒数
+BUSY_TIMEOUT = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS embeddings (
+    model TEXT NOT NULL,
+    digest BLOB NOT NULL,
+    vector BLOB NOT NULL,
+    last_used INTEGER NOT NULL,
+    PRIMARY KEY (model, digest)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used);
+CREATE TABLE IF NOT EXISTS stats (bytes INTEGER NOT NULL, entries INTEGER NOT NULL);
+INSERT INTO stats SELECT 0, 0 WHERE NOT EXISTS (SELECT 1 FROM stats);
+CREATE TRIGGER IF NOT EXISTS embeddings_insert AFTER INSERT ON embeddings BEGIN
+    UPDATE stats SET bytes = bytes + length(NEW.vector), entries = entries + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS embeddings_delete AFTER DELETE ON embeddings BEGIN
+    UPDATE stats SET bytes = bytes - length(OLD.vector), entries = entries - 1;
+END;
+"""
+
+
+def normalize_snippet(text):
+    """只有空白不同的片段（换行符、行尾空格、首尾空行）视为相同。"""
+    lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    return '\n'.join(line.rstrip() for line in lines).strip('\n')
+
+
+def snippet_digest(text):
+    return hashlib.sha1(normalize_snippet(text).encode('utf8')).digest()
+
+
+class EmbeddingCache:
+    """SQLite 上的内容寻址向量缓存。
+
+    WAL 模式下多个构建进程可以同时读写：写入在 BEGIN IMMEDIATE 事务中进行，已存在的键被忽略，
+    条目数由触发器在同一事务内维护，淘汰按事务内的页数判断，因此并发写入不会使统计失真。
+    淘汰释放的页由 incremental_vacuum 归还给文件系统。数据库不能放在网络文件系统上。
+    """
+
+    def __init__(self, path=None, max_bytes=MAX_CACHE_BYTES):
+        self.path = path or EMBEDDING_CACHE_PATH
+        self.max_bytes = max_bytes
+        self._connection = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # fork 出的子进程不能沿用父进程的连接
+        if self._connection is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None,
+                                         check_same_thread=False)
+            # auto_vacuum 只在建库时生效，淘汰后用 incremental_vacuum 归还空间
+            connection.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            try:
+                # 多个进程可能同时建表，放在一个写事务里
+                connection.executescript('BEGIN IMMEDIATE;' + SCHEMA + 'COMMIT;')
+            except sqlite3.Error:
+                connection.close()
+                raise
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+    def get_many(self, model, digests):
+        """返回 {哈希: 向量}，只包含命中的哈希。"""
+        found = {}
+        now = int(time.time())
+        with self._lock:
+            connection = self._connect()
+            for start in range(0, len(digests), LOOKUP_CHUNK):
+                chunk = digests[start:start + LOOKUP_CHUNK]
+                placeholders = ','.join('?' * len(chunk))
+                stale = []
+                for digest, vector, last_used in connection.execute(
+                        f"SELECT digest, vector, last_used FROM embeddings WHERE model = ? AND digest IN ({placeholders})",
+                        [model, *chunk]):
+                    found[bytes(digest)] = np.frombuffer(vector, dtype='float32')
+                    if last_used < now - TOUCH_INTERVAL:
+                        stale.append(digest)
+                if stale:
+                    placeholders = ','.join('?' * len(stale))
+                    connection.execute(f"UPDATE embeddings SET last_used = ? WHERE model = ? AND digest IN ({placeholders})",
+                                       [now, model, *stale])
+        return found
+
+    def put_many(self, model, digests, vectors):
+        now = int(time.time())
+        rows = [(model, digest, np.ascontiguousarray(vector, dtype='float32').tobytes(), now)
+                for digest, vector in zip(digests, vectors)]
+        if not rows:
+            return
+        with self._lock:
+            connection = self._connect()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                connection.executemany("INSERT OR IGNORE INTO embeddings VALUES (?, ?, ?, ?)", rows)
+                evicted = self._evict(connection)
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            if evicted:
+                # execute() 只执行 incremental_vacuum 的一步（释放一页），executescript 会执行到底
+                connection.executescript('PRAGMA incremental_vacuum;')
+        if evicted:
+            logging.info(f"Evicted {evicted} least recently used embeddings from {self.path}")
+
+    @staticmethod
+    def _used_bytes(connection):
+        page_count = connection.execute('PRAGMA page_count').fetchone()[0]
+        free_pages = connection.execute('PRAGMA freelist_count').fetchone()[0]
+        page_size = connection.execute('PRAGMA page_size').fetchone()[0]
+        return (page_count - free_pages) * page_size
+
+    def _evict(self, connection):
+        size = self._used_bytes(connection)
+        entries = connection.execute("SELECT entries FROM stats").fetchone()[0]
+        if size <= self.max_bytes or not entries:
+            return 0
+        # 按每个条目平均占用的页空间估算需要删除的条目数，一次删除
+        count = -(-(size - int(self.max_bytes * EVICT_TO)) * entries // size)
+        connection.execute("DELETE FROM embeddings WHERE (model, digest) IN "
+                           "(SELECT model, digest FROM embeddings ORDER BY last_used LIMIT ?)", (count,))
+        return count
+
+    def stats(self):
+        with self._lock:
+            connection = self._connect()
+            vector_bytes, entries = connection.execute("SELECT bytes, entries FROM stats").fetchone()
+            size = self._used_bytes(connection)
+        return {'bytes': size, 'vector_bytes': vector_bytes, 'entries': entries, 'max_bytes': self.max_bytes}
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None and self._pid == os.getpid():
+                self._connection.close()
+            self._connection = None
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def default_cache():
+    """进程内共享的缓存实例，EMBEDDING_CACHE_PATH 为空时返回 None。"""
+    global _default
+    if not EMBEDDING_CACHE_PATH:
+        return None
+    with _default_lock:
+        if _default is None or _default.path != EMBEDDING_CACHE_PATH:
+            _default = EmbeddingCache(EMBEDDING_CACHE_PATH)
+        return _default
+
+
+def encode(texts, model, encode_texts, cache=None):
+    """返回 texts 的 float32 向量矩阵，只有缓存中没有的片段才交给 encode_texts 编码。
+
+    model 是缓存键的一部分，换模型（或改变池化方式）时应使用不同的名字；同一批中内容相同的片段只编码一次。
+    缓存不可用时记录警告并直接编码。
+    """
+    cache = cache or default_cache()
+    if cache is None or not texts:
+        return np.asarray(encode_texts(list(texts)), dtype='float32')
+
+    digests = [snippet_digest(text) for text in texts]
+    try:
+        with metrics.timer('embedding_cache_lookup'):
+            found = cache.get_many(model, list(dict.fromkeys(digests)))
+    except sqlite3.Error as e:
+        logging.warning(f"Embedding cache {cache.path} unavailable: {e}")
+        return np.asarray(encode_texts(list(texts)), dtype='float32')
+
+    missing = {}
+    for text, digest in zip(texts, digests):
+        if digest not in found and digest not in missing:
+            missing[digest] = text
+    metrics.count('embedding_cache_hit', len(texts) - sum(digest not in found for digest in digests))
+    metrics.count('embedding_cache_miss', len(missing))
+
+    if missing:
+        vectors = np.asarray(encode_texts(list(missing.values())), dtype='float32')
+        try:
+            with metrics.timer('embedding_cache_store'):
+                cache.put_many(model, list(missing), vectors)
+        except sqlite3.Error as e:
+            logging.warning(f"Failed to write to embedding cache {cache.path}: {e}")
+        found.update(zip(missing, vectors))
+    logging.info(f"Encoded {len(missing)} of {len(texts)} snippets, reused the rest from the embedding cache")
+    return np.stack([found[digest] for digest in digests]).astype('float32', copy=False)
@@ -1,14 +1,14 @@
 import os
-import networkx as nx
 from tree_sitter import Language, Parser
 import tree_sitter_java as tsjava
-import torch
-from transformers import RobertaTokenizer, RobertaModel, AutoTokenizer, AutoModelForCausalLM
-from sentence_transformers import SentenceTransformer
-import faiss
+import numpy as np
+import ann_index
+import embedding_cache
+import model_registry
 import glob
 import logging
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 # 设置日志
 logging.basicConfig(level=logging.INFO)
@@ -21,12 +21,26 @@ JAVA_LANGUAGE = Language(tsjava.language())
 parser = Parser()
 parser.language = JAVA_LANGUAGE
 
-# 初始化编码器
-encoder = SentenceTransformer('all-MiniLM-L6-v2')
+# FAISS 索引类型（见 ann_index.INDEX_TYPES）和搜索参数
+INDEX_TYPE = 'flat'
+SEARCH_PARAMS = {}
 
-# 初始化 LLM（这里使用的是 GPT-2，你可以替换为其他模型）
-llm_tokenizer = AutoTokenizer.from_pretrained("gpt2")
-llm_model = AutoModelForCausalLM.from_pretrained("gpt2")
+# 每批送入编码器的代码片段数
+ENCODE_BATCH_SIZE = 256
+
+# 已提交但还未被编码阶段取走的文件数上限，限制解析结果在内存中的堆积
+MAX_PENDING_FILES = 4 * (os.cpu_count() or 1)
+
+
+def get_encoder():
+    # 模型在主进程第一次使用时才加载，只做解析的工作进程不会加载模型；
+    # 同一进程中的其他入口（如 optimized_rag_java_analyzer）共用同一个编码器
+    return model_registry.sentence_encoder()
+
+
+def get_llm():
+    # 这里使用的是 GPT-2，可以在 model_registry.CAUSAL_LM_MODEL 中替换为其他模型
+    return model_registry.causal_lm()
 
 
 def parse_java_file(file_path):
@@ -41,51 +55,77 @@ def parse_java_file(file_path):
 
 
 def process_file(file_path):
+    """只做 tree-sitter 解析，在工作进程中运行。"""
     tree, source_code = parse_java_file(file_path)
     if not tree or not source_code:
-        return [], []
+        return []
 
+    source_bytes = bytes(source_code, 'utf8')
     nodes = []
-    embeddings = []
-
     for node in tree.root_node.children:
         if node.type in ['method_declaration', 'class_declaration']:
-            content = source_code[node.start_byte:node.end_byte]
+            content = source_bytes[node.start_byte:node.end_byte].decode('utf8')
             nodes.append((file_path, node.type, content))
-            embeddings.append(encoder.encode(content))
+    return nodes
+
 
-    return nodes, embeddings
+def parse_files(executor, java_files):
+    """按文件顺序产出解析结果，同时最多有 MAX_PENDING_FILES 个文件在解析或等待编码。"""
+    pending = deque()
+    for file_path in java_files:
+        pending.append(executor.submit(process_file, file_path))
+        if len(pending) >= MAX_PENDING_FILES:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
 
 
 def create_code_index(repo_path):
-    java_files = glob.glob(os.path.join(repo_path, "**/*.java"), recursive=True)
+    # 排序后结果与文件系统遍历顺序无关，每次运行的节点顺序一致
+    java_files = sorted(glob.glob(os.path.join(repo_path, "**/*.java"), recursive=True))
     logging.info(f"Found {len(java_files)} Java files in the repository")
 
     all_nodes = []
-    all_embeddings = []
+    embedding_batches = []
+    batch = []
 
+    def encode_batch():
+        # 第一次编码时才加载模型，此时工作进程已经启动，fork 出来的进程不会带上模型
+        embeddings = embedding_cache.encode(batch, model_registry.SENTENCE_ENCODER_MODEL,
+                                            lambda texts: get_encoder().encode(texts, batch_size=len(texts)))
+        embedding_batches.append(np.asarray(embeddings, dtype='float32'))
+        batch.clear()
+
+    # 工作进程只解析，编码在主进程中按大批次进行
     with ProcessPoolExecutor() as executor:
-        future_to_file = {executor.submit(process_file, file_path): file_path for file_path in java_files}
-        for future in as_completed(future_to_file):
-            nodes, embeddings = future.result()
-            all_nodes.extend(nodes)
-            all_embeddings.extend(embeddings)
+        for nodes in parse_files(executor, java_files):
+            for node in nodes:
+                all_nodes.append(node)
+                batch.append(node[2])
+                if len(batch) >= ENCODE_BATCH_SIZE:
+                    encode_batch()
+    if batch:
+        encode_batch()
 
     logging.info(f"Processed {len(all_nodes)} code snippets")
 
+    if embedding_batches:
+        embeddings = np.concatenate(embedding_batches)
+    else:
+        embeddings = np.empty((0, get_encoder().get_sentence_embedding_dimension()), dtype='float32')
+
     # 创建 FAISS 索引
-    dimension = len(all_embeddings[0])
-    index = faiss.IndexFlatL2(dimension)
-    index.add(numpy.array(all_embeddings))
+    index = ann_index.build_index(embeddings, index_type=INDEX_TYPE)
+    ann_index.set_search_params(index, **SEARCH_PARAMS)
 
     return index, all_nodes
 
 
 def query_code(index, nodes, query, k=5):
-    query_vector = encoder.encode([query])
+    query_vector = get_encoder().encode([query])
     distances, indices = index.search(query_vector, k)
 
-    results = [nodes[i] for i in indices[0]]
+    results = [nodes[i] for i in indices[0] if i != -1]
     return results
 
 
@@ -95,6 +135,7 @@ def generate_response(query, contexts):
         prompt += f"\n{ctx[1]}:\n{ctx[2]}\n"
     prompt += "\nBased on the above code contexts, please provide an answer to the query:"
 
+    llm_tokenizer, llm_model = get_llm()
     inputs = llm_tokenizer(prompt, return_tensors="pt")
     outputs = llm_model.generate(**inputs, max_length=200, num_return_sequences=1, no_repeat_ngram_size=2)
     response = llm_tokenizer.decode(outputs[0], skip_special_tokens=True)
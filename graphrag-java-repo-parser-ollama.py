@@ -3,11 +3,11 @@ import tree_sitter_java as tsjava
 from tree_sitter import Language, Parser
 import glob
 import logging
-import requests
-import json
-from sentence_transformers import SentenceTransformer
-import faiss
 import numpy as np
+import ann_index
+import embedding_cache
+from ollama_client import OllamaClient, OllamaError
+import model_registry
 
 # 设置日志
 logging.basicConfig(level=logging.INFO)
@@ -21,8 +21,17 @@ JAVA_LANGUAGE = Language(tsjava.language())
 parser = Parser()
 parser.set_language(JAVA_LANGUAGE)
 
-# 初始化句子编码器
-encoder = SentenceTransformer('all-MiniLM-L6-v2')
+# FAISS 索引类型（见 ann_index.INDEX_TYPES）和搜索参数
+INDEX_TYPE = 'flat'
+SEARCH_PARAMS = {}
+
+# 复用连接的 Ollama 客户端
+ollama_client = OllamaClient()
+
+
+def get_encoder():
+    # 第一次编码时才加载模型
+    return model_registry.sentence_encoder()
 
 
 def parse_java_file(file_path):
@@ -58,34 +67,27 @@ def create_code_index(repo_path):
     logging.info(f"Extracted {len(all_snippets)} code snippets")
 
     # 编码代码片段
-    embeddings = encoder.encode(all_snippets)
+    embeddings = embedding_cache.encode(all_snippets, model_registry.SENTENCE_ENCODER_MODEL,
+                                        lambda texts: get_encoder().encode(texts))
 
     # 创建 FAISS 索引
-    dimension = embeddings.shape[1]
-    index = faiss.IndexFlatL2(dimension)
-    index.add(embeddings)
+    index = ann_index.build_index(np.asarray(embeddings, dtype='float32'), index_type=INDEX_TYPE)
+    ann_index.set_search_params(index, **SEARCH_PARAMS)
 
     return index, all_snippets
 
 
 def query_code(index, all_snippets, query, k=5):
-    query_vector = encoder.encode([query])
+    query_vector = get_encoder().encode([query])
     distances, indices = index.search(query_vector, k)
-    return [all_snippets[i] for i in indices[0]]
+    return [all_snippets[i] for i in indices[0] if i != -1]
 
 
 def query_ollama(prompt, model="llama3.1"):
-    url = "http://localhost:11434/api/generate"
-    data = {
-        "model": model,
-        "prompt": prompt,
-        "stream": False
-    }
-    response = requests.post(url, json=data)
-    if response.status_code == 200:
-        return json.loads(response.text)['response']
-    else:
-        logging.error(f"Error querying Ollama: {response.status_code}, {response.text}")
+    try:
+        return ollama_client.generate(prompt, model=model)
+    except OllamaError as e:
+        logging.error(str(e))
         return None
 
 
@@ -1,12 +1,13 @@
 import os
-import networkx as nx
 import tree_sitter_java as tsjava
 from tree_sitter import Language, Parser
-from transformers import RobertaTokenizer, RobertaModel
 import torch
-from torch.nn.functional import cosine_similarity
 import glob
 import logging
+from code_graph import CodeGraph, CodeGraphBuilder
+import embedding_cache
+import metrics
+import model_registry
 
 # 设置日志
 logging.basicConfig(level=logging.INFO)
@@ -28,109 +29,202 @@ JAVA_LANGUAGE = Language(tsjava.language())
 parser = Parser()
 parser.set_language(JAVA_LANGUAGE)
 
-# 初始化 GraphCodeBERT 编码器
-tokenizer = RobertaTokenizer.from_pretrained("microsoft/graphcodebert-base")
-model = RobertaModel.from_pretrained("microsoft/graphcodebert-base")
+# 模型单个输入的 token 上限，以及长文本滑动窗口的步长
+MAX_TOKENS = 512
+WINDOW_STRIDE = 384
+
+# 批量编码的批大小和 torch 算子内线程数
+ENCODE_BATCH_SIZE = 32
+ENCODE_THREADS = int(os.environ.get("ENCODE_THREADS", os.cpu_count() or 1))
+
+# 跨仓库向量缓存中的模型名，包含窗口切分方式，改变切分参数后不会取到旧的向量
+EMBEDDING_CACHE_MODEL = f"{model_registry.GRAPH_ENCODER_MODEL}:window{MAX_TOKENS}/{WINDOW_STRIDE}"
+
+# 保存解析结果的目录，以及其中的节点向量缓存文件
+GRAPH_CACHE_DIR = 'code_graph_cache'
+EMBEDDINGS_CACHE_FILE = 'embeddings.pt'
+
+# 退出时把指标写到这个文件（Prometheus 文本格式），未设置时只在日志中输出各阶段汇总
+METRICS_FILE = os.environ.get('RAG_METRICS_FILE')
+
+# 检索到的节点沿图扩展的步数，以及返回的上下文节点数上限
+CONTEXT_HOPS = 1
+MAX_CONTEXT_NODES = 20
+
+
+def get_graph_encoder():
+    """GraphCodeBERT 的 (tokenizer, model)，第一次编码时才加载。"""
+    return model_registry.graph_encoder()
+
+
+def split_windows(token_ids, size=MAX_TOKENS - 2, stride=WINDOW_STRIDE):
+    """把超过模型长度上限的 token 序列切成有重叠的滑动窗口（不含特殊 token）。"""
+    if len(token_ids) <= size:
+        return [token_ids]
+    windows = []
+    for start in range(0, len(token_ids), stride):
+        windows.append(token_ids[start:start + size])
+        if start + size >= len(token_ids):
+            break
+    return windows
+
+
+def encode_texts(texts, batch_size=ENCODE_BATCH_SIZE, num_threads=ENCODE_THREADS):
+    """批量编码，返回形状为 (len(texts), hidden_size) 的张量。
+
+    长文本先切成滑动窗口，所有窗口按 token 长度排序后分批送入模型，使同一批内的填充最少；
+    每个文本的向量是其各窗口向量按 token 数加权的平均。
+    """
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+    tokenizer, model = get_graph_encoder()
+    token_ids = tokenizer(list(texts), add_special_tokens=False, truncation=False, verbose=False)['input_ids']
+    owners = []
+    windows = []
+    for i, ids in enumerate(token_ids):
+        for window in split_windows(ids):
+            owners.append(i)
+            windows.append([tokenizer.cls_token_id] + window + [tokenizer.sep_token_id])
+
+    hidden_size = model.config.hidden_size
+    window_embeddings = torch.empty((len(windows), hidden_size))
+    order = sorted(range(len(windows)), key=lambda j: len(windows[j]))
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        with metrics.timer('encode_batch') as timing:
+            inputs = tokenizer.pad({'input_ids': [windows[j] for j in batch]}, return_tensors="pt")
+            with torch.no_grad():
+                outputs = model(**inputs)
+            mask = inputs['attention_mask'].unsqueeze(-1).to(outputs.last_hidden_state.dtype)
+            window_embeddings[batch] = (outputs.last_hidden_state * mask).sum(dim=1) / mask.sum(dim=1)
+        # 按窗口均摊，长文本的多个窗口各算一项
+        metrics.observe('encode_item', timing.seconds / len(batch), len(batch))
+        metrics.count('encode_batch', len(batch))
+
+    owners = torch.tensor(owners, dtype=torch.long)
+    weights = torch.tensor([len(window) for window in windows], dtype=window_embeddings.dtype).unsqueeze(-1)
+    pooled = torch.zeros((len(texts), hidden_size)).index_add_(0, owners, window_embeddings * weights)
+    totals = torch.zeros((len(texts), 1)).index_add_(0, owners, weights)
+    return pooled / totals
 
 
 def encode_text(text):
-    inputs = tokenizer(text, return_tensors="pt", max_length=512, truncation=True, padding=True)
-    with torch.no_grad():
-        outputs = model(**inputs)
-    return outputs.last_hidden_state.mean(dim=1)
+    return encode_texts([text])
 
 
 def parse_java_file(file_path):
     try:
-        with open(file_path, 'r', encoding='utf-8') as file:
-            content = file.read()
-        tree = parser.parse(bytes(content, 'utf8'))
-        return tree, content
+        with metrics.timer('parse'):
+            with open(file_path, 'rb') as file:
+                source = file.read()
+            tree = parser.parse(source)
+        metrics.count('parse')
+        return tree, source
     except Exception as e:
+        metrics.error('parse')
         logging.error(f"Error parsing file {file_path}: {str(e)}")
         return None, None
 
 
-def traverse_tree(tree):
-    cursor = tree.walk()
-
-    reached_root = False
-    while reached_root == False:
-        yield cursor.node
-
-        if cursor.goto_first_child():
-            continue
-
-        if cursor.goto_next_sibling():
-            continue
-
-        retracing = True
-        while retracing:
-            if not cursor.goto_parent():
-                retracing = False
-                reached_root = True
-
-            if cursor.goto_next_sibling():
-                retracing = False
-
-
-def create_code_graph(repo_path):
-    G = nx.Graph()
-    java_files = glob.glob(os.path.join(repo_path, "**/*.java"), recursive=True)
-
-    for file_path in java_files:
-        tree, source_code = parse_java_file(file_path)
-        if tree and source_code:
-            file_node = file_path
-            G.add_node(file_node, type='file', content=source_code)
-
-            for node in traverse_tree(tree):
-                if node.type == 'method_declaration':
-                    method_name = next(
-                        (child.text.decode('utf8') for child in node.children if child.type == 'identifier'), None)
-                    if method_name:
-                        method_node = f"{file_path}::{method_name}"
-                        method_content = source_code[node.start_byte:node.end_byte]
-                        G.add_node(method_node, type='method', content=method_content)
-                        G.add_edge(file_node, method_node)
-                elif node.type == 'class_declaration':
-                    class_name = next(
-                        (child.text.decode('utf8') for child in node.children if child.type == 'identifier'), None)
-                    if class_name:
-                        class_node = f"{file_path}::{class_name}"
-                        class_content = source_code[node.start_byte:node.end_byte]
-                        G.add_node(class_node, type='class', content=class_content)
-                        G.add_edge(file_node, class_node)
-
-    logging.info(f"Created graph with {G.number_of_nodes()} nodes and {G.number_of_edges()} edges")
+def create_code_graph(repo_path, cache_dir=GRAPH_CACHE_DIR, force_rebuild=False):
+    """解析仓库中的所有 Java 文件，通过符号表解析跨文件的调用、继承、实现、字段类型和导入关系。
+
+    图保存在 cache_dir 中，源文件没有增删改时直接加载，不再重新解析。
+    """
+    java_files = sorted(glob.glob(os.path.join(repo_path, "**/*.java"), recursive=True))
+
+    G = None if force_rebuild else CodeGraph.load(cache_dir)
+    if G is not None and G.is_stale(java_files):
+        logging.info("Source files changed since the graph was saved, rebuilding")
+        G = None
+
+    if G is None:
+        builder = CodeGraphBuilder()
+        for file_path in java_files:
+            tree, source = parse_java_file(file_path)
+            # 空文件也要加入，否则文件列表对不上，每次都会判定为需要重建
+            if tree is not None:
+                with metrics.timer('graph_extract'):
+                    builder.add_file(file_path, tree, source)
+        with metrics.timer('graph_resolve'):
+            G = builder.build()
+        G.save(cache_dir)
+    else:
+        logging.info(f"Loaded graph with {G.num_nodes} nodes and {G.num_edges} edges from {cache_dir}")
+
+    G.embeddings = compute_node_embeddings(G, cache_dir)
     return G
 
 
-def query_graph(G, query):
-    if G.number_of_nodes() == 0:
+def load_embeddings_cache(cache_file):
+    """返回 {节点 ID: (内容哈希, 向量)}，没有缓存时返回空字典。"""
+    if not os.path.exists(cache_file):
+        return {}
+    cache = torch.load(cache_file)
+    return {node_id: (digest, embedding) for node_id, digest, embedding
+            in zip(cache['node_ids'], cache['content_hashes'], cache['embeddings'])}
+
+
+def compute_node_embeddings(G, cache_dir=GRAPH_CACHE_DIR):
+    """为图中所有节点计算归一化向量，返回按节点 ID 对齐的向量矩阵。
+
+    内容没有变化的节点直接复用 cache_dir 中缓存文件的向量，变化的节点再查跨仓库的 embedding_cache；
+    只有节点有变化或有节点被删除时才写回缓存文件。是否变化按构建图时保存的内容摘要判断，
+    只有变化的节点才会从源文件中读取内容。
+    """
+    cache_file = os.path.join(cache_dir, EMBEDDINGS_CACHE_FILE)
+    cached = load_embeddings_cache(cache_file)
+    node_ids = G.labels
+    hashes = [digest.tobytes().hex() for digest in G.node_digests]
+
+    missing = [i for i, (node, digest) in enumerate(zip(node_ids, hashes))
+               if node not in cached or cached[node][0] != digest]
+    # 变化的节点先查跨仓库的向量缓存，仍然没有的才交给模型编码
+    encoded = None
+    if missing:
+        encoded = torch.from_numpy(embedding_cache.encode([G.content(i) for i in missing], EMBEDDING_CACHE_MODEL,
+                                                          lambda texts: encode_texts(texts).numpy()))
+        encoded = torch.nn.functional.normalize(encoded, dim=1)
+
+    # 向量维度尽量从已有的向量中取，全部命中缓存时不需要加载模型
+    if encoded is not None:
+        hidden_size = encoded.shape[1]
+    elif cached:
+        hidden_size = len(next(iter(cached.values()))[1])
+    else:
+        hidden_size = get_graph_encoder()[1].config.hidden_size
+    embeddings = torch.empty((len(node_ids), hidden_size))
+    for i, node in enumerate(node_ids):
+        if node in cached and cached[node][0] == hashes[i]:
+            embeddings[i] = cached[node][1]
+    if missing:
+        embeddings[missing] = encoded
+
+    # 没有缺失的节点时，缓存中的节点数不同说明有节点被删除
+    if missing or len(cached) != len(node_ids):
+        os.makedirs(cache_dir, exist_ok=True)
+        torch.save({'node_ids': node_ids, 'content_hashes': hashes, 'embeddings': embeddings}, cache_file)
+    logging.info(f"{len(missing)} of {len(node_ids)} nodes changed, reused the rest from {cache_file}")
+    return embeddings
+
+
+def query_graph(G, query, k=5, hops=CONTEXT_HOPS, max_nodes=MAX_CONTEXT_NODES):
+    if G.num_nodes == 0:
         logging.warning("Graph is empty. No nodes to query.")
         return []
 
-    query_embedding = encode_text(query)
+    # 节点向量已归一化，矩阵乘法即为余弦相似度
+    with metrics.timer('encode_query'):
+        query_embedding = torch.nn.functional.normalize(encode_text(query), dim=1)[0]
+    with metrics.timer('vector_search'):
+        similarities = G.embeddings @ query_embedding
+        top = torch.topk(similarities, min(k, G.num_nodes)).indices.tolist()
 
-    max_similarity = -float('inf')
-    most_similar_node = None
-    for node, data in G.nodes(data=True):
-        node_embedding = encode_text(data['content'])
-        similarity = cosine_similarity(query_embedding, node_embedding).item()
-        if similarity > max_similarity:
-            max_similarity = similarity
-            most_similar_node = node
-
-    if most_similar_node is None:
-        logging.warning("No similar node found for the query.")
-        return []
-
-    context = [G.nodes[most_similar_node]['content']]
-    for neighbor in G.neighbors(most_similar_node):
-        context.append(G.nodes[neighbor]['content'])
-
-    return context
+    # 沿 CSR 邻接数组做有界的 k 步扩展，命中的节点排在前面
+    with metrics.timer('graph_expand'):
+        nodes = G.expand(top, hops=hops, max_nodes=max_nodes)
+    return [G.content(node) for node in nodes]
 
 
 def main():
@@ -146,6 +240,8 @@ def main():
     for i, c in enumerate(context):
         print(f"Context {i + 1}:\n{c}\n")
 
+    metrics.dump(METRICS_FILE)
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
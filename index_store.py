@@ -0,0 +1,192 @@
+import os
+import json
+import mmap
+import numpy as np
+import faiss
+
+# 缓存目录中的文件
+INDEX_FILE = 'index.faiss'
+EMBEDDINGS_FILE = 'embeddings.npy'
+SNIPPETS_FILE = 'snippets.bin'
+OFFSETS_FILE = 'snippet_offsets.npy'
+MANIFEST_FILE = 'manifest.json'
+
+# 复制 embeddings.npy 时每次搬运的行数
+COPY_CHUNK_ROWS = 65536
+
+
+def _replace_atomically(path, write):
+    tmp_path = path + '.tmp'
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+class SnippetStore:
+    """按片段 ID 懒加载代码片段。
+
+    所有片段按追加顺序写在 snippets.bin 中，snippet_offsets.npy 的第 i 行是 ID 为 i 的片段的
+    (起始偏移, 字节长度)，已删除的片段起始偏移为 -1。只有被访问到的片段才会从 mmap 中解码出来。
+    """
+
+    def __init__(self, cache_dir):
+        self.blob_path = os.path.join(cache_dir, SNIPPETS_FILE)
+        offsets_path = os.path.join(cache_dir, OFFSETS_FILE)
+        if os.path.exists(offsets_path):
+            self.offsets = np.load(offsets_path, mmap_mode='r')
+        else:
+            self.offsets = np.empty((0, 2), dtype='int64')
+        # 立即打开片段文件，之后即使索引重建替换了文件，这个实例读到的仍是与 offsets 对应的旧文件
+        self._file = open(self.blob_path, 'rb') if os.path.exists(self.blob_path) else None
+        self._mmap = None
+
+    def __len__(self):
+        return int(np.count_nonzero(self.offsets[:, 0] >= 0))
+
+    def __contains__(self, snippet_id):
+        return 0 <= snippet_id < len(self.offsets) and self.offsets[snippet_id, 0] >= 0
+
+    def __getitem__(self, snippet_id):
+        if snippet_id not in self:
+            raise KeyError(snippet_id)
+        start, length = (int(x) for x in self.offsets[snippet_id])
+        return self._blob()[start:start + length].decode('utf-8')
+
+    def items(self):
+        for snippet_id in np.flatnonzero(self.offsets[:, 0] >= 0):
+            yield int(snippet_id), self[int(snippet_id)]
+
+    def _blob(self):
+        if self._mmap is None:
+            # 空文件无法 mmap
+            if self._file is None or os.fstat(self._file.fileno()).st_size == 0:
+                return b''
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def load_manifest(cache_dir):
+    path = os.path.join(cache_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_manifest(cache_dir, manifest):
+    def write(tmp_path):
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+
+    _replace_atomically(os.path.join(cache_dir, MANIFEST_FILE), write)
+
+
+def read_index(cache_dir, writable=False):
+    """读取 FAISS 原生格式的索引。
+
+    只读时优先用 IO_FLAG_MMAP_IFC 把向量编码直接 mmap 进来，旧版本 FAISS 没有这个标志时退回普通读取。
+    """
+    path = os.path.join(cache_dir, INDEX_FILE)
+    mmap_flag = getattr(faiss, 'IO_FLAG_MMAP_IFC', None)
+    if not writable and mmap_flag is not None:
+        try:
+            return faiss.read_index(path, mmap_flag)
+        except RuntimeError:
+            pass
+    return faiss.read_index(path)
+
+
+def write_index(cache_dir, index):
+    _replace_atomically(os.path.join(cache_dir, INDEX_FILE), lambda tmp_path: faiss.write_index(index, tmp_path))
+
+
+def load_embeddings(cache_dir):
+    """以 mmap 方式打开向量矩阵，第 i 行是 ID 为 i 的片段的向量。"""
+    path = os.path.join(cache_dir, EMBEDDINGS_FILE)
+    if not os.path.exists(path):
+        return None
+    return np.load(path, mmap_mode='r')
+
+
+def append_embeddings(cache_dir, first_id, embeddings):
+    """把 ID 从 first_id 开始的新向量写到 embeddings.npy 末尾，旧向量按块复制，不会整体读入内存。
+
+    first_id 之后的旧行是上次中断留下的，会被覆盖。
+    """
+    path = os.path.join(cache_dir, EMBEDDINGS_FILE)
+    old = load_embeddings(cache_dir)
+    embeddings = np.asarray(embeddings, dtype='float32')
+    old_rows = 0 if old is None else min(old.shape[0], first_id)
+
+    def write(tmp_path):
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype='float32',
+                                        shape=(old_rows + len(embeddings), embeddings.shape[1]))
+        for start in range(0, old_rows, COPY_CHUNK_ROWS):
+            stop = min(start + COPY_CHUNK_ROWS, old_rows)
+            out[start:stop] = old[start:stop]
+        out[old_rows:] = embeddings
+        out.flush()
+        del out
+
+    _replace_atomically(path, write)
+
+
+def update_snippets(cache_dir, removed_ids, first_id, new_snippets):
+    """删除 removed_ids 对应的片段，并把 new_snippets 以从 first_id 开始的连续 ID 追加到片段文件。
+
+    失效字节超过有效字节时顺带压缩片段文件，片段 ID 保持不变。
+    """
+    blob_path = os.path.join(cache_dir, SNIPPETS_FILE)
+    offsets_path = os.path.join(cache_dir, OFFSETS_FILE)
+    if os.path.exists(offsets_path):
+        # 丢弃上次中断时写入但没有记入清单的片段
+        offsets = np.load(offsets_path)[:first_id]
+    else:
+        offsets = np.empty((0, 2), dtype='int64')
+    if len(removed_ids):
+        offsets[np.asarray(removed_ids, dtype='int64'), 0] = -1
+
+    new_offsets = np.empty((len(new_snippets), 2), dtype='int64')
+    with open(blob_path, 'ab') as f:
+        position = f.tell()
+        for i, snippet in enumerate(new_snippets):
+            data = snippet.encode('utf-8')
+            f.write(data)
+            new_offsets[i] = (position, len(data))
+            position += len(data)
+    offsets = np.concatenate([offsets, new_offsets])
+
+    live = offsets[:, 0] >= 0
+    live_bytes = int(offsets[live, 1].sum())
+    if position - live_bytes > live_bytes:
+        offsets = _compact_snippets(blob_path, offsets)
+
+    _replace_atomically(offsets_path, lambda tmp_path: _save_npy(tmp_path, offsets))
+
+
+def _save_npy(path, array):
+    # 传文件对象，避免 np.save 给临时文件名追加 .npy 后缀
+    with open(path, 'wb') as f:
+        np.save(f, array)
+
+
+def _compact_snippets(blob_path, offsets):
+    offsets = offsets.copy()
+    tmp_path = blob_path + '.tmp'
+    with open(blob_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+        position = 0
+        for snippet_id in np.flatnonzero(offsets[:, 0] >= 0):
+            start, length = offsets[snippet_id]
+            src.seek(start)
+            dst.write(src.read(length))
+            offsets[snippet_id, 0] = position
+            position += length
+    os.replace(tmp_path, blob_path)
+    return offsets
@@ -0,0 +1,196 @@
+import re
+from collections import namedtuple
+from java_syntax import CHUNKED_TYPE_DECLARATIONS, body_members, declared_names, node_text
+
+# 单个代码块的 token 上限，以及低于该值的相邻小成员会被合并
+MAX_CHUNK_TOKENS = 256
+MIN_CHUNK_TOKENS = 32
+
+MEMBER_KINDS = {
+    'method_declaration': 'method',
+    'constructor_declaration': 'constructor',
+    'compact_constructor_declaration': 'constructor',
+    'field_declaration': 'field',
+    'constant_declaration': 'field',
+    'annotation_type_element_declaration': 'method',
+    'enum_constant': 'field',
+    'static_initializer': 'initializer',
+    'block': 'initializer',
+}
+COMMENT_TYPES = {'line_comment', 'block_comment'}
+
+TOKEN_PATTERN = re.compile(r'\w+|[^\w\s]')
+
+# kind: type / method / constructor / field / initializer / members（合并的小成员）
+# start_byte 和 end_byte 是代码块正文（不含签名头）在源文件中的字节范围
+Chunk = namedtuple('Chunk', ['kind', 'name', 'start_byte', 'end_byte', 'text'])
+
+
+def count_tokens(text):
+    """粗略的 token 计数，只用于控制代码块大小，不依赖任何模型分词器。"""
+    return len(TOKEN_PATTERN.findall(text))
+
+
+def _node_text(source_bytes, start, end):
+    return source_bytes[start:end].decode('utf8', errors='replace')
+
+
+def _name_of(node):
+    name = node.child_by_field_name('name')
+    if name is not None:
+        return node_text(name)
+    if node.type in ('field_declaration', 'constant_declaration'):
+        return ','.join(declared_names(node))
+    return node.type
+
+
+def _package_of(root):
+    for node in root.children:
+        if node.type == 'package_declaration':
+            for child in node.children:
+                if child.type in ('scoped_identifier', 'identifier'):
+                    return node_text(child)
+    return ''
+
+
+class _Chunker:
+    def __init__(self, source_bytes, max_tokens, min_tokens):
+        self.source_bytes = source_bytes
+        self.max_tokens = max_tokens
+        self.min_tokens = min_tokens
+        self.chunks = []
+
+    def line_start(self, start):
+        """成员前面只有缩进时从行首开始截取，保留原有缩进。"""
+        line_start = self.source_bytes.rfind(b'\n', 0, start) + 1
+        if not self.source_bytes[line_start:start].strip():
+            return line_start
+        return start
+
+    def emit(self, kind, name, header, start, end, signature=None):
+        start = self.line_start(start)
+        text = _node_text(self.source_bytes, start, end)
+        # 签名头也计入 token 上限
+        budget = max(self.max_tokens - count_tokens(header), self.min_tokens)
+        if count_tokens(text) <= budget:
+            self.chunks.append(Chunk(kind, name, start, end, header + text))
+            return
+
+        # 单个成员超过上限时按行切分，后续各段额外带上成员自身的签名
+        if signature:
+            continuation_header = f"{header}// {signature} ...\n"
+        else:
+            continuation_header = header
+        budget = max(self.max_tokens - count_tokens(continuation_header), self.min_tokens)
+        parts = []
+        current = []
+        current_tokens = 0
+        for line in text.splitlines(keepends=True):
+            line_tokens = count_tokens(line)
+            if current and current_tokens + line_tokens > budget:
+                parts.append(current)
+                current = []
+                current_tokens = 0
+            current.append(line)
+            current_tokens += line_tokens
+        if current:
+            parts.append(current)
+
+        offset = start
+        for i, part in enumerate(parts, 1):
+            part_text = ''.join(part)
+            part_end = offset + len(part_text.encode('utf8'))
+            self.chunks.append(Chunk(kind, f"{name} (part {i}/{len(parts)})", offset, part_end,
+                                     (header if i == 1 else continuation_header) + part_text))
+            offset = part_end
+
+    def signature_of(self, node):
+        body = node.child_by_field_name('body')
+        end = body.start_byte if body is not None else node.end_byte
+        return ' '.join(_node_text(self.source_bytes, node.start_byte, end).split())
+
+    def chunk_type(self, node, package, scope):
+        body = node.child_by_field_name('body')
+        type_name = _name_of(node)
+        qualified_name = '.'.join(filter(None, [package] + [s[1] for s in scope] + [type_name]))
+        header = self.header(package, scope)
+
+        type_text = _node_text(self.source_bytes, node.start_byte, node.end_byte)
+        if body is None or count_tokens(header + type_text) <= self.max_tokens:
+            self.emit('type', qualified_name, header, node.start_byte, node.end_byte)
+            return
+
+        inner_scope = scope + [(self.signature_of(node), type_name)]
+        inner_header = self.header(package, inner_scope)
+
+        group = []
+        group_tokens = 0
+        comment_start = None
+
+        def flush():
+            nonlocal group, group_tokens
+            if not group:
+                return
+            if len(group) == 1:
+                kind, name, start, end, member_node = group[0]
+                signature = self.signature_of(member_node)
+            else:
+                kind, name = 'members', ','.join(member[1] for member in group)
+                start, end = group[0][2], group[-1][3]
+                signature = None
+            self.emit(kind, f"{qualified_name}#{name}", inner_header, start, end, signature)
+            group = []
+            group_tokens = 0
+
+        for child in body_members(body):
+            if child.type in COMMENT_TYPES:
+                # 紧挨在成员前面的注释（如 Javadoc）归入该成员
+                if comment_start is None:
+                    comment_start = child.start_byte
+                continue
+
+            start = child.start_byte if comment_start is None else comment_start
+            comment_start = None
+
+            if child.type in CHUNKED_TYPE_DECLARATIONS:
+                flush()
+                self.chunk_type(child, package, inner_scope)
+                continue
+            if child.type not in MEMBER_KINDS:
+                continue
+
+            tokens = count_tokens(_node_text(self.source_bytes, start, child.end_byte))
+            member = (MEMBER_KINDS[child.type], _name_of(child), start, child.end_byte, child)
+            if tokens >= self.min_tokens:
+                flush()
+                group.append(member)
+                flush()
+            else:
+                # 相邻的小成员（字段、getter/setter 等）合并成一个块
+                if group_tokens + tokens > self.max_tokens:
+                    flush()
+                group.append(member)
+                group_tokens += tokens
+        flush()
+
+    @staticmethod
+    def header(package, scope):
+        lines = []
+        if package:
+            lines.append(f"// package {package}\n")
+        lines.extend(f"// {signature}\n" for signature, _ in scope)
+        return ''.join(lines)
+
+
+def chunk_java(tree, source_bytes, max_tokens=MAX_CHUNK_TOKENS, min_tokens=MIN_CHUNK_TOKENS):
+    """递归遍历 Java 语法树，按方法、构造器、字段和内部类型切分代码块。
+
+    放得进 max_tokens 的类型整体作为一个块；否则逐个成员切分，嵌套类型递归处理。每个块前面带有
+    包名和外层类型签名。小于 min_tokens 的相邻成员会合并，超过 max_tokens 的成员按行拆分。
+    """
+    package = _package_of(tree.root_node)
+    chunker = _Chunker(source_bytes, max_tokens, min_tokens)
+    for node in tree.root_node.children:
+        if node.type in CHUNKED_TYPE_DECLARATIONS:
+            chunker.chunk_type(node, package, [])
+    return chunker.chunks
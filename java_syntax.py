@@ -0,0 +1,60 @@
+# tree-sitter Java 语法树的公共辅助函数，code_graph、advanced_java_analyzer 和 java_chunker 共用
+
+TYPE_DECLARATIONS = {'class_declaration', 'interface_declaration', 'enum_declaration', 'record_declaration'}
+# 注解类型不参与继承和调用关系，类图和代码图不处理；分块时和其他类型一样按成员切分
+CHUNKED_TYPE_DECLARATIONS = TYPE_DECLARATIONS | {'annotation_type_declaration'}
+
+
+def node_text(node):
+    return node.text.decode('utf8')
+
+
+def type_name(node):
+    """类型节点的基础类型名：List<Order> -> List，a.b.C -> C，Foo[] -> Foo。"""
+    if node is None:
+        return None
+    if node.type == 'type_identifier':
+        return node_text(node)
+    if node.type == 'scoped_type_identifier':
+        return node_text([child for child in node.children if child.type == 'type_identifier'][-1])
+    if node.type in ('generic_type', 'array_type'):
+        return type_name(node.children[0])
+    return None
+
+
+def referenced_types(node):
+    """类型节点中出现的所有类型名，包括泛型参数：Map<String, Order> -> Map, String, Order。"""
+    names = []
+    stack = [node]
+    while stack:
+        current = stack.pop()
+        if current.type in ('type_identifier', 'scoped_type_identifier'):
+            names.append(type_name(current))
+            continue
+        stack.extend(reversed(current.children))
+    return names
+
+
+def type_list(node):
+    """extends/implements 子句中的类型名。"""
+    if node is None:
+        return []
+    for child in node.children:
+        if child.type == 'type_list':
+            return [name for name in (type_name(type_node) for type_node in child.named_children) if name]
+    return []
+
+
+def declared_names(node):
+    """字段或局部变量声明中的变量名。"""
+    return [node_text(child.child_by_field_name('name')) for child in node.children
+            if child.type == 'variable_declarator']
+
+
+def body_members(body):
+    """类型体内的直接成员，枚举的成员声明区会被展开。"""
+    for child in body.children:
+        if child.type == 'enum_body_declarations':
+            yield from child.children
+        else:
+            yield child
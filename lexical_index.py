@@ -0,0 +1,238 @@
+import os
+import re
+from collections import Counter
+import numpy as np
+
+LEXICAL_FILE = 'lexical.npz'
+
+# BM25 参数
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# 倒排融合时 RRF 的平滑常数
+RRF_K = 60
+
+IDENTIFIER_PATTERN = re.compile(r'[A-Za-z_$][\w$]*')
+# 驼峰、全大写缩写和数字的切分点：OrderEventHandler -> Order Event Handler，HTTPServer2 -> HTTP Server 2
+PART_PATTERN = re.compile(r'[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+')
+SYMBOL_QUERY_PATTERN = re.compile(r'[A-Za-z_$][\w$]*(?:[.#][A-Za-z_$][\w$]*)*')
+
+JAVA_KEYWORDS = {
+    'abstract', 'assert', 'boolean', 'break', 'byte', 'case', 'catch', 'char', 'class', 'const', 'continue',
+    'default', 'do', 'double', 'else', 'enum', 'extends', 'final', 'finally', 'float', 'for', 'goto', 'if',
+    'implements', 'import', 'instanceof', 'int', 'interface', 'long', 'native', 'new', 'package', 'private',
+    'protected', 'public', 'return', 'short', 'static', 'strictfp', 'super', 'switch', 'synchronized', 'this',
+    'throw', 'throws', 'transient', 'try', 'void', 'volatile', 'while', 'var', 'record', 'true', 'false', 'null',
+}
+
+
+def split_identifier(identifier):
+    """把标识符按 snake_case 和 camelCase 切成小写的词：handleRetry -> handle, retry。"""
+    parts = []
+    for piece in identifier.split('_'):
+        parts.extend(part.lower() for part in PART_PATTERN.findall(piece))
+    return parts
+
+
+def identifier_terms(identifier):
+    """标识符的检索词：切分出的各个词，多词标识符还会带上完整的小写形式，用于精确匹配。"""
+    parts = split_identifier(identifier)
+    terms = [part for part in parts if len(part) > 1 and part not in JAVA_KEYWORDS]
+    if len(parts) > 1:
+        terms.append(identifier.lower())
+    return terms
+
+
+def tokenize(text):
+    terms = []
+    for identifier in IDENTIFIER_PATTERN.findall(text):
+        if identifier not in JAVA_KEYWORDS:
+            terms.extend(identifier_terms(identifier))
+    return terms
+
+
+class LexicalIndex:
+    """代码片段上的 BM25 倒排索引，片段 ID 与 FAISS 索引中的 ID 一致。
+
+    倒排表以 CSR 形式存放：vocabulary[t] 的倒排项是 doc_ids/term_freqs 中 indptr[t]:indptr[t + 1]
+    的部分，doc_lengths[i] 是片段 i 的词数（已删除或不存在的片段为 0）。
+    """
+
+    def __init__(self, vocabulary=(), indptr=None, doc_ids=None, term_freqs=None, doc_lengths=None):
+        self.vocabulary = list(vocabulary)
+        self.term_ids = {term: i for i, term in enumerate(self.vocabulary)}
+        self.indptr = np.zeros(1, dtype='int64') if indptr is None else indptr
+        self.doc_ids = np.empty(0, dtype='int64') if doc_ids is None else doc_ids
+        self.term_freqs = np.empty(0, dtype='int32') if term_freqs is None else term_freqs
+        self.doc_lengths = np.empty(0, dtype='int32') if doc_lengths is None else doc_lengths
+        live = self.doc_lengths > 0
+        self.num_docs = int(np.count_nonzero(live))
+        self.average_length = float(self.doc_lengths[live].mean()) if self.num_docs else 0.0
+
+    def __len__(self):
+        return self.num_docs
+
+    @classmethod
+    def build(cls, snippets, num_ids=None):
+        """由 (片段 ID, 文本) 序列构建索引，缺失的 ID 视为已删除。num_ids 为 ID 空间的大小。"""
+        documents = dict(snippets)
+        if num_ids is None:
+            num_ids = max(documents, default=-1) + 1
+        return cls().update([], 0, [documents.get(i, '') for i in range(num_ids)])
+
+    def update(self, removed_ids, first_id, new_snippets):
+        """返回删除 removed_ids、丢弃 first_id 及之后的旧文档、再追加 new_snippets 后的新索引。
+
+        与 index_store.update_snippets 的约定一致：new_snippets 的 ID 从 first_id 开始连续分配。
+        """
+        removed_ids = np.asarray(removed_ids, dtype='int64')
+        term_ids = np.repeat(np.arange(len(self.vocabulary), dtype='int64'), np.diff(self.indptr))
+        keep = self.doc_ids < first_id
+        if len(removed_ids):
+            keep &= ~np.isin(self.doc_ids, removed_ids)
+        term_ids, doc_ids, term_freqs = term_ids[keep], self.doc_ids[keep], self.term_freqs[keep]
+
+        doc_lengths = np.zeros(first_id + len(new_snippets), dtype='int32')
+        old_rows = min(len(self.doc_lengths), first_id)
+        doc_lengths[:old_rows] = self.doc_lengths[:old_rows]
+        removed_ids = removed_ids[removed_ids < old_rows]
+        doc_lengths[removed_ids] = 0
+
+        vocabulary = list(self.vocabulary)
+        vocabulary_ids = dict(self.term_ids)
+        new_terms, new_docs, new_freqs = [], [], []
+        for offset, text in enumerate(new_snippets):
+            counts = Counter(tokenize(text))
+            doc_lengths[first_id + offset] = sum(counts.values())
+            for term, count in counts.items():
+                term_id = vocabulary_ids.get(term)
+                if term_id is None:
+                    term_id = vocabulary_ids[term] = len(vocabulary)
+                    vocabulary.append(term)
+                new_terms.append(term_id)
+                new_docs.append(first_id + offset)
+                new_freqs.append(count)
+
+        term_ids = np.concatenate([term_ids, np.asarray(new_terms, dtype='int64')])
+        doc_ids = np.concatenate([doc_ids, np.asarray(new_docs, dtype='int64')])
+        term_freqs = np.concatenate([term_freqs, np.asarray(new_freqs, dtype='int32')])
+
+        # 去掉已经没有倒排项的词，重新编号后按 (词, 文档) 排序得到 CSR
+        counts = np.bincount(term_ids, minlength=len(vocabulary))
+        used = np.flatnonzero(counts)
+        remap = np.full(len(vocabulary), -1, dtype='int64')
+        remap[used] = np.arange(len(used))
+        term_ids = remap[term_ids]
+        order = np.lexsort((doc_ids, term_ids))
+        indptr = np.zeros(len(used) + 1, dtype='int64')
+        np.cumsum(counts[used], out=indptr[1:])
+        return LexicalIndex([vocabulary[i] for i in used], indptr, doc_ids[order], term_freqs[order], doc_lengths)
+
+    def postings(self, term):
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            return self.doc_ids[:0], self.term_freqs[:0]
+        start, end = self.indptr[term_id], self.indptr[term_id + 1]
+        return self.doc_ids[start:end], self.term_freqs[start:end]
+
+    def document_frequencies(self, terms):
+        """{词: 包含它的文档数}，只包含索引中出现过的词。"""
+        frequencies = {}
+        for term in terms:
+            term_id = self.term_ids.get(term)
+            if term_id is not None:
+                frequencies[term] = int(self.indptr[term_id + 1] - self.indptr[term_id])
+        return frequencies
+
+    def search(self, query, k=5, corpus=None):
+        """返回按 BM25 得分降序的 [(片段 ID, 得分)]，开销与查询词的倒排表长度成正比。
+
+        corpus 为 corpus_stats() 的结果时，IDF 和平均长度按多个索引合起来的语料计算，
+        各索引的得分可以直接比较；默认只用本索引的统计。
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms or not self.num_docs:
+            return []
+        num_docs, average_length, frequencies = corpus or (self.num_docs, self.average_length, None)
+        all_ids, all_scores = [], []
+        for term in terms:
+            doc_ids, term_freqs = self.postings(term)
+            if not len(doc_ids):
+                continue
+            df = len(doc_ids) if frequencies is None else frequencies[term]
+            idf = np.log(1 + (num_docs - df + 0.5) / (df + 0.5))
+            lengths = self.doc_lengths[doc_ids] / average_length
+            tf = term_freqs.astype('float32')
+            all_ids.append(doc_ids)
+            all_scores.append(idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * lengths)))
+        if not all_ids:
+            return []
+        doc_ids, inverse = np.unique(np.concatenate(all_ids), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(all_scores))
+        top = np.argsort(-scores, kind='stable')[:k]
+        return [(int(doc_ids[i]), float(scores[i])) for i in top]
+
+    def exact_symbol(self, query):
+        """查询本身就是一个多词标识符（如 OrderEventHandler、handleRetry、Foo.bar）且在代码中出现过时
+        返回 True，此时可以只走词法检索，跳过向量化。"""
+        query = query.strip().rstrip('()?')
+        if not SYMBOL_QUERY_PATTERN.fullmatch(query):
+            return False
+        segments = re.split(r'[.#]', query)
+        multi_part = [segment for segment in segments if len(split_identifier(segment)) > 1]
+        if not multi_part and len(segments) == 1:
+            return False
+        return all(segment.lower() in self.term_ids for segment in multi_part or segments)
+
+    def save(self, cache_dir):
+        path = os.path.join(cache_dir, LEXICAL_FILE)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, vocabulary=np.array(self.vocabulary, dtype=str), indptr=self.indptr,
+                     doc_ids=self.doc_ids, term_freqs=self.term_freqs, doc_lengths=self.doc_lengths)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, cache_dir):
+        path = os.path.join(cache_dir, LEXICAL_FILE)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            return cls(data['vocabulary'].tolist(), data['indptr'], data['doc_ids'], data['term_freqs'],
+                       data['doc_lengths'])
+
+
+def corpus_stats(indexes, query):
+    """多个索引合起来的 (文档数, 平均文档长度, {查询词: 文档频率})，传给 LexicalIndex.search。"""
+    terms = list(dict.fromkeys(tokenize(query)))
+    num_docs = sum(index.num_docs for index in indexes)
+    total_length = sum(index.average_length * index.num_docs for index in indexes)
+    frequencies = dict.fromkeys(terms, 0)
+    for index in indexes:
+        for term, df in index.document_frequencies(terms).items():
+            frequencies[term] += df
+    return num_docs, total_length / num_docs if num_docs else 0.0, frequencies
+
+
+def reciprocal_rank_fusion(rankings, weights=None, rrf_k=RRF_K):
+    """融合多个按相关性排好序的 ID 列表，返回按融合得分降序的 ID。"""
+    weights = weights or [1.0] * len(rankings)
+    scores = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] = scores.get(doc_id, 0.0) + weight / (rrf_k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+def weighted_score_fusion(scored_lists, weights):
+    """各列表的得分先按最小-最大归一化到 [0, 1]，再加权求和。scored_lists 中得分越大越相关。"""
+    scores = {}
+    for scored, weight in zip(scored_lists, weights):
+        if not scored:
+            continue
+        values = np.array([score for _, score in scored], dtype='float64')
+        low, span = values.min(), values.max() - values.min()
+        normalized = (values - low) / span if span > 0 else np.ones_like(values)
+        for (doc_id, _), value in zip(scored, normalized):
+            scores[doc_id] = scores.get(doc_id, 0.0) + weight * value
+    return sorted(scores, key=scores.get, reverse=True)
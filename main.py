@@ -1,13 +1,268 @@
-from fastapi import FastAPI
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
 
-app = FastAPI()
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from starlette.concurrency import iterate_in_threadpool
+
+import metrics
+import model_registry
+import optimized_rag_java_analyzer as rag
+from ollama_client import OllamaError
+from query_cache import QueryCache
+
+REPO_PATH = os.environ.get("REPO_PATH", "./repo")
+
+# 启动时预加载并预热模型，第一个查询不用承担模型加载的开销：WARMUP=1 uvicorn main:app 或 python main.py --warmup
+WARMUP = os.environ.get("WARMUP") == "1"
+
+# 在这个时间窗口内到达的查询会合并成一次 encoder.encode 调用
+BATCH_WINDOW_SECONDS = 0.005
+MAX_BATCH_SIZE = 64
+
+# 单个请求最多返回的片段数
+MAX_K = 100
+
+
+class EmbeddingBatcher:
+    """把并发请求的查询向量化合并成批，在工作线程中执行，避免阻塞事件循环。"""
+
+    def __init__(self, encode, max_batch_size=MAX_BATCH_SIZE, window=BATCH_WINDOW_SECONDS):
+        self.encode_batch = encode
+        self.max_batch_size = max_batch_size
+        self.window = window
+        self._queue = None
+        self._task = None
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    async def encode(self, text):
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            started = loop.time()
+            deadline = started + self.window
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            texts = [text for text, _ in batch]
+            # 为了凑批而等待的时间
+            metrics.observe('encode_query_wait', loop.time() - started)
+            try:
+                vectors = await asyncio.to_thread(self.encode_batch, texts)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), vector in zip(batch, vectors):
+                if not future.done():
+                    future.set_result(vector)
+
+
+class CodeIndex:
+    """常驻内存的索引，重建时整体替换，查询总是看到一致的 (index, snippets)。
+
+    查询缓存属于索引，每次重建后清空。
+    """
+
+    def __init__(self, repo_path):
+        self.repo_path = repo_path
+        self.index = None
+        self.snippets = None
+        self.lexical = None
+        self.cache = QueryCache()
+        self._lock = asyncio.Lock()
+
+    async def load(self, force_rebuild=False):
+        async with self._lock:
+            self.index, self.snippets, self.lexical = await asyncio.to_thread(rag.load_or_create_index,
+                                                                              self.repo_path, force_rebuild)
+            self.cache.clear()
+
+    def search_symbol(self, query, k):
+        """精确符号匹配的快速路径，只查倒排表，直接在事件循环中执行。不适用时返回 None。"""
+        return rag.symbol_search(self.lexical, self.snippets, query, k)
+
+    async def search(self, query, query_vector, k):
+        index, snippets, lexical = self.index, self.snippets, self.lexical
+        return await asyncio.to_thread(rag.hybrid_search, index, snippets, lexical, query, query_vector, k)
+
+
+def register_gauges(app):
+    code_index = app.state.code_index
+
+    def cache_stat(name):
+        return lambda: code_index.cache.stats()[name]
+
+    metrics.gauge('rag_index_snippets', "Snippets in the loaded index",
+                  lambda: len(code_index.snippets) if code_index.snippets is not None else None)
+    metrics.gauge('rag_query_cache_entries', "Query cache entries", cache_stat('entries'))
+    # 命中和未命中次数只增不减（重建索引清空缓存时也不归零），导出为 counter
+    for name in ('hits', 'semantic_hits', 'misses'):
+        metrics.counter(f'rag_query_cache_{name}', f"Query cache {name.replace('_', ' ')}", cache_stat(name))
+
+
+@asynccontextmanager
+async def lifespan(app):
+    app.state.code_index = CodeIndex(REPO_PATH)
+    with metrics.timer('index_load') as timing:
+        await app.state.code_index.load()
+    logging.info(f"Index loading/creation took {timing.seconds:.2f} seconds")
+    register_gauges(app)
+    if WARMUP:
+        # 索引加载之后再预热：建索引时会 fork 进程池，此时不应有加载模型的后台线程
+        await asyncio.to_thread(model_registry.warmup, [model_registry.SENTENCE_ENCODER])
+
+    # 查询的向量化按批进行，和建索引的编码分开统计
+    app.state.batcher = EmbeddingBatcher(lambda texts: rag.encode_texts(texts, 'encode_query'))
+    app.state.batcher.start()
+    yield
+    await app.state.batcher.stop()
+    metrics.write_profiles()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+class SearchRequest(BaseModel):
+    # 空白查询返回 422，不做检索和生成
+    query: str = Field(min_length=1, pattern=r'\S')
+    k: int = Field(5, ge=1, le=MAX_K)
+
+
+class QueryRequest(SearchRequest):
+    stream: bool = False
+
+
+class ReindexRequest(BaseModel):
+    force: bool = False
+
+
+async def retrieve(query, k, need_answer):
+    """返回 (查询向量, 片段, 缓存中的回答, 缓存版本)，能用缓存时跳过向量化和检索。
+
+    命中精确符号的查询不做向量化，查询向量为 None。need_answer 为真时（/query）只有带回答的缓存条目
+    才计为命中，/search 只需要片段。
+    """
+    code_index = app.state.code_index
+    version = code_index.cache.version
+    entry = code_index.cache.lookup(query, k, need_answer=need_answer)
+    if entry is not None:
+        return entry.query_vector, entry.snippets, entry.answer, version
+
+    snippets = code_index.search_symbol(query, k)
+    if snippets is not None:
+        return None, snippets, None, version
+
+    query_vector = None
+    if rag.RETRIEVAL_MODE != 'lexical':
+        query_vector = await app.state.batcher.encode(query)
+    snippets = await code_index.search(query, query_vector, k)
+    return query_vector, snippets, None, version
 
 
 @app.get("/")
 async def root():
-    return {"message": "Hello World"}
+    code_index = app.state.code_index
+    return {"repo_path": REPO_PATH, "snippets": len(code_index.snippets), "cache": code_index.cache.stats()}
+
+
+@app.post("/search")
+async def search(request: SearchRequest):
+    query_vector, snippets, answer, version = await retrieve(request.query, request.k, need_answer=False)
+    app.state.code_index.cache.store(request.query, request.k, query_vector, snippets, answer, version)
+    return {"snippets": snippets}
+
+
+@app.post("/query")
+async def query(request: QueryRequest):
+    cache = app.state.code_index.cache
+    query_vector, snippets, answer, version = await retrieve(request.query, request.k, need_answer=True)
+    if not snippets:
+        raise HTTPException(status_code=404, detail="No relevant code found.")
+
+    if answer is None and query_vector is not None:
+        answer = cache.lookup_similar(query_vector, snippets)
+
+    if request.stream:
+        if answer is not None:
+            return StreamingResponse(iter([answer]), media_type="text/plain")
+
+        async def stream_and_cache():
+            # 在线程池中迭代同步的生成器，完整生成后再写入缓存。已经开始流式输出后无法再改状态码，
+            # 生成失败时以一段错误文本结束响应；客户端断开时生成器被取消，关闭到 Ollama 的连接
+            generation = rag.ollama_client.stream(rag.build_prompt(request.query, snippets))
+            tokens = []
+            completed = False
+            try:
+                async for token in iterate_in_threadpool(iter(generation)):
+                    tokens.append(token)
+                    yield token
+                completed = True
+            except OllamaError as e:
+                logging.error(str(e))
+                yield f"\n\n[error] {e}\n"
+            finally:
+                if not completed:
+                    generation.cancel()
+            if not generation.stats.cancelled:
+                cache.store(request.query, request.k, query_vector, snippets, ''.join(tokens), version)
+
+        return StreamingResponse(stream_and_cache(), media_type="text/plain")
+
+    if answer is None:
+        try:
+            answer = await asyncio.to_thread(rag.ollama_client.generate, rag.build_prompt(request.query, snippets))
+        except OllamaError as e:
+            raise HTTPException(status_code=502, detail=str(e))
+    cache.store(request.query, request.k, query_vector, snippets, answer, version)
+    return {"answer": answer, "snippets": snippets}
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+
+@app.post("/reindex")
+async def reindex(request: ReindexRequest):
+    with metrics.timer('index_load') as timing:
+        await app.state.code_index.load(force_rebuild=request.force)
+    return {"snippets": len(app.state.code_index.snippets), "seconds": timing.seconds}
+
 
+if __name__ == "__main__":
+    import argparse
+    import uvicorn
 
-@app.get("/hello/{name}")
-async def say_hello(name: str):
-    return {"message": f"Hello {name}"}
+    arg_parser = argparse.ArgumentParser(description="Serve the code index over HTTP")
+    arg_parser.add_argument('--host', default='127.0.0.1')
+    arg_parser.add_argument('--port', type=int, default=8000)
+    arg_parser.add_argument('--warmup', action='store_true', help="load and warm up models before serving")
+    args = arg_parser.parse_args()
+    WARMUP = WARMUP or args.warmup
+    uvicorn.run(app, host=args.host, port=args.port)
@@ -0,0 +1,412 @@
+import bisect
+import cProfile
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter as _Counter
+from contextlib import contextmanager
+
+# 延迟直方图的桶上界（秒），覆盖从单次 BM25 查询到整次 LLM 生成
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+# 性能剖析：RAG_PROFILE 为 'cprofile' 或 'sampling' 时对 RAG_PROFILE_STAGES 中的阶段（留空为全部）
+# 采集剖析数据，write_profiles() 写到 RAG_PROFILE_DIR
+PROFILE_MODE = os.environ.get('RAG_PROFILE', '')
+PROFILE_STAGES = os.environ.get('RAG_PROFILE_STAGES', '')
+PROFILE_DIR = os.environ.get('RAG_PROFILE_DIR', 'profiles')
+SAMPLING_INTERVAL = 0.005
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        return self._values.get(labels, 0)
+
+    def state(self):
+        with self._lock:
+            return dict(self._values)
+
+    def merge(self, state):
+        with self._lock:
+            for labels, value in state.items():
+                self._values[labels] = self._values.get(labels, 0) + value
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def samples(self):
+        for labels, value in sorted(self.state().items()):
+            yield self.name + '_total', list(zip(self.labelnames, labels)), value
+
+
+class Gauge(Counter):
+    """取值在导出时由 callback 计算，如索引中的片段数。"""
+
+    def __init__(self, name, documentation, callback):
+        super().__init__(name, documentation)
+        self.callback = callback
+
+    def samples(self):
+        value = self.callback()
+        if value is not None:
+            yield self.name, [], value
+
+
+class CallbackCounter(Gauge):
+    """单调递增、取值在导出时由 callback 读取的计数，如查询缓存的命中次数。"""
+
+    def samples(self):
+        value = self.callback()
+        if value is not None:
+            yield self.name + '_total', [], value
+
+
+class Histogram:
+    """固定桶的直方图，每组标签保存各桶的计数、总和、总数和最大值。"""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, labels=(), count=1):
+        """记录 count 次取值为 value 的观测，用于把一批的耗时均摊到每一项。"""
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0, value]
+            entry[0][index] += count
+            entry[1] += value * count
+            entry[2] += count
+            entry[3] = max(entry[3], value)
+
+    def state(self):
+        with self._lock:
+            return {labels: (list(counts), total, count, maximum)
+                    for labels, (counts, total, count, maximum) in self._values.items()}
+
+    def merge(self, state):
+        with self._lock:
+            for labels, (counts, total, count, maximum) in state.items():
+                entry = self._values.setdefault(labels, [[0] * (len(self.buckets) + 1), 0.0, 0, maximum])
+                entry[0] = [a + b for a, b in zip(entry[0], counts)]
+                entry[1] += total
+                entry[2] += count
+                entry[3] = max(entry[3], maximum)
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def quantile(self, q, labels=()):
+        """按桶内线性插值估计分位数，不超过实际观测到的最大值。"""
+        entry = self.state().get(labels)
+        if entry is None or not entry[2]:
+            return None
+        counts, _, count, maximum = entry
+        rank = q * count
+        cumulative = 0
+        for i, bucket_count in enumerate(counts):
+            if cumulative + bucket_count >= rank and bucket_count:
+                if i == len(self.buckets):
+                    return maximum
+                lower = self.buckets[i - 1] if i else 0.0
+                return min(maximum, lower + (self.buckets[i] - lower) * (rank - cumulative) / bucket_count)
+            cumulative += bucket_count
+        return maximum
+
+    def samples(self):
+        for labels, (counts, total, count, _) in sorted(self.state().items()):
+            pairs = list(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                yield self.name + '_bucket', pairs + [('le', '+Inf' if bound == float('inf') else repr(bound))], \
+                    cumulative
+            yield self.name + '_sum', pairs, total
+            yield self.name + '_count', pairs, count
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def state(self):
+        return {name: metric.state() for name, metric in self.metrics.items() if not isinstance(metric, Gauge)}
+
+    def merge(self, state):
+        for name, metric_state in state.items():
+            if name in self.metrics:
+                self.metrics[name].merge(metric_state)
+
+    def reset(self):
+        for metric in self.metrics.values():
+            if not isinstance(metric, Gauge):
+                metric.reset()
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'rag_stage_seconds', "Latency of pipeline stages (parse, chunk, encode, search, prompt, llm)", ('stage',)))
+STAGE_ITEMS = REGISTRY.register(Counter(
+    'rag_stage_items', "Items processed by pipeline stages (files, chunks, texts, tokens)", ('stage',)))
+STAGE_ERRORS = REGISTRY.register(Counter('rag_stage_errors', "Failures of pipeline stages", ('stage',)))
+
+
+def observe(stage, seconds, count=1):
+    STAGE_SECONDS.observe(seconds, (stage,), count)
+
+
+def count(stage, amount=1):
+    STAGE_ITEMS.inc(amount, (stage,))
+
+
+def error(stage):
+    STAGE_ERRORS.inc(1, (stage,))
+
+
+def gauge(name, documentation, callback):
+    return REGISTRY.register(Gauge(name, documentation, callback))
+
+
+def counter(name, documentation, callback):
+    """导出为 Prometheus counter（样本名带 _total 后缀），callback 返回的值必须只增不减。"""
+    return REGISTRY.register(CallbackCounter(name, documentation, callback))
+
+
+class _Timing:
+    seconds = None
+
+
+@contextmanager
+def timer(stage):
+    """统计代码块的耗时，退出后 .seconds 为本次耗时；开启剖析时同时采集该阶段的剖析数据。"""
+    timing = _Timing()
+    profile = _profiler.enter(stage) if _profiler is not None else None
+    start_time = time.perf_counter()
+    try:
+        yield timing
+    finally:
+        timing.seconds = time.perf_counter() - start_time
+        if profile is not None:
+            _profiler.exit(profile)
+        observe(stage, timing.seconds)
+
+
+def run_collected(function, *args):
+    """在进程池的工作进程中执行 function，连同这次调用产生的指标一起返回，由主进程 merge_collected。"""
+    REGISTRY.reset()
+    return function(*args), REGISTRY.state()
+
+
+def merge_collected(state):
+    REGISTRY.merge(state)
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_prometheus(registry=REGISTRY):
+    """Prometheus 文本格式（0.0.4）。"""
+    lines = []
+    for metric in registry.metrics.values():
+        if isinstance(metric, Histogram):
+            kind = 'histogram'
+        elif isinstance(metric, Gauge) and not isinstance(metric, CallbackCounter):
+            kind = 'gauge'
+        else:
+            kind = 'counter'
+        # 0.0.4 文本格式中 counter 的元数据要写在实际的样本名（带 _total 后缀）上
+        family = metric.name + '_total' if kind == 'counter' else metric.name
+        lines.append(f"# HELP {family} {metric.documentation}")
+        lines.append(f"# TYPE {family} {kind}")
+        for name, pairs, value in metric.samples():
+            lines.append(f"{name}{_format_labels(pairs)} {value:.17g}" if isinstance(value, float)
+                         else f"{name}{_format_labels(pairs)} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+def summary():
+    """各阶段的 {阶段: {count, total_seconds, mean_ms, p50_ms, p95_ms, p99_ms, items, errors}}。"""
+    result = {}
+    for (stage,), (_, total, observations, _) in sorted(STAGE_SECONDS.state().items()):
+        if not observations:
+            continue
+        result[stage] = {
+            'count': observations,
+            'total_seconds': total,
+            'mean_ms': total / observations * 1000,
+            'p50_ms': STAGE_SECONDS.quantile(0.5, (stage,)) * 1000,
+            'p95_ms': STAGE_SECONDS.quantile(0.95, (stage,)) * 1000,
+            'p99_ms': STAGE_SECONDS.quantile(0.99, (stage,)) * 1000,
+        }
+    for (stage,), value in STAGE_ITEMS.state().items():
+        result.setdefault(stage, {})['items'] = value
+    for (stage,), value in STAGE_ERRORS.state().items():
+        result.setdefault(stage, {})['errors'] = value
+    return result
+
+
+def format_summary():
+    lines = [f"{'stage':<24} {'count':>8} {'total s':>10} {'mean ms':>10} {'p50 ms':>10} {'p95 ms':>10} "
+             f"{'items':>10}"]
+    for stage, values in summary().items():
+        lines.append(f"{stage:<24} {values.get('count', 0):>8} {values.get('total_seconds', 0):>10.3f} "
+                     f"{values.get('mean_ms', 0):>10.2f} {values.get('p50_ms', 0):>10.2f} "
+                     f"{values.get('p95_ms', 0):>10.2f} {values.get('items', ''):>10}")
+    return '\n'.join(lines)
+
+
+def dump(path=None):
+    """CLI 脚本退出时调用：给定 path 时写入 Prometheus 文本，否则把各阶段汇总写入日志。"""
+    if path:
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(render_prometheus())
+        logging.info(f"Metrics written to {path}")
+    else:
+        logging.info("Stage timings:\n" + format_summary())
+    write_profiles()
+
+
+class CProfileHooks:
+    """每个阶段一个 cProfile.Profile。同一时刻只能有一个剖析器处于开启状态，
+    嵌套的阶段或其他线程中同时运行的阶段不重复采集。"""
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.profiles = {}
+        self._lock = threading.Lock()
+
+    def enter(self, stage):
+        if self.stages and stage not in self.stages or not self._lock.acquire(blocking=False):
+            return None
+        profile = self.profiles.setdefault(stage, cProfile.Profile())
+        profile.enable()
+        return profile
+
+    def exit(self, profile):
+        profile.disable()
+        self._lock.release()
+
+    def write(self, directory):
+        for stage, profile in self.profiles.items():
+            profile.dump_stats(os.path.join(directory, f"{stage}.prof"))
+
+
+class SamplingHooks:
+    """后台线程定期采样处于被剖析阶段中的线程的调用栈，输出 flamegraph.pl 可用的折叠栈格式。
+    开销与被剖析代码的调用次数无关，适合在服务中长期开启。"""
+
+    def __init__(self, stages, interval=SAMPLING_INTERVAL):
+        self.stages = stages
+        self.interval = interval
+        self.samples = {}
+        self._active = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def enter(self, stage):
+        if self.stages and stage not in self.stages:
+            return None
+        ident = threading.get_ident()
+        with self._lock:
+            previous = self._active.get(ident)
+            self._active[ident] = stage
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+                self._thread.start()
+        return ident, previous
+
+    def exit(self, token):
+        ident, previous = token
+        with self._lock:
+            if previous is None:
+                self._active.pop(ident, None)
+            else:
+                self._active[ident] = previous
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                active = dict(self._active)
+            if not active:
+                continue
+            frames = sys._current_frames()
+            for ident, stage in active.items():
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                if stack:
+                    with self._lock:
+                        self.samples.setdefault(stage, _Counter())[';'.join(reversed(stack))] += 1
+
+    def write(self, directory):
+        with self._lock:
+            samples = {stage: dict(stacks) for stage, stacks in self.samples.items()}
+        for stage, stacks in samples.items():
+            with open(os.path.join(directory, f"{stage}.folded"), 'w', encoding='utf-8') as f:
+                for stack, hits in sorted(stacks.items()):
+                    f.write(f"{stack} {hits}\n")
+
+
+_profiler = None
+
+
+def enable_profiling(mode, stages=(), interval=SAMPLING_INTERVAL):
+    """mode 为 'cprofile' 或 'sampling'，stages 为空时剖析所有阶段。只作用于当前进程。"""
+    global _profiler
+    stages = set(stages)
+    if mode == 'cprofile':
+        _profiler = CProfileHooks(stages)
+    elif mode == 'sampling':
+        _profiler = SamplingHooks(stages, interval)
+    elif mode:
+        raise ValueError(f"Unknown profiling mode: {mode}")
+    else:
+        _profiler = None
+
+
+def write_profiles(directory=None):
+    if _profiler is None:
+        return
+    directory = directory or PROFILE_DIR
+    os.makedirs(directory, exist_ok=True)
+    _profiler.write(directory)
+    logging.info(f"Profiles written to {directory}")
+
+
+enable_profiling(PROFILE_MODE, [stage for stage in PROFILE_STAGES.split(',') if stage])
@@ -1,49 +1,203 @@
+import argparse
+import glob
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
 import nltk
 from nltk.tokenize import sent_tokenize
-from transformers import pipeline
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import pairwise_distances_argmin
 import numpy as np
 
-# 下载必要的NLTK数据
-nltk.download('punkt', quiet=True)
+logging.basicConfig(level=logging.INFO)
 
-# 初始化模型
-summarizer = pipeline("summarization", model="facebook/bart-large-cnn", device="mps")
+SUMMARIZER_MODEL = "facebook/bart-large-cnn"
+SUMMARIZER_DEVICE = "mps"
 
+# 摘要模型在第一次生成摘要时才加载，导入本模块不会加载模型
+summarizer = None
+punkt_ready = False
 
-def extract_topics_and_key_sentences(text, num_topics=3):
-    # 使用BART模型进行摘要生成
-    summary = summarizer(text, max_length=130, min_length=30, do_sample=False)[0]['summary_text']
 
-    # 将文本分割成句子
-    sentences = sent_tokenize(text)
+def get_summarizer():
+    global summarizer
+    if summarizer is None:
+        from transformers import pipeline
+        summarizer = pipeline("summarization", model=SUMMARIZER_MODEL, device=SUMMARIZER_DEVICE)
+    return summarizer
 
-    # 使用TF-IDF向量化句子
-    vectorizer = TfidfVectorizer(stop_words='english')
-    sentence_vectors = vectorizer.fit_transform(sentences)
 
-    # 使用K-means聚类来提取主题
-    kmeans = KMeans(n_clusters=num_topics)
+def split_sentences(text):
+    # 第一次分句时才下载必要的NLTK数据
+    global punkt_ready
+    if not punkt_ready:
+        nltk.download('punkt', quiet=True)
+        punkt_ready = True
+    return sent_tokenize(text)
+
+
+def warmup():
+    """预加载摘要模型和分句数据，用于对首次调用延迟敏感的场景。"""
+    text = "Models are loaded on first use. Warming up loads them before the first request."
+    get_summarizer()(text, max_length=20, min_length=5, do_sample=False)
+    split_sentences(text)
+
+
+# 摘要长度，以及 BART 单次输入的 token 上限（1024）减去特殊 token 后留出余量的分块大小
+SUMMARY_MAX_LENGTH = 130
+SUMMARY_MIN_LENGTH = 30
+SUMMARY_CHUNK_TOKENS = 900
+# 批量处理时一次送入摘要模型的文档数
+SUMMARY_BATCH_SIZE = 8
+
+# 各种图使用的簇数：思维导图的主题数、流程图的要点数和时序图的要点数
+NUM_TOPICS = 3
+NUM_KEY_POINTS = 5
+NUM_SEQUENCE_POINTS = 4
+
+# 句子数超过这个值时改用 MiniBatchKMeans，每次迭代只用一小批句子更新簇中心
+MINIBATCH_THRESHOLD = 10000
+MINIBATCH_SIZE = 1024
+
+# 批量生成时读取的文档类型，以及每篇文档预先计算的簇数
+DOCUMENT_PATTERNS = ('*.md', '*.txt')
+DIAGRAM_CLUSTERS = (NUM_TOPICS, NUM_KEY_POINTS, NUM_SEQUENCE_POINTS)
+
+
+def _count_tokens(tokenizer, text):
+    return len(tokenizer(text, add_special_tokens=False)['input_ids'])
+
+
+def _chunk_sentences(tokenizer, sentences, max_tokens=SUMMARY_CHUNK_TOKENS):
+    """把句子按顺序装进不超过 max_tokens 的块，单个超长的句子按 token 切开。"""
+    chunks = []
+    current, current_tokens = [], 0
+    for sentence in sentences:
+        ids = tokenizer(sentence, add_special_tokens=False)['input_ids']
+        if len(ids) > max_tokens:
+            pieces = [(tokenizer.decode(ids[i:i + max_tokens]), len(ids[i:i + max_tokens]))
+                      for i in range(0, len(ids), max_tokens)]
+        else:
+            pieces = [(sentence, len(ids))]
+        for piece, tokens in pieces:
+            if current and current_tokens + tokens > max_tokens:
+                chunks.append(' '.join(current))
+                current, current_tokens = [], 0
+            current.append(piece)
+            current_tokens += tokens
+    if current:
+        chunks.append(' '.join(current))
+    return chunks
+
+
+def summarize(text, sentences=None, max_length=SUMMARY_MAX_LENGTH, min_length=SUMMARY_MIN_LENGTH):
+    """生成摘要。超过模型输入上限的长文档按句子分块，先分别摘要（map），再对拼接起来的
+    分块摘要继续摘要（reduce），直到能放进一次输入，而不是截断或报错。"""
+    summarizer = get_summarizer()
+    tokenizer = summarizer.tokenizer
+    sentences = sentences if sentences is not None else split_sentences(text)
+    while _count_tokens(tokenizer, text) > SUMMARY_CHUNK_TOKENS:
+        chunks = _chunk_sentences(tokenizer, sentences)
+        partial = summarizer(chunks, max_length=max_length, min_length=min_length, do_sample=False, truncation=True)
+        text = ' '.join(result['summary_text'] for result in partial)
+        sentences = split_sentences(text)
+        if len(chunks) == 1:
+            return text
+    return summarizer(text, max_length=max_length, min_length=min_length, do_sample=False,
+                      truncation=True)[0]['summary_text']
+
+
+class DocumentAnalysis:
+    """一篇文档的分析结果：句子、摘要、TF-IDF 矩阵和各簇数下的聚类。
+
+    每一项在第一次用到时计算并缓存，思维导图、流程图和时序图共用同一个实例，摘要模型和
+    KMeans 对同一篇文档只运行一次。
+    """
+
+    def __init__(self, text, vectorizer=None, sentences=None):
+        """vectorizer 为多篇文档共用的、已经拟合好的 TfidfVectorizer，为空时在本文档的句子上拟合。"""
+        self.text = text
+        self.vectorizer = vectorizer
+        self._sentences = sentences
+        self._summary = None
+        self._tfidf = None
+        self._clusterings = {}
+
+    @property
+    def sentences(self):
+        if self._sentences is None:
+            self._sentences = split_sentences(self.text)
+        return self._sentences
+
+    @property
+    def summary(self):
+        if self._summary is None:
+            self._summary = summarize(self.text, self.sentences)
+        return self._summary
+
+    @property
+    def tfidf(self):
+        """(vectorizer, 句子的 TF-IDF 矩阵)。"""
+        if self._tfidf is None:
+            if self.vectorizer is not None:
+                self._tfidf = self.vectorizer, self.vectorizer.transform(self.sentences)
+            else:
+                vectorizer = TfidfVectorizer(stop_words='english')
+                self._tfidf = vectorizer, vectorizer.fit_transform(self.sentences)
+        return self._tfidf
+
+    def closest_sentences(self, n_clusters):
+        """K-means 聚类后离每个簇中心最近的句子的下标，簇数不超过句子数。"""
+        n_clusters = min(n_clusters, len(self.sentences))
+        if n_clusters not in self._clusterings:
+            self._clusterings[n_clusters] = closest_to_centers(self.tfidf[1], n_clusters)
+        return self._clusterings[n_clusters]
+
+    def key_points(self, num_points=NUM_KEY_POINTS):
+        return [self.sentences[i] for i in self.closest_sentences(num_points)]
+
+    def topics_and_key_sentences(self, num_topics=NUM_TOPICS):
+        # 找出每个簇的中心句子作为主题
+        closest = self.closest_sentences(num_topics)
+        topics = [self.sentences[i] for i in closest]
+        if not closest:
+            return topics, []
+
+        # 选择与主题最相似的句子作为关键句子；主题本身就是矩阵中的行，一次稀疏矩阵乘法算出全部相似度
+        _, sentence_vectors = self.tfidf
+        similarities = (sentence_vectors @ sentence_vectors[closest].T).toarray()
+        key_sentences = [self.sentences[i] for i in np.argmax(similarities, axis=0)]
+        return topics, key_sentences
+
+
+def make_kmeans(n_clusters, n_samples):
+    if n_samples > MINIBATCH_THRESHOLD:
+        return MiniBatchKMeans(n_clusters=n_clusters, batch_size=MINIBATCH_SIZE, n_init=3)
+    return KMeans(n_clusters=n_clusters)
+
+
+def closest_to_centers(sentence_vectors, n_clusters):
+    """K-means 聚类，返回离每个簇中心最近的句子的下标。
+
+    距离由 pairwise_distances_argmin 分块计算（|x|² - 2x·c + |c|²），稀疏的 TF-IDF 矩阵不会被转成稠密矩阵。
+    """
+    if not n_clusters:
+        return []
+    kmeans = make_kmeans(n_clusters, sentence_vectors.shape[0])
     kmeans.fit(sentence_vectors)
+    return [int(i) for i in pairwise_distances_argmin(kmeans.cluster_centers_, sentence_vectors)]
 
-    # 找出每个簇的中心句子作为主题
-    closest_indices = []
-    for i in range(num_topics):
-        distances = np.linalg.norm(sentence_vectors - kmeans.cluster_centers_[i], axis=1)
-        closest_index = np.argmin(distances)
-        closest_indices.append(closest_index)
 
-    topics = [sentences[i] for i in closest_indices]
+def analyze(document):
+    """document 为文本或已有的 DocumentAnalysis，后者原样返回，以便多个生成函数共用分析结果。"""
+    return document if isinstance(document, DocumentAnalysis) else DocumentAnalysis(document)
 
-    # 选择与主题最相似的句子作为关键句子
-    key_sentences = []
-    for topic in topics:
-        similarities = sentence_vectors.dot(vectorizer.transform([topic]).T).toarray().flatten()
-        key_sentence_index = np.argmax(similarities)
-        key_sentences.append(sentences[key_sentence_index])
 
-    return topics, key_sentences, summary
+def extract_topics_and_key_sentences(document, num_topics=NUM_TOPICS):
+    analysis = analyze(document)
+    topics, key_sentences = analysis.topics_and_key_sentences(num_topics)
+    return topics, key_sentences, analysis.summary
 
 
 def clean_text_for_mermaid(text):
@@ -54,9 +208,9 @@ def clean_text_for_mermaid(text):
     return cleaned
 
 
-def generate_mindmap_mermaid(text):
+def generate_mindmap_mermaid(document):
     # 提取主题、关键句子和摘要
-    topics, key_sentences, summary = extract_topics_and_key_sentences(text)
+    topics, key_sentences, summary = extract_topics_and_key_sentences(document)
 
     # 生成正确的Mermaid语法的思维导图
     mermaid_syntax = ["```mermaid", "mindmap"]
@@ -73,26 +227,14 @@ def generate_mindmap_mermaid(text):
     return "\n".join(mermaid_syntax)
 
 
-def extract_key_points(text, num_points=5):
-    sentences = sent_tokenize(text)
-    vectorizer = TfidfVectorizer(stop_words='english')
-    sentence_vectors = vectorizer.fit_transform(sentences)
-
-    kmeans = KMeans(n_clusters=num_points)
-    kmeans.fit(sentence_vectors)
+def extract_key_points(document, num_points=NUM_KEY_POINTS):
+    return analyze(document).key_points(num_points)
 
-    closest_indices = []
-    for i in range(num_points):
-        distances = np.linalg.norm(sentence_vectors - kmeans.cluster_centers_[i], axis=1)
-        closest_index = np.argmin(distances)
-        closest_indices.append(closest_index)
 
-    key_points = [sentences[i] for i in closest_indices]
-    return key_points
-
-def generate_flowchart(text):
-    summary = summarizer(text, max_length=130, min_length=30, do_sample=False)[0]['summary_text']
-    key_points = extract_key_points(text)
+def generate_flowchart(document):
+    analysis = analyze(document)
+    summary = analysis.summary
+    key_points = analysis.key_points()
 
     mermaid_syntax = ["```mermaid", "flowchart TD"]
     mermaid_syntax.append(f"    A[{clean_text_for_mermaid(summary)}]")
@@ -104,8 +246,8 @@ def generate_flowchart(text):
     return "\n".join(mermaid_syntax)
 
 
-def generate_sequence_diagram(text):
-    key_points = extract_key_points(text, num_points=4)  # 减少点数以简化时序图
+def generate_sequence_diagram(document):
+    key_points = extract_key_points(document, num_points=NUM_SEQUENCE_POINTS)  # 减少点数以简化时序图
 
     mermaid_syntax = ["```mermaid", "sequenceDiagram"]
     mermaid_syntax.append("    participant Human")
@@ -120,6 +262,99 @@ def generate_sequence_diagram(text):
     mermaid_syntax.append("```")
     return "\n".join(mermaid_syntax)
 
+
+def generate_diagrams(document):
+    """生成三种图，共用一次文档分析。"""
+    analysis = analyze(document)
+    return {
+        'mindmap': generate_mindmap_mermaid(analysis),
+        'flowchart': generate_flowchart(analysis),
+        'sequence': generate_sequence_diagram(analysis),
+    }
+
+
+def _cluster_document(sentence_vectors):
+    # 在工作进程中执行，一次算出三种图需要的聚类
+    n_sentences = sentence_vectors.shape[0]
+    return {min(n, n_sentences): closest_to_centers(sentence_vectors, min(n, n_sentences)) for n in DIAGRAM_CLUSTERS}
+
+
+def summarize_documents(analyses):
+    """放得进一次输入的文档按 SUMMARY_BATCH_SIZE 成批送入摘要模型，更长的文档各自做 map-reduce。"""
+    summarizer = get_summarizer()
+    short = [analysis for analysis in analyses if analysis._summary is None
+             and _count_tokens(summarizer.tokenizer, analysis.text) <= SUMMARY_CHUNK_TOKENS]
+    if short:
+        results = summarizer([analysis.text for analysis in short], max_length=SUMMARY_MAX_LENGTH,
+                             min_length=SUMMARY_MIN_LENGTH, do_sample=False, truncation=True,
+                             batch_size=SUMMARY_BATCH_SIZE)
+        for analysis, result in zip(short, results):
+            analysis._summary = result['summary_text']
+    for analysis in analyses:
+        analysis.summary
+
+
+def analyze_documents(texts, max_workers=None):
+    """批量分析多篇文档，返回与 texts 对齐的 DocumentAnalysis。
+
+    分句和聚类在进程池中并行；所有文档共用一个在全部句子上拟合的 TfidfVectorizer，词表和 IDF
+    只计算一次，各文档的主题也按同一套词权重挑选；摘要在主进程中成批生成，模型只加载一次。
+    所有句子都只有停用词时没有可用的词表，各文档不提取主题和要点，只生成摘要。
+    """
+    if not texts:
+        return []
+    # 在主进程中准备好分句数据，工作进程不用各自下载
+    split_sentences("")
+    with ProcessPoolExecutor(max_workers) as executor:
+        sentence_lists = list(executor.map(split_sentences, texts))
+        vectorizer = TfidfVectorizer(stop_words='english')
+        try:
+            vectorizer.fit([sentence for sentences in sentence_lists for sentence in sentences])
+        except ValueError as e:
+            logging.warning(f"Skipping topic extraction: {e}")
+            vectorizer = None
+        analyses = [DocumentAnalysis(text, vectorizer, sentences) for text, sentences in zip(texts, sentence_lists)]
+        if vectorizer is None:
+            for analysis in analyses:
+                analysis._clusterings.update((min(n, len(analysis.sentences)), []) for n in DIAGRAM_CLUSTERS)
+        else:
+            for analysis, clusterings in zip(analyses, executor.map(_cluster_document,
+                                                                    [analysis.tfidf[1] for analysis in analyses])):
+                analysis._clusterings.update(clusterings)
+    summarize_documents(analyses)
+    return analyses
+
+
+def generate_folder(input_dir, output_dir, patterns=DOCUMENT_PATTERNS, max_workers=None):
+    """为 input_dir 下（含子目录）的每篇文档生成三种图，写到 output_dir 中对应的 .mermaid.md 文件。"""
+    output_prefix = os.path.join(os.path.abspath(output_dir), '')
+    paths = sorted({path for pattern in patterns
+                    for path in glob.glob(os.path.join(input_dir, '**', pattern), recursive=True)
+                    if not os.path.abspath(path).startswith(output_prefix)})
+    documents = []
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+        if text.strip():
+            documents.append((path, text))
+    logging.info(f"Generating diagrams for {len(documents)} documents in {input_dir}")
+    if not documents:
+        return []
+
+    analyses = analyze_documents([text for _, text in documents], max_workers)
+    outputs = []
+    for (path, _), analysis in zip(documents, analyses):
+        relative_path = os.path.relpath(path, input_dir)
+        output_path = os.path.join(output_dir, os.path.splitext(relative_path)[0] + '.mermaid.md')
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        diagrams = generate_diagrams(analysis)
+        with open(output_path, 'w', encoding='utf-8') as f:
+            f.write(f"# {relative_path}\n\n## Mind Map\n\n{diagrams['mindmap']}\n\n"
+                    f"## Flowchart\n\n{diagrams['flowchart']}\n\n## Sequence Diagram\n\n{diagrams['sequence']}\n")
+        outputs.append(output_path)
+    return outputs
+
+
 # 示例使用
 sample_text = """
 Artificial intelligence (AI) is intelligence demonstrated by machines, as opposed to natural intelligence displayed by animals including humans. AI research has been defined as the field of study of intelligent agents, which refers to any system that perceives its environment and takes actions that maximize its chance of achieving its goals.
@@ -127,11 +362,22 @@ The term "artificial intelligence" had previously been used to describe machines
 AI applications include advanced web search engines, recommendation systems, understanding human speech, self-driving cars, automated decision-making and competing at the highest level in strategic game systems. As machines become increasingly capable, tasks considered to require "intelligence" are often removed from the definition of AI, a phenomenon known as the AI effect. For instance, optical character recognition is frequently excluded from things considered to be AI, having become a routine technology.
 """
 
-mermaid_mindmap = generate_mindmap_mermaid(sample_text)
-print(mermaid_mindmap)
-
-
-print("Flowchart:")
-print(generate_flowchart(sample_text))
-print("\nSequence Diagram:")
-print(generate_sequence_diagram(sample_text))
\ No newline at end of file
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Generate Mermaid diagrams for documents")
+    arg_parser.add_argument('input_dir', nargs='?', help="folder of .md/.txt documents; omit to run the example")
+    arg_parser.add_argument('--output', default='diagrams')
+    arg_parser.add_argument('--workers', type=int)
+    args = arg_parser.parse_args()
+    if args.input_dir:
+        for output_path in generate_folder(args.input_dir, args.output, max_workers=args.workers):
+            print(output_path)
+        raise SystemExit
+
+    diagrams = generate_diagrams(sample_text)
+    print(diagrams['mindmap'])
+
+
+    print("Flowchart:")
+    print(diagrams['flowchart'])
+    print("\nSequence Diagram:")
+    print(diagrams['sequence'])
@@ -0,0 +1,98 @@
+import logging
+import threading
+import metrics
+
+# 各脚本使用的模型。模型在第一次 get() 时才加载，同一进程中的所有入口共享同一个实例；
+# 依赖库（sentence_transformers、transformers 及其依赖的 torch）也在加载时才导入
+SENTENCE_ENCODER_MODEL = 'all-MiniLM-L6-v2'
+GRAPH_ENCODER_MODEL = 'microsoft/graphcodebert-base'
+CAUSAL_LM_MODEL = 'gpt2'
+
+SENTENCE_ENCODER = 'sentence_encoder'
+GRAPH_ENCODER = 'graph_encoder'
+CAUSAL_LM = 'causal_lm'
+
+_loaders = {}
+_models = {}
+_locks = {}
+_lock = threading.Lock()
+
+
+def register(name, loader, warm=None):
+    """登记模型。loader() 返回模型对象；warm(model) 在预热时做一次推理，完成惰性初始化。"""
+    with _lock:
+        _loaders[name] = (loader, warm)
+        _locks.setdefault(name, threading.Lock())
+
+
+def get(name):
+    """返回已加载的模型，第一次调用时加载。并发的首次调用只会加载一次。"""
+    model = _models.get(name)
+    if model is not None:
+        return model
+    with _lock:
+        if name not in _loaders:
+            raise KeyError(f"Unknown model: {name}")
+        loader, _ = _loaders[name]
+        lock = _locks[name]
+    with lock:
+        model = _models.get(name)
+        if model is None:
+            logging.info(f"Loading model {name}...")
+            with metrics.timer('model_load') as timing:
+                model = loader()
+            logging.info(f"Loaded model {name} in {timing.seconds:.2f} seconds")
+            _models[name] = model
+    return model
+
+
+def warmup(names=None):
+    """加载并预热模型，用于对首个请求延迟敏感的服务。names 为空时预热所有已登记的模型。"""
+    for name in names or sorted(_loaders):
+        model = get(name)
+        warm = _loaders[name][1]
+        if warm is not None:
+            with metrics.timer('model_warmup'):
+                warm(model)
+
+
+def _load_sentence_encoder():
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(SENTENCE_ENCODER_MODEL)
+
+
+def _load_graph_encoder():
+    from transformers import RobertaTokenizer, RobertaModel
+    tokenizer = RobertaTokenizer.from_pretrained(GRAPH_ENCODER_MODEL)
+    return tokenizer, RobertaModel.from_pretrained(GRAPH_ENCODER_MODEL)
+
+
+def _load_causal_lm():
+    from transformers import AutoTokenizer, AutoModelForCausalLM
+    return AutoTokenizer.from_pretrained(CAUSAL_LM_MODEL), AutoModelForCausalLM.from_pretrained(CAUSAL_LM_MODEL)
+
+
+def _warm_transformer(pair):
+    import torch
+    tokenizer, model = pair
+    with torch.no_grad():
+        model(**tokenizer("warmup", return_tensors="pt"))
+
+
+register(SENTENCE_ENCODER, _load_sentence_encoder, lambda encoder: encoder.encode(["warmup"]))
+register(GRAPH_ENCODER, _load_graph_encoder, _warm_transformer)
+register(CAUSAL_LM, _load_causal_lm, _warm_transformer)
+
+
+def sentence_encoder():
+    return get(SENTENCE_ENCODER)
+
+
+def graph_encoder():
+    """返回 (tokenizer, model)。"""
+    return get(GRAPH_ENCODER)
+
+
+def causal_lm():
+    """返回 (tokenizer, model)。"""
+    return get(CAUSAL_LM)
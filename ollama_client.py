@@ -0,0 +1,216 @@
+import json
+import logging
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+import metrics
+
+DEFAULT_BASE_URL = "http://localhost:11434"
+DEFAULT_MODEL = "llama3.1"
+
+# 连接超时和两次读取之间的超时（秒）；首个 token 之前模型要完成 prefill，读取超时要留足余量
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 300
+
+
+class OllamaError(RuntimeError):
+    pass
+
+
+class GenerationStats:
+    """单次生成的耗时统计，时间单位为秒。"""
+
+    def __init__(self):
+        self.time_to_first_token = None
+        self.total_time = None
+        self.tokens = 0
+        self.prompt_tokens = None
+        self.prompt_eval_time = None
+        self.eval_time = None
+        self.cancelled = False
+        # Ollama 返回的对话状态，可在下一次请求中传回以复用已计算的上下文
+        self.context = None
+
+    @property
+    def tokens_per_second(self):
+        # 优先使用 Ollama 自己统计的解码耗时，没有时用首 token 之后的墙钟时间估算
+        if self.eval_time:
+            return self.tokens / self.eval_time
+        if self.total_time and self.time_to_first_token is not None and self.tokens > 1:
+            return (self.tokens - 1) / (self.total_time - self.time_to_first_token)
+        return None
+
+    def as_dict(self):
+        return {
+            'time_to_first_token': self.time_to_first_token,
+            'total_time': self.total_time,
+            'tokens': self.tokens,
+            'tokens_per_second': self.tokens_per_second,
+            'prompt_tokens': self.prompt_tokens,
+            'prompt_eval_time': self.prompt_eval_time,
+            'cancelled': self.cancelled,
+        }
+
+
+class Generation:
+    """一次流式生成。迭代得到逐个到达的文本片段，结束后 stats 中有完整统计。
+
+    cancel() 可以在其他线程调用，会关闭底层连接，Ollama 随之停止生成。total_timeout 由定时器在到期时
+    关闭连接来保证，即使读取阻塞在一行还没到达的输出上也会按时结束并抛出 OllamaError。
+    """
+
+    def __init__(self, client, payload, total_timeout=None):
+        self.client = client
+        self.payload = payload
+        self.total_timeout = total_timeout
+        self.stats = GenerationStats()
+        self._cancelled = threading.Event()
+        self._timed_out = threading.Event()
+        self._response = None
+
+    def cancel(self):
+        self._cancelled.set()
+        self.stats.cancelled = True
+        if self._response is not None:
+            self._response.close()
+
+    def _expire(self):
+        self._timed_out.set()
+        if self._response is not None:
+            self._response.close()
+
+    def _timeout_error(self):
+        return OllamaError(f"Ollama generation exceeded {self.total_timeout} seconds")
+
+    def text(self):
+        return ''.join(self)
+
+    def __iter__(self):
+        if self._cancelled.is_set():
+            return
+        start_time = time.perf_counter()
+        read_timeout = self.client.read_timeout
+        if self.total_timeout is not None:
+            read_timeout = min(read_timeout, self.total_timeout)
+        try:
+            response = self.client.session.post(self.client.base_url + "/api/generate", json=self.payload,
+                                                stream=True, timeout=(self.client.connect_timeout, read_timeout))
+        except requests.RequestException as e:
+            metrics.error('llm_total')
+            raise OllamaError(f"Error connecting to Ollama: {e}") from e
+
+        self._response = response
+        timer = None
+        if self.total_timeout is not None:
+            timer = threading.Timer(max(0.0, self.total_timeout - (time.perf_counter() - start_time)), self._expire)
+            timer.daemon = True
+            timer.start()
+        try:
+            if response.status_code != 200:
+                raise OllamaError(f"Error querying Ollama: {response.status_code}, {response.text}")
+
+            for line in response.iter_lines():
+                if self._cancelled.is_set():
+                    break
+                if self._timed_out.is_set():
+                    raise self._timeout_error()
+                if not line:
+                    continue
+
+                message = json.loads(line)
+                if 'error' in message:
+                    raise OllamaError(f"Error querying Ollama: {message['error']}")
+
+                token = message.get('response', '')
+                if token:
+                    if self.stats.time_to_first_token is None:
+                        self.stats.time_to_first_token = time.perf_counter() - start_time
+                    self.stats.tokens += 1
+                    yield token
+
+                if message.get('done'):
+                    self._finish(message)
+                    break
+            else:
+                # 定时器关闭连接后 iter_lines 也可能直接结束而不抛出异常
+                if self._timed_out.is_set() and not self._cancelled.is_set():
+                    raise self._timeout_error()
+        except OllamaError:
+            metrics.error('llm_total')
+            raise
+        except Exception as e:
+            # 其他线程调用 cancel() 关闭连接时，阻塞中的读取会抛出异常，属于正常结束
+            if self._cancelled.is_set():
+                return
+            metrics.error('llm_total')
+            if self._timed_out.is_set():
+                raise self._timeout_error() from e
+            if isinstance(e, requests.RequestException):
+                raise OllamaError(f"Error reading Ollama response: {e}") from e
+            raise
+        finally:
+            if timer is not None:
+                timer.cancel()
+            response.close()
+            self.stats.total_time = time.perf_counter() - start_time
+            self.client.record(self.stats)
+
+    def _finish(self, message):
+        # Ollama 的耗时字段单位是纳秒
+        if 'eval_count' in message:
+            self.stats.tokens = message['eval_count']
+        if 'eval_duration' in message:
+            self.stats.eval_time = message['eval_duration'] / 1e9
+        if 'prompt_eval_count' in message:
+            self.stats.prompt_tokens = message['prompt_eval_count']
+        if 'prompt_eval_duration' in message:
+            self.stats.prompt_eval_time = message['prompt_eval_duration'] / 1e9
+        self.stats.context = message.get('context')
+
+
+class OllamaClient:
+    """复用连接池的 Ollama 客户端，以 NDJSON 流的方式接收生成结果。"""
+
+    def __init__(self, base_url=DEFAULT_BASE_URL, model=DEFAULT_MODEL, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, pool_size=10):
+        self.base_url = base_url.rstrip('/')
+        self.model = model
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.last_stats = None
+
+    def stream(self, prompt, model=None, context=None, options=None, total_timeout=None):
+        payload = {
+            "model": model or self.model,
+            "prompt": prompt,
+            "stream": True,
+        }
+        if context:
+            payload["context"] = context
+        if options:
+            payload["options"] = options
+        return Generation(self, payload, total_timeout)
+
+    def generate(self, prompt, **kwargs):
+        return self.stream(prompt, **kwargs).text()
+
+    def record(self, stats):
+        self.last_stats = stats
+        metrics.observe('llm_total', stats.total_time)
+        if stats.cancelled:
+            metrics.count('llm_cancelled')
+        if stats.time_to_first_token is not None:
+            metrics.observe('llm_first_token', stats.time_to_first_token)
+            metrics.count('llm_total', stats.tokens)
+            tokens_per_second = stats.tokens_per_second
+            logging.info(f"Ollama time to first token {stats.time_to_first_token:.2f} seconds, "
+                         f"{stats.tokens} tokens in {stats.total_time:.2f} seconds"
+                         + (f" ({tokens_per_second:.1f} tokens/s)" if tokens_per_second else ""))
+
+    def close(self):
+        self.session.close()
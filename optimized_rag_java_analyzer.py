@@ -3,15 +3,19 @@ import tree_sitter_java as tsjava
 from tree_sitter import Language, Parser
 import glob
 import logging
-import requests
-import json
-from sentence_transformers import SentenceTransformer
-import faiss
 import numpy as np
-import pickle
+import shutil
 import hashlib
 from concurrent.futures import ProcessPoolExecutor
-import time
+import index_store
+import java_chunker
+import ann_index
+import embedding_cache
+from lexical_index import LexicalIndex, reciprocal_rank_fusion, weighted_score_fusion
+from ollama_client import OllamaClient, OllamaError
+import prompt_builder
+import metrics
+import model_registry
 
 # 设置日志
 logging.basicConfig(level=logging.INFO)
@@ -25,28 +29,65 @@ JAVA_LANGUAGE = Language(tsjava.language())
 parser = Parser()
 parser.set_language(JAVA_LANGUAGE)
 
-# 初始化句子编码器
-encoder = SentenceTransformer('all-MiniLM-L6-v2')
+# 代码块的 token 上限，修改后缓存会整体重建
+MAX_CHUNK_TOKENS = java_chunker.MAX_CHUNK_TOKENS
+
+# FAISS 索引类型（见 ann_index.INDEX_TYPES）、构建参数和搜索参数，
+# 例如 INDEX_TYPE = 'ivf_pq'、INDEX_PARAMS = {'nlist': 4096}、SEARCH_PARAMS = {'nprobe': 16}
+INDEX_TYPE = 'flat'
+INDEX_PARAMS = {}
+SEARCH_PARAMS = {}
+
+# 量化索引（ann_index.QUANTIZED_TYPES：'sq_fp16'、'sq8'、'pq'、'ivf_pq'）在内存中只保存压缩后的编码，
+# 检索时取回 k 的这么多倍的候选，再用 mmap 的 embeddings.npy 按精确距离重排；0 表示不重排
+RERANK_CANDIDATES = ann_index.RERANK_CANDIDATES
+
+# 检索方式：'hybrid' 融合 BM25 和向量检索，'vector' / 'lexical' 只用其中一种。
+# 融合方法 'rrf' 按排名融合，'weighted' 按归一化得分加权；LEXICAL_WEIGHT 是词法检索的权重（0~1）
+RETRIEVAL_MODE = 'hybrid'
+FUSION_METHOD = 'rrf'
+LEXICAL_WEIGHT = 0.5
+# 每一路检索取回的候选数是 k 的倍数
+FUSION_CANDIDATES = 4
+
+# 提示词中代码片段的 token 预算，以及交互式对话的上下文窗口（传给 Ollama 的 num_ctx）
+PROMPT_TOKEN_BUDGET = prompt_builder.PROMPT_TOKEN_BUDGET
+CONTEXT_WINDOW = prompt_builder.CONTEXT_WINDOW
+
+# 编码时每批的片段数，按批统计编码耗时
+ENCODE_BATCH_SIZE = 64
+
+# 交互模式退出时把指标写到这个文件（Prometheus 文本格式），未设置时只在日志中输出各阶段汇总
+METRICS_FILE = os.environ.get('RAG_METRICS_FILE')
+
+# 复用连接的 Ollama 客户端
+ollama_client = OllamaClient()
+
+
+def get_encoder():
+    # 第一次编码时才加载模型，只做解析和分块的工作进程不会加载
+    return model_registry.sentence_encoder()
 
 
 def parse_java_file(file_path):
     try:
-        with open(file_path, 'r', encoding='utf-8') as file:
-            content = file.read()
-        tree = parser.parse(bytes(content, 'utf8'))
+        with metrics.timer('parse'):
+            with open(file_path, 'r', encoding='utf-8') as file:
+                content = file.read()
+            tree = parser.parse(bytes(content, 'utf8'))
+        metrics.count('parse')
         return tree, content
     except Exception as e:
+        metrics.error('parse')
         logging.error(f"Error parsing file {file_path}: {str(e)}")
         return None, None
 
 
-def extract_code_snippets(tree, source_code):
-    snippets = []
-    for node in tree.root_node.children:
-        if node.type in ['method_declaration', 'class_declaration']:
-            snippet = source_code[node.start_byte:node.end_byte]
-            snippets.append(snippet)
-    return snippets
+def extract_code_snippets(tree, source_code, max_tokens=MAX_CHUNK_TOKENS):
+    with metrics.timer('chunk'):
+        chunks = java_chunker.chunk_java(tree, bytes(source_code, 'utf8'), max_tokens=max_tokens)
+    metrics.count('chunk', len(chunks))
+    return [chunk.text for chunk in chunks]
 
 
 def process_file(file_path):
@@ -56,110 +97,349 @@ def process_file(file_path):
     return []
 
 
-def compute_repo_hash(repo_path):
+def snippet_package(snippet):
+    """java_chunker 在片段开头写入 "// package ..."，没有包声明时返回 None。"""
+    first_line = snippet.split('\n', 1)[0]
+    return first_line[len('// package '):].strip() if first_line.startswith('// package ') else None
+
+
+def process_file_collected(file_path):
+    # 进程池中执行，连同工作进程里记录的解析和分块指标一起返回
+    return metrics.run_collected(process_file, file_path)
+
+
+def encode_texts(texts, stage='encode'):
+    """按 ENCODE_BATCH_SIZE 分批编码，记录每批的耗时和均摊到每个片段的耗时。"""
+    batches = []
+    for start in range(0, len(texts), ENCODE_BATCH_SIZE):
+        batch = texts[start:start + ENCODE_BATCH_SIZE]
+        with metrics.timer(stage + '_batch') as timing:
+            batches.append(np.asarray(get_encoder().encode(batch), dtype='float32'))
+        metrics.observe(stage + '_item', timing.seconds / len(batch), len(batch))
+        metrics.count(stage + '_batch', len(batch))
+    if not batches:
+        return np.empty((0, get_encoder().get_sentence_embedding_dimension()), dtype='float32')
+    return np.concatenate(batches)
+
+
+CACHE_DIR = 'code_index_cache'
+
+
+def compute_file_hash(file_path):
     hasher = hashlib.md5()
-    for root, _, files in os.walk(repo_path):
-        for file in files:
-            if file.endswith('.java'):
-                file_path = os.path.join(root, file)
-                hasher.update(file_path.encode())
-                with open(file_path, 'rb') as f:
-                    hasher.update(f.read())
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            hasher.update(chunk)
     return hasher.hexdigest()
 
 
-def load_or_create_index(repo_path, force_rebuild=False):
-    repo_hash = compute_repo_hash(repo_path)
-    cache_file = f'code_index_cache_{repo_hash}.pkl'
+def scan_repo(repo_path, manifest, exclude=()):
+    """对比文件清单，返回 (新清单, 新增或修改的文件, 已删除的文件)。
+
+    mtime 和 size 都没变的文件直接沿用旧记录，只有可能变化的文件才重新计算内容哈希。
+    exclude 中目录下的文件被跳过。
+    """
+    current = {}
+    changed = []
+    java_files = glob.glob(os.path.join(repo_path, "**/*.java"), recursive=True)
+    excluded = tuple(os.path.join(directory, '') for directory in exclude)
+    for file_path in java_files:
+        if excluded and file_path.startswith(excluded):
+            continue
+        stat = os.stat(file_path)
+        entry = manifest.get(file_path)
+        if entry and entry['mtime'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+            current[file_path] = entry
+            continue
+
+        file_hash = compute_file_hash(file_path)
+        if entry and entry['hash'] == file_hash:
+            # 只是 touch 过，内容没变
+            current[file_path] = dict(entry, mtime=stat.st_mtime_ns, size=stat.st_size)
+            continue
 
-    if os.path.exists(cache_file) and not force_rebuild:
+        current[file_path] = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'hash': file_hash, 'ids': []}
+        changed.append(file_path)
+
+    deleted = [file_path for file_path in manifest if file_path not in current]
+    return current, changed, deleted
+
+
+def build_index_from_embeddings(files, cache_dir=None):
+    """用 embeddings.npy 中仍然有效的向量重建索引。"""
+    live_ids = np.array(sorted(i for entry in files.values() for i in entry['ids']), dtype='int64')
+    embeddings = index_store.load_embeddings(cache_dir or CACHE_DIR)
+    logging.info(f"Building {INDEX_TYPE} index over {len(live_ids)} vectors...")
+    if embeddings is None:
+        vectors = np.empty((0, get_encoder().get_sentence_embedding_dimension()), dtype='float32')
+        return ann_index.build_index(vectors, live_ids, INDEX_TYPE, **INDEX_PARAMS)
+    # 向量 ID 就是 embeddings.npy 中的行号，按批从 mmap 中读取，不把全部 float32 向量读入内存
+    return ann_index.build_index(embeddings, index_type=INDEX_TYPE, rows=live_ids, **INDEX_PARAMS)
+
+
+def searchable_index(index, cache_dir=None):
+    """量化索引包装上精确重排，并记录相对 float32 向量节省的内存。"""
+    if not ann_index.is_quantized(index):
+        return index
+    index_bytes = ann_index.memory_bytes(index)
+    float32_bytes = ann_index.float32_bytes(index.ntotal, index.d)
+    logging.info(f"{INDEX_TYPE} index holds {index.ntotal} vectors in {index_bytes / 2 ** 20:.1f} MB "
+                 f"instead of {float32_bytes / 2 ** 20:.1f} MB as float32 "
+                 f"({1 - index_bytes / max(float32_bytes, 1):.0%} saved)")
+    return ann_index.with_reranking(index, index_store.load_embeddings(cache_dir or CACHE_DIR), RERANK_CANDIDATES)
+
+
+def load_or_create_index(repo_path, force_rebuild=False, cache_dir=None, exclude=()):
+    """加载或增量更新 repo_path 的索引，返回 (index, snippets, lexical)。
+
+    cache_dir 默认为 CACHE_DIR；exclude 中的子目录（如单独建索引的子模块）不纳入本索引。
+    """
+    cache_dir = cache_dir or CACHE_DIR
+    if force_rebuild and os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    cache_manifest = index_store.load_manifest(cache_dir)
+    if cache_manifest is not None and cache_manifest.get('max_chunk_tokens') != MAX_CHUNK_TOKENS:
+        logging.info("Chunking settings changed, discarding cached index...")
+        shutil.rmtree(cache_dir)
+        os.makedirs(cache_dir)
+        cache_manifest = None
+    if cache_manifest is None:
+        logging.info("Creating new index...")
+        cache_manifest = {'files': {}, 'next_id': 0, 'max_chunk_tokens': MAX_CHUNK_TOKENS}
+    else:
         logging.info("Loading cached index...")
-        with open(cache_file, 'rb') as f:
-            return pickle.load(f)
 
-    logging.info("Creating new index...")
-    all_snippets = []
-    java_files = glob.glob(os.path.join(repo_path, "**/*.java"), recursive=True)
+    old_files = cache_manifest['files']
+    files, changed, deleted = scan_repo(repo_path, old_files, exclude)
+
+    index_file = os.path.join(cache_dir, index_store.INDEX_FILE)
+    index_config = {'type': INDEX_TYPE, 'params': INDEX_PARAMS}
+    # 索引类型或参数变化时只需用已存储的向量重建索引，不用重新编码
+    index_changed = cache_manifest.get('index') != index_config
+    if not changed and not deleted and os.path.exists(index_file) and not index_changed:
+        if files != old_files:
+            cache_manifest['files'] = files
+            index_store.save_manifest(cache_dir, cache_manifest)
+        index = index_store.read_index(cache_dir)
+        ann_index.set_search_params(index, **SEARCH_PARAMS)
+        index = searchable_index(index, cache_dir)
+        snippets = index_store.SnippetStore(cache_dir)
+        lexical = LexicalIndex.load(cache_dir)
+        if lexical is None or len(lexical.doc_lengths) != cache_manifest['next_id']:
+            # 旧版本的缓存没有词法索引，或上次写入中断
+            lexical = LexicalIndex.build(snippets.items(), cache_manifest['next_id'])
+            lexical.save(cache_dir)
+        return index, snippets, lexical
+
+    logging.info(f"{len(changed)} files added or changed, {len(deleted)} files deleted")
+
+    # 删除已修改和已删除文件的旧向量
+    stale_ids = [i for file_path in changed + deleted if file_path in old_files
+                 for i in old_files[file_path]['ids']]
+
+    next_id = cache_manifest['next_id']
+    index = None
+    if os.path.exists(index_file) and not index_changed:
+        index = index_store.read_index(cache_dir, writable=True)
+        expected = sum(len(entry['ids']) for entry in old_files.values())
+        if index.ntotal != expected:
+            # 上次中断时写入了没有记入清单的向量
+            index = None
+        elif stale_ids:
+            if ann_index.supports_remove(index):
+                index.remove_ids(np.array(stale_ids, dtype='int64'))
+            else:
+                index = None
 
     # 使用多进程处理文件
     with ProcessPoolExecutor() as executor:
-        snippets_list = list(executor.map(process_file, java_files))
-        all_snippets = [snippet for sublist in snippets_list for snippet in sublist]
+        snippets_list = []
+        for snippets, collected in executor.map(process_file_collected, changed):
+            snippets_list.append(snippets)
+            metrics.merge_collected(collected)
+
+    first_id = next_id
+    new_snippets = []
+    new_ids = []
+    for file_path, snippets in zip(changed, snippets_list):
+        ids = list(range(next_id, next_id + len(snippets)))
+        next_id += len(snippets)
+        files[file_path]['ids'] = ids
+        files[file_path]['package'] = snippet_package(snippets[0]) if snippets else None
+        new_ids.extend(ids)
+        new_snippets.extend(snippets)
+
+    logging.info(f"Extracted {len(new_snippets)} code snippets")
+
+    index_store.update_snippets(cache_dir, stale_ids, first_id, new_snippets)
+    lexical = LexicalIndex.load(cache_dir)
+    if lexical is None or len(lexical.doc_lengths) < first_id:
+        snippet_store = index_store.SnippetStore(cache_dir)
+        lexical = LexicalIndex.build(snippet_store.items(), next_id)
+        snippet_store.close()
+    else:
+        lexical = lexical.update(stale_ids, first_id, new_snippets)
+    lexical.save(cache_dir)
+    if new_snippets:
+        # 编码代码片段，其他仓库或上次构建已经编码过的相同片段从向量缓存中取
+        embeddings = embedding_cache.encode(new_snippets, model_registry.SENTENCE_ENCODER_MODEL, encode_texts)
+        index_store.append_embeddings(cache_dir, first_id, embeddings)
+        if index is not None:
+            index.add_with_ids(embeddings, np.array(new_ids, dtype='int64'))
+
+    if index is None:
+        index = build_index_from_embeddings(files, cache_dir)
+    index_store.write_index(cache_dir, index)
+    ann_index.set_search_params(index, **SEARCH_PARAMS)
+    index = searchable_index(index, cache_dir)
+
+    # 清单最后写入，中途失败时下次会重新处理这些文件
+    cache_manifest['files'] = files
+    cache_manifest['next_id'] = next_id
+    cache_manifest['index'] = index_config
+    index_store.save_manifest(cache_dir, cache_manifest)
+
+    return index, index_store.SnippetStore(cache_dir), lexical
+
+
+def query_code(index, all_snippets, query, k=5, lexical=None):
+    # 查询就是代码中出现过的符号名时直接走词法检索，不需要向量化
+    snippets = symbol_search(lexical, all_snippets, query, k)
+    if snippets is not None:
+        return snippets
+    query_vector = encode_texts([query], 'encode_query') if RETRIEVAL_MODE != 'lexical' else None
+    return hybrid_search(index, all_snippets, lexical, query, query_vector, k)
+
+
+def symbol_search(lexical, all_snippets, query, k=5):
+    """精确符号匹配的快速路径，不适用时返回 None。"""
+    if lexical is None or RETRIEVAL_MODE == 'vector' or not lexical.exact_symbol(query):
+        return None
+    return [all_snippets[i] for i, _ in lexical_search(lexical, query, k)]
 
-    logging.info(f"Extracted {len(all_snippets)} code snippets")
 
-    # 编码代码片段
-    embeddings = encoder.encode(all_snippets)
+def lexical_search(lexical, query, k, corpus=None):
+    with metrics.timer('lexical_search'):
+        return lexical.search(query, k, corpus)
 
-    # 创建 FAISS 索引
-    dimension = embeddings.shape[1]
-    index = faiss.IndexFlatL2(dimension)
-    index.add(embeddings)
 
-    # 缓存索引
-    with open(cache_file, 'wb') as f:
-        pickle.dump((index, all_snippets), f)
+def vector_search(index, query_vector, k):
+    """返回 [(片段 ID, 得分)]，得分越大越相关。"""
+    with metrics.timer('vector_search'):
+        distances, indices = index.search(np.asarray(query_vector, dtype='float32').reshape(1, -1), k)
+    # 结果不足 k 个时 FAISS 用 -1 填充；L2 距离取负数作为得分
+    return [(int(i), -float(distance)) for distance, i in zip(distances[0], indices[0]) if i != -1]
 
-    return index, all_snippets
 
+def search_code(index, all_snippets, query_vector, k=5):
+    return [all_snippets[i] for i, _ in vector_search(index, query_vector, k)]
 
-def query_code(index, all_snippets, query, k=5):
-    query_vector = encoder.encode([query])
-    distances, indices = index.search(query_vector, k)
-    return [all_snippets[i] for i in indices[0]]
 
+def retrieval_candidates(index, lexical, query, query_vector, k=5, corpus=None):
+    """按 RETRIEVAL_MODE 取回 (词法结果, 向量结果)，各为按得分降序的 [(片段 ID, 得分)]，不用的一路为空。
 
-def query_ollama(prompt, model="llama3.1"):
-    url = "http://localhost:11434/api/generate"
-    data = {
-        "model": model,
-        "prompt": prompt,
-        "stream": False
-    }
-    response = requests.post(url, json=data)
-    if response.status_code == 200:
-        return json.loads(response.text)['response']
+    query_vector 为 None 时只走词法检索（精确符号查询）。corpus 见 LexicalIndex.search。
+    """
+    if query_vector is None:
+        return lexical_search(lexical, query, k, corpus), []
+    if lexical is None or RETRIEVAL_MODE == 'vector':
+        return [], vector_search(index, query_vector, k)
+    if RETRIEVAL_MODE == 'lexical':
+        return lexical_search(lexical, query, k, corpus), []
+    candidates = k * FUSION_CANDIDATES
+    return lexical_search(lexical, query, candidates, corpus), vector_search(index, query_vector, candidates)
+
+
+def fuse_results(lexical_results, vector_results, k=5):
+    """融合两路结果，返回前 k 个 ID。只有一路时保持它原来的顺序。"""
+    if not vector_results or not lexical_results:
+        return [i for i, _ in (lexical_results or vector_results)[:k]]
+    weights = [LEXICAL_WEIGHT, 1 - LEXICAL_WEIGHT]
+    if FUSION_METHOD == 'weighted':
+        fused = weighted_score_fusion([lexical_results, vector_results], weights)
     else:
-        logging.error(f"Error querying Ollama: {response.status_code}")
+        fused = reciprocal_rank_fusion([[i for i, _ in lexical_results], [i for i, _ in vector_results]], weights)
+    return fused[:k]
+
+
+def hybrid_search(index, all_snippets, lexical, query, query_vector, k=5):
+    lexical_results, vector_results = retrieval_candidates(index, lexical, query, query_vector, k)
+    return [all_snippets[i] for i in fuse_results(lexical_results, vector_results, k)]
+
+
+def build_prompt(query, snippets):
+    # 去掉重复和互相包含的片段，按排名装入 token 预算
+    with metrics.timer('prompt'):
+        return prompt_builder.build_prompt(query, snippets, PROMPT_TOKEN_BUDGET)
+
+
+def query_ollama(prompt, model="llama3.1"):
+    try:
+        return ollama_client.generate(prompt, model=model)
+    except OllamaError as e:
+        logging.error(str(e))
         return None
 
 
-def main():
+def main(warmup=False):
     repo_path = "./repo"
 
-    start_time = time.time()
-    index, all_snippets = load_or_create_index(repo_path)
-    logging.info(f"Index loading/creation took {time.time() - start_time:.2f} seconds")
+    with metrics.timer('index_load') as timing:
+        index, all_snippets, lexical = load_or_create_index(repo_path)
+    logging.info(f"Index loading/creation took {timing.seconds:.2f} seconds")
+    if warmup:
+        # 在第一次提问之前加载编码器，而不是在第一次查询时
+        model_registry.warmup([model_registry.SENTENCE_ENCODER])
 
+    # 追问复用 Ollama 返回的对话状态，不用重新 prefill 之前的问题和片段
+    session = prompt_builder.PromptSession(PROMPT_TOKEN_BUDGET, CONTEXT_WINDOW)
     while True:
-        query = input("Enter your query (or 'quit' to exit): ")
+        query = input("Enter your query ('reset' to start a new conversation, 'metrics' to show stage timings, "
+                      "'quit' to exit): ")
         if query.lower() == 'quit':
             break
+        if query.lower() == 'reset':
+            session.reset()
+            continue
+        if query.lower() == 'metrics':
+            print(metrics.format_summary())
+            continue
 
-        start_time = time.time()
-        relevant_snippets = query_code(index, all_snippets, query)
-        logging.info(f"Code retrieval took {time.time() - start_time:.2f} seconds")
+        with metrics.timer('retrieval') as timing:
+            relevant_snippets = query_code(index, all_snippets, query, lexical=lexical)
+        logging.info(f"Code retrieval took {timing.seconds:.2f} seconds")
 
         if not relevant_snippets:
             print("No relevant code found.")
             continue
 
         logging.info("Generating response with Ollama...")
-        prompt = f"Query: {query}\n\nRelevant code contexts:\n"
-        for i, snippet in enumerate(relevant_snippets):
-            prompt += f"\nSnippet {i + 1}:\n{snippet}\n"
-        prompt += "\nBased on the above code snippets, please provide a detailed answer to the query."
-
-        start_time = time.time()
-        response = query_ollama(prompt)
-        logging.info(f"Ollama response generation took {time.time() - start_time:.2f} seconds")
-
-        if response:
-            print("\nGenerated response:")
-            print(response)
-        else:
+        with metrics.timer('prompt'):
+            prompt = session.prompt(query, relevant_snippets)
+
+        # 边生成边输出，Ctrl-C 取消当前回答
+        print("\nGenerated response:")
+        generation = ollama_client.stream(prompt, context=session.context, options={'num_ctx': CONTEXT_WINDOW})
+        try:
+            for token in generation:
+                print(token, end='', flush=True)
+            print()
+            session.finish(generation.stats)
+        except KeyboardInterrupt:
+            generation.cancel()
+            session.reset()
+            print("\n[cancelled]")
+        except OllamaError as e:
+            logging.error(str(e))
+            session.reset()
             print("Failed to generate a response.")
 
+    metrics.dump(METRICS_FILE)
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    import sys
+
+    main(warmup='--warmup' in sys.argv[1:])
\ No newline at end of file
@@ -0,0 +1,155 @@
+from java_chunker import count_tokens
+
+# 提示词中代码片段可用的 token 预算，以及被截断的片段至少要保留的 token 数
+PROMPT_TOKEN_BUDGET = 3000
+MIN_SNIPPET_TOKENS = 64
+
+# 片段中已经出现在前面片段里的行超过这个比例时视为重复
+OVERLAP_THRESHOLD = 0.8
+# 少于这个 token 数的行（如单独的 "}"）不参与重叠判断
+MIN_OVERLAP_LINE_TOKENS = 3
+
+# 对话上下文窗口，以及为回答预留的 token 数；超过时开始新的对话
+CONTEXT_WINDOW = 8192
+ANSWER_TOKEN_RESERVE = 1024
+
+PROMPT_HEADER = "Query: {query}\n\nRelevant code contexts:\n"
+PROMPT_FOOTER = "\nBased on the above code snippets, please provide a detailed answer to the query."
+FOLLOW_UP_HEADER = "Follow-up query: {query}\n"
+FOLLOW_UP_CONTEXTS = "\nAdditional code contexts:\n"
+FOLLOW_UP_FOOTER = ("\nBased on the code snippets in this conversation, please provide a detailed answer "
+                    "to the follow-up query.")
+
+
+def _split_header(snippet):
+    """分出 java_chunker 加在片段前面的 "// package ..." 和外层类型签名注释。"""
+    lines = snippet.splitlines(keepends=True)
+    i = 0
+    while i < len(lines) and lines[i].startswith('// '):
+        i += 1
+    return ''.join(lines[:i]), ''.join(lines[i:])
+
+
+def _overlap_lines(body):
+    return {line.strip() for line in body.splitlines() if count_tokens(line) >= MIN_OVERLAP_LINE_TOKENS}
+
+
+def _truncate(snippet, budget):
+    """按行截断到 budget 个 token 以内，保留签名头，末尾标注省略。"""
+    header, body = _split_header(snippet)
+    marker = "// ...\n"
+    remaining = budget - count_tokens(header) - count_tokens(marker)
+    kept = []
+    for line in body.splitlines(keepends=True):
+        tokens = count_tokens(line)
+        if tokens > remaining:
+            break
+        kept.append(line)
+        remaining -= tokens
+    if not kept:
+        return None
+    text = header + ''.join(kept)
+    return text + ('' if text.endswith('\n') else '\n') + marker
+
+
+def select_snippets(snippets, budget=PROMPT_TOKEN_BUDGET, exclude=()):
+    """按检索排名依次挑选片段，直到用完 token 预算。
+
+    - 正文被已选片段包含的（如已选类中的某个方法）、或大部分行已经出现过的片段被跳过；
+    - 包含已选片段的更大片段被选中时，替换掉被它包含的片段；
+    - 放不下的片段在剩余预算足够时按行截断。
+    exclude 中的片段视为已经发送过，被它们包含的片段同样跳过。
+    """
+    selected = []
+    seen_lines = set()
+    excluded_bodies = [_split_header(snippet)[1] for snippet in exclude]
+    for snippet in exclude:
+        seen_lines |= _overlap_lines(_split_header(snippet)[1])
+    used = 0
+
+    for snippet in snippets:
+        header, body = _split_header(snippet)
+        if not body.strip():
+            continue
+        if any(body in other for other in excluded_bodies) or any(body in other[2] for other in selected):
+            continue
+        lines = _overlap_lines(body)
+        if lines and len(lines & seen_lines) >= OVERLAP_THRESHOLD * len(lines):
+            # 大部分行已经出现过；如果它正好包含了已选片段，后面的替换逻辑会处理
+            if not any(other[2] in body for other in selected):
+                continue
+
+        contained = [other for other in selected if other[2] in body]
+        freed = sum(other[1] for other in contained)
+        tokens = count_tokens(snippet)
+        if used - freed + tokens > budget:
+            if contained:
+                continue
+            remaining = budget - used
+            if remaining < MIN_SNIPPET_TOKENS:
+                continue
+            snippet = _truncate(snippet, remaining)
+            if snippet is None:
+                continue
+            tokens = count_tokens(snippet)
+
+        # 位置沿用第一个被替换的片段，保持排名顺序
+        position = selected.index(contained[0]) if contained else len(selected)
+        selected = [other for other in selected if other not in contained]
+        selected.insert(min(position, len(selected)), (snippet, tokens, body))
+        used += tokens - freed
+        seen_lines |= lines
+    return [snippet for snippet, _, _ in selected]
+
+
+def format_snippets(snippets, start=1):
+    return ''.join(f"\nSnippet {i}:\n{snippet}\n" for i, snippet in enumerate(snippets, start))
+
+
+def build_prompt(query, snippets, budget=PROMPT_TOKEN_BUDGET):
+    return (PROMPT_HEADER.format(query=query) + format_snippets(select_snippets(snippets, budget))
+            + PROMPT_FOOTER)
+
+
+class PromptSession:
+    """交互式对话。Ollama 返回的 context 保存了已经计算过的对话状态，追问时传回去，
+    只需要对新的问题和新增的片段做 prefill；已经发送过的片段不再重复发送。
+
+    上下文窗口快满、或者上一次生成被取消（没有返回 context）时，自动开始新的对话。
+    """
+
+    def __init__(self, budget=PROMPT_TOKEN_BUDGET, context_window=CONTEXT_WINDOW,
+                 answer_reserve=ANSWER_TOKEN_RESERVE):
+        self.budget = budget
+        self.context_window = context_window
+        self.answer_reserve = answer_reserve
+        self.reset()
+
+    def reset(self):
+        self.context = None
+        self.sent = []
+
+    def prompt(self, query, snippets):
+        """返回本轮要发送的提示词，需要时会先开始新的对话。"""
+        if self.context is not None:
+            room = self.context_window - len(self.context) - self.answer_reserve
+            budget = min(self.budget, room - count_tokens(FOLLOW_UP_HEADER.format(query=query) + FOLLOW_UP_FOOTER))
+            if budget >= MIN_SNIPPET_TOKENS:
+                selected = select_snippets(snippets, budget, exclude=self.sent)
+                self.sent.extend(selected)
+                prompt = FOLLOW_UP_HEADER.format(query=query)
+                if selected:
+                    prompt += FOLLOW_UP_CONTEXTS + format_snippets(selected, len(self.sent) - len(selected) + 1)
+                return prompt + FOLLOW_UP_FOOTER
+            self.reset()
+
+        selected = select_snippets(snippets, self.budget)
+        self.sent = list(selected)
+        return PROMPT_HEADER.format(query=query) + format_snippets(selected) + PROMPT_FOOTER
+
+    def finish(self, stats):
+        """记录一次生成的结果，stats 为 ollama_client.GenerationStats。"""
+        if stats.cancelled or not stats.context:
+            self.reset()
+        else:
+            self.context = stats.context
@@ -0,0 +1,119 @@
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+MAX_ENTRIES = 1024
+
+# 查询向量的余弦相似度不低于该值、且检索到的片段完全相同时，直接复用已生成的回答
+SIMILARITY_THRESHOLD = 0.95
+
+
+def normalize_query(query):
+    return ' '.join(query.lower().split()).rstrip('?!.。？！ ')
+
+
+def snippet_key(snippets):
+    """检索结果的指纹，与片段顺序无关。"""
+    hasher = hashlib.sha1()
+    for snippet in sorted(snippets):
+        hasher.update(hashlib.sha1(snippet.encode('utf8')).digest())
+    return hasher.hexdigest()
+
+
+class CacheEntry:
+    def __init__(self, query_vector, snippets, answer):
+        self.query_vector = query_vector
+        self.snippets = snippets
+        self.snippet_key = snippet_key(snippets)
+        self.answer = answer
+
+
+class QueryCache:
+    """两级查询缓存。
+
+    第一级按规范化后的查询文本精确匹配，命中时检索和生成都可以跳过；第二级在检索之后，按查询向量的
+    余弦相似度查找已有回答，只有检索到的片段集合完全相同时才复用，因此只省去生成。两级共用同一个
+    按最近使用顺序淘汰的容量上限。索引重建后调用 clear() 使全部条目失效。
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, similarity_threshold=SIMILARITY_THRESHOLD):
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self.version = 0
+        self._entries = OrderedDict()
+        # 片段指纹 -> 有回答的条目的键，语义匹配只需要和检索结果相同的条目比较
+        self._by_snippets = {}
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self.version += 1
+        self._entries.clear()
+        self._by_snippets.clear()
+
+    def lookup(self, query, k, need_answer=False):
+        """精确匹配。need_answer 为真时，没有回答的条目仍会返回（可以跳过检索），但不计为命中。"""
+        key = (normalize_query(query), k)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        if entry.answer is not None or not need_answer:
+            self.hits += 1
+        return entry
+
+    def lookup_similar(self, query_vector, snippets):
+        keys = self._by_snippets.get(snippet_key(snippets))
+        if keys:
+            query_vector = _unit(query_vector)
+            candidates = list(keys)
+            vectors = np.stack([self._entries[key].query_vector for key in candidates])
+            similarities = vectors @ query_vector
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.similarity_threshold:
+                self._entries.move_to_end(candidates[best])
+                self.semantic_hits += 1
+                return self._entries[candidates[best]].answer
+        self.misses += 1
+        return None
+
+    def store(self, query, k, query_vector, snippets, answer=None, version=None):
+        """写入缓存。version 与当前不一致说明期间索引已重建，结果作废。"""
+        if version is not None and version != self.version:
+            return
+        key = (normalize_query(query), k)
+        self._remove(key)
+        # 走符号快速路径的查询没有向量，只参与精确匹配
+        entry = CacheEntry(None if query_vector is None else _unit(query_vector), snippets, answer)
+        self._entries[key] = entry
+        if answer is not None and entry.query_vector is not None:
+            self._by_snippets.setdefault(entry.snippet_key, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None or entry.answer is None or entry.query_vector is None:
+            return
+        keys = self._by_snippets[entry.snippet_key]
+        keys.discard(key)
+        if not keys:
+            del self._by_snippets[entry.snippet_key]
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'semantic_hits': self.semantic_hits,
+            'misses': self.misses,
+        }
+
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype='float32').reshape(-1)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
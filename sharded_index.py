@@ -0,0 +1,281 @@
+import argparse
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import index_store
+import metrics
+import optimized_rag_java_analyzer as rag
+from lexical_index import corpus_stats, split_identifier
+
+logging.basicConfig(level=logging.INFO)
+
+# 每个分片在这个目录下有自己的缓存子目录，分片列表记录在 shards.json 中
+SHARD_CACHE_DIR = 'shard_index_cache'
+SHARDS_FILE = 'shards.json'
+
+# 含有这些文件的目录视为一个 Maven/Gradle 模块，单独成为一个分片
+BUILD_FILES = ('pom.xml', 'build.gradle', 'build.gradle.kts')
+
+# 并行检索各分片的线程数；FAISS 检索和词法检索的 NumPy 运算大多会释放 GIL
+MAX_SEARCH_THREADS = 8
+
+# 路由时忽略的通用包名和目录名，它们几乎出现在每个分片中
+GENERIC_TERMS = {'com', 'org', 'net', 'io', 'java', 'main', 'src', 'test', 'app', 'core', 'common', 'impl'}
+
+
+def discover_modules(repo_path):
+    """返回 [(模块相对路径, 需要排除的子模块目录)]，仓库根目录的相对路径为 '.'。
+
+    每个 Java 文件归属于包含它的最深一层模块，因此父模块的分片要排除嵌套在其中的子模块；
+    不含 Java 文件的模块（如只做聚合的父 pom）不单独成为分片。
+    """
+    repo_path = os.path.abspath(repo_path)
+    roots = {repo_path}
+    java_dirs = set()
+    for root, dirs, files in os.walk(repo_path):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        if any(name in files for name in BUILD_FILES):
+            roots.add(root)
+        if any(name.endswith('.java') for name in files):
+            java_dirs.add(root)
+
+    def owner(directory):
+        while directory not in roots:
+            directory = os.path.dirname(directory)
+        return directory
+
+    owned = {owner(directory) for directory in java_dirs}
+    modules = []
+    for root in sorted(owned):
+        nested = sorted(other for other in roots if other != root and other.startswith(os.path.join(root, '')))
+        modules.append((os.path.relpath(root, repo_path), nested))
+    return modules
+
+
+def query_terms(query):
+    """查询中的词：标识符按 camelCase 切分，另外保留原样的小写标识符和带点的包名。"""
+    terms = set()
+    for word in re.findall(r'[A-Za-z_$][\w$.]*', query):
+        word = word.strip('.')
+        terms.add(word.lower())
+        for segment in word.split('.'):
+            terms.add(segment.lower())
+            terms.update(split_identifier(segment))
+    return terms - GENERIC_TERMS
+
+
+class Shard:
+    """一个仓库或模块的索引，有自己的缓存目录，可以单独构建和增量刷新。"""
+
+    def __init__(self, name, path, exclude=(), cache_dir=None):
+        self.name = name
+        self.path = path
+        self.exclude = list(exclude)
+        self.cache_dir = cache_dir
+        self.index = None
+        self.snippets = None
+        self.lexical = None
+        self.packages = None
+
+    @property
+    def loaded(self):
+        return self.index is not None
+
+    def load(self, force_rebuild=False):
+        with metrics.timer('shard_load'):
+            self.index, self.snippets, self.lexical = rag.load_or_create_index(
+                self.path, force_rebuild, self.cache_dir, self.exclude)
+        self.read_packages()
+        logging.info(f"Shard {self.name}: {self.index.ntotal} vectors, {len(self.packages)} packages")
+
+    def read_packages(self):
+        """从分片的 manifest.json 读出包名，不加载索引、词法索引和片段。"""
+        manifest = index_store.load_manifest(self.cache_dir) or {'files': {}}
+        self.packages = {entry['package'] for entry in manifest['files'].values() if entry.get('package')}
+
+    def keywords(self):
+        """路由用的关键词：分片名的各部分，以及包名的各段和各级前缀。"""
+        if self.packages is None:
+            self.read_packages()
+        words = set()
+        for part in re.split(r'[/\\_\-.]+', self.name.lower()):
+            words.add(part)
+            words.update(split_identifier(part))
+        for package in self.packages:
+            segments = package.lower().split('.')
+            words.update(segments)
+            words.update('.'.join(segments[:i]) for i in range(2, len(segments) + 1))
+        return words - GENERIC_TERMS - {''}
+
+    def to_json(self):
+        return {'name': self.name, 'path': self.path, 'exclude': self.exclude}
+
+
+class ShardedIndex:
+    """由多个分片组成的索引，每个仓库或 Maven/Gradle 模块一个分片。
+
+    分片各自构建、各自增量刷新，新增一个仓库不会重建其他分片。查询只编码一次，然后在线程池中
+    并行检索选中的分片，各分片的词法（按全局语料统计打分）和向量候选按得分合并后再融合成最终的前 k 个结果。
+    """
+
+    def __init__(self, cache_dir=SHARD_CACHE_DIR, max_workers=MAX_SEARCH_THREADS):
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        self.shards = {}
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        path = os.path.join(cache_dir, SHARDS_FILE)
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for entry in json.load(f):
+                    self.shards[entry['name']] = self._shard(entry['name'], entry['path'], entry['exclude'])
+
+    def _shard(self, name, path, exclude=()):
+        return Shard(name, path, exclude, os.path.join(self.cache_dir, re.sub(r'[^\w.\-]+', '__', name)))
+
+    def _save(self):
+        path = os.path.join(self.cache_dir, SHARDS_FILE)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump([shard.to_json() for shard in self.shards.values()], f, indent=2)
+        os.replace(path + '.tmp', path)
+
+    def add_repo(self, repo_path, name=None, split_modules=True):
+        """登记仓库并构建（或增量刷新）它的分片，返回这些分片的名字。其他仓库的分片不受影响。"""
+        repo_path = os.path.abspath(repo_path)
+        name = name or os.path.basename(repo_path.rstrip(os.sep))
+        # 分片名同时是缓存目录名，同名的另一个仓库会被悄悄替换掉
+        for shard_name, shard in self.shards.items():
+            if (shard_name == name or shard_name.startswith(f"{name}/")) and not (
+                    shard.path == repo_path or shard.path.startswith(os.path.join(repo_path, ''))):
+                raise ValueError(f"Shard {shard_name} already indexes {shard.path}, "
+                                 f"choose another name for {repo_path}")
+        modules = discover_modules(repo_path) if split_modules else [('.', [])]
+        names = []
+        for relative_path, exclude in modules:
+            shard_name = name if relative_path == '.' else f"{name}/{relative_path.replace(os.sep, '/')}"
+            shard = self._shard(shard_name, os.path.normpath(os.path.join(repo_path, relative_path)), exclude)
+            shard.load()
+            with self._lock:
+                self.shards[shard_name] = shard
+            names.append(shard_name)
+
+        # 仓库中已经不存在的模块
+        stale = [shard_name for shard_name in self.shards if shard_name not in names
+                 and (shard_name == name or shard_name.startswith(f"{name}/"))]
+        for shard_name in stale:
+            self.remove_shard(shard_name)
+        self._save()
+        return names
+
+    def remove_shard(self, name):
+        with self._lock:
+            shard = self.shards.pop(name, None)
+        if shard is not None:
+            shutil.rmtree(shard.cache_dir, ignore_errors=True)
+            self._save()
+
+    def refresh(self, names=None, force_rebuild=False):
+        """增量刷新指定的分片（默认全部），只重新处理各自目录中变化的文件。"""
+        for name in names or list(self.shards):
+            self.shards[name].load(force_rebuild)
+
+    def route(self, query):
+        """选出名字或包名与查询中的词相匹配的分片，没有匹配时返回全部分片。
+
+        关键词只来自各分片的 manifest.json，路由本身不加载任何分片的索引。
+        """
+        terms = query_terms(query)
+        keywords = {name: shard.keywords() for name, shard in self.shards.items()}
+        # 所有分片都有的词（如共同的包名前缀）区分不了分片
+        if len(keywords) > 1:
+            terms -= set.intersection(*keywords.values())
+        matched = [name for name, words in keywords.items() if terms & words]
+        return matched or list(self.shards)
+
+    def _ensure_loaded(self, shards):
+        for shard in shards:
+            if not shard.loaded:
+                shard.load()
+
+    def search(self, query, k=5, shards=None, route=False):
+        """并行检索选中的分片（默认全部，route 为真时按查询路由），返回 [(分片名, 片段)]。"""
+        if shards is None:
+            shards = self.route(query) if route else list(self.shards)
+        targets = [self.shards[name] for name in shards]
+        if not targets:
+            return []
+        self._ensure_loaded(targets)
+
+        # 查询向量只计算一次，所有分片共用；精确符号查询在任一分片命中时只走词法检索
+        symbol_query = rag.RETRIEVAL_MODE != 'vector' and any(
+            shard.lexical is not None and shard.lexical.exact_symbol(query) for shard in targets)
+        query_vector = None
+        if not symbol_query and rag.RETRIEVAL_MODE != 'lexical':
+            query_vector = rag.encode_texts([query], 'encode_query')
+
+        # BM25 的 IDF 和平均长度按所有选中分片合起来的语料计算，否则小分片或含罕见词的分片得分偏高
+        corpus = corpus_stats([shard.lexical for shard in targets if shard.lexical is not None], query)
+
+        def candidates(shard):
+            return rag.retrieval_candidates(shard.index, shard.lexical, query, query_vector, k, corpus)
+
+        with metrics.timer('shard_search'):
+            if len(targets) == 1:
+                results = [candidates(targets[0])]
+            else:
+                with ThreadPoolExecutor(max_workers=min(self.max_workers, len(targets))) as executor:
+                    results = list(executor.map(candidates, targets))
+
+        # 向量距离来自同一个编码器，BM25 用的是全局统计，两种得分在分片之间都可比，按得分合并成
+        # 全局的候选列表；片段 ID 只在分片内唯一，用 (分片序号, ID) 区分
+        lexical_results, vector_results = [], []
+        for position, (shard_lexical, shard_vector) in enumerate(results):
+            lexical_results.extend(((position, i), score) for i, score in shard_lexical)
+            vector_results.extend(((position, i), score) for i, score in shard_vector)
+        lexical_results.sort(key=lambda item: item[1], reverse=True)
+        vector_results.sort(key=lambda item: item[1], reverse=True)
+        fused = rag.fuse_results(lexical_results, vector_results, k)
+        return [(targets[position].name, targets[position].snippets[i]) for position, i in fused]
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Sharded multi-repository index")
+    arg_parser.add_argument('--cache-dir', default=SHARD_CACHE_DIR)
+    commands = arg_parser.add_subparsers(dest='command', required=True)
+    add_parser = commands.add_parser('add', help="add a repository, one shard per Maven/Gradle module")
+    add_parser.add_argument('repo_path')
+    add_parser.add_argument('--name', help="shard name, defaults to the directory name; must be unique")
+    add_parser.add_argument('--no-split', action='store_true', help="index the whole repository as one shard")
+    refresh_parser = commands.add_parser('refresh', help="pick up changed files in the given shards (default all)")
+    refresh_parser.add_argument('shards', nargs='*')
+    refresh_parser.add_argument('--force', action='store_true')
+    commands.add_parser('list')
+    search_parser = commands.add_parser('search')
+    search_parser.add_argument('query')
+    search_parser.add_argument('-k', type=int, default=5)
+    search_parser.add_argument('--shards', help="comma separated shard names")
+    search_parser.add_argument('--route', action='store_true', help="only search shards matching the query")
+    args = arg_parser.parse_args()
+
+    sharded = ShardedIndex(args.cache_dir)
+    if args.command == 'add':
+        for name in sharded.add_repo(args.repo_path, args.name, not args.no_split):
+            print(name)
+    elif args.command == 'refresh':
+        sharded.refresh(args.shards, args.force)
+    elif args.command == 'list':
+        for name, shard in sharded.shards.items():
+            print(f"{name}\t{shard.path}")
+    elif args.command == 'search':
+        shards = args.shards.split(',') if args.shards else None
+        for i, (name, snippet) in enumerate(sharded.search(args.query, args.k, shards, args.route), 1):
+            print(f"\n[{i}] {name}\n{snippet}")
+    metrics.dump(rag.METRICS_FILE)
+
+
+if __name__ == "__main__":
+    main()